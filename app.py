@@ -0,0 +1,167 @@
+import time
+import threading
+import numpy as np
+from flask import Flask, request, jsonify
+from flask_cors import CORS
+from brainMRI.logging import logger
+
+app = Flask(__name__)
+CORS(app)
+
+predictor = None
+startup = {'ready': False, 'error': None, 'phases': {}}
+
+
+def _start() -> None:
+    """
+    Imports the model stack, loads and warms up the predictor, and records how long each phase took.
+    Runs in the background so that the readiness endpoint answers while the replica is starting.
+    """
+    global predictor
+    try:
+        start = time.perf_counter()
+        from brainMRI.config.configuration import ConfigHandler
+        startup['phases']['import_seconds'] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        config = ConfigHandler()
+        config.get_logging_config('serve').apply()
+        startup['phases']['config_seconds'] = time.perf_counter() - start
+        startup['runtime'] = config.get_runtime_config('serve').apply()['effective']
+
+        loaded = config.get_prediction_config()
+        startup['phases'].update(loaded.load_timings)
+        if loaded.registry is not None:
+            loaded.start_watching()
+
+        predictor = loaded
+        startup['ready'] = True
+        logger.info(f"Predictor ready: {startup['phases']}")
+    except Exception as e:
+        startup['error'] = str(e)
+        logger.exception(e)
+
+
+threading.Thread(target=_start, name='predictor-startup', daemon=True).start()
+
+
+def _not_ready():
+    return jsonify({'error': 'Predictor is not ready', 'startup': startup}), 503
+
+
+def _flag(name: str, default: bool) -> bool:
+    """
+    Reads a boolean request option from the query string or form fields.
+    """
+    value = request.values.get(name)
+    if value is None:
+        return default
+    return value.strip().lower() in ('1', 'true', 'yes', 'on')
+
+
+@app.route('/predict', methods=['POST'])
+def predict():
+    """
+    Predicts the class of one or more uploaded images, sent as multipart `file` fields.
+    Test-time augmentation is enabled per request with `tta=true`, and Grad-CAM overlays
+    (base64 PNGs in `gradcam`) with `explain=true`.
+    """
+    if predictor is None:
+        return _not_ready()
+
+    files = request.files.getlist('file')
+    if not files:
+        return jsonify({'error': "No images uploaded in the 'file' field"}), 400
+
+    try:
+        predictions = predictor.predict_files([file.stream for file in files], tta=_flag('tta', predictor.tta),
+                                              explain=_flag('explain', predictor.explain),
+                                              names=[file.filename for file in files])
+    except Exception as e:
+        logger.exception(e)
+        return jsonify({'error': str(e)}), 400
+
+    return jsonify({
+        'predictions': [dict(prediction, filename=file.filename) for file, prediction in zip(files, predictions)]
+    })
+
+
+@app.route('/predict/tensor', methods=['POST'])
+def predict_tensor():
+    """
+    Predicts a batch of images sent as pixel arrays in the request body, as a `.npy` file or a
+    length-prefixed tensor (see `brainMRI.components.tensor_payload`), which skips image decoding and
+    resizing. Takes the same `tta` and `explain` options as /predict.
+    """
+    if predictor is None:
+        return _not_ready()
+
+    tta, explain = _flag('tta', predictor.tta), _flag('explain', predictor.explain)
+    data = request.get_data(cache=False)
+    if not data:
+        return jsonify({'error': "No tensor in the request body"}), 400
+
+    try:
+        predictions = predictor.predict(predictor.load_tensor(data), tta=tta, explain=explain)
+    except Exception as e:
+        logger.exception(e)
+        return jsonify({'error': str(e)}), 400
+
+    return jsonify({'predictions': [dict(prediction, index=index) for index, prediction in enumerate(predictions)]})
+
+
+@app.route('/similar', methods=['POST'])
+def similar():
+    """
+    Finds the prior scans most similar to each uploaded image, sent as multipart `file` fields. The
+    number of neighbours is set per request with `k`.
+    """
+    if predictor is None:
+        return _not_ready()
+
+    files = request.files.getlist('file')
+    if not files:
+        return jsonify({'error': "No images uploaded in the 'file' field"}), 400
+
+    try:
+        k = int(request.values.get('k', 0)) or None
+        images = np.stack([predictor.load_image(file.stream) for file in files])
+        neighbours, timings = predictor.similar(images, k)
+    except Exception as e:
+        logger.exception(e)
+        return jsonify({'error': str(e)}), 400
+
+    return jsonify({
+        'results': [{'filename': file.filename, 'neighbours': found} for file, found in zip(files, neighbours)],
+        **timings,
+    })
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """
+    Reports the prediction cache hit/miss counters, the size of the similar-case index and the loaded model version.
+    """
+    if predictor is None:
+        return _not_ready()
+    cache_metrics = predictor.cache.metrics() if predictor.cache is not None else {}
+    retrieval_metrics = predictor.retrieval.stats() if predictor.retrieval is not None else {}
+    return jsonify({'model_version': predictor.model_version, 'cache': cache_metrics, 'retrieval': retrieval_metrics})
+
+
+@app.route('/ready', methods=['GET'])
+def ready():
+    """
+    Readiness probe: 200 once the model is loaded and warmed up at every configured batch size,
+    503 before that. Reports the duration of each start-up phase either way.
+    """
+    status = 200 if startup['ready'] else 503
+    payload = dict(startup)
+    if predictor is not None:
+        payload['model_version'] = predictor.model_version
+        payload['last_load'] = predictor.load_timings
+    return jsonify(payload), status
+
+
+if __name__ == '__main__':
+    app.run(host='0.0.0.0', port=8080)
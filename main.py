@@ -1,5 +1,6 @@
 from brainMRI.logging import logger
 from brainMRI.config.configuration import ConfigHandler
+from brainMRI.components.scheduler import Stage
 from brainMRI.pipeline.base_model_pipeline import BaseModelPipeline
 from brainMRI.pipeline.callbacks_pipeline import CallbacksPipeline
 from brainMRI.pipeline.fetch_data_pipeline import FetchDataPipeline
@@ -7,40 +8,39 @@ from brainMRI.pipeline.analze_data_pipeline import AnalyzeDataPipeline
 from brainMRI.pipeline.prepare_datasets_pipeline import PrepareDatasetsPipeline
 from brainMRI.pipeline.transfer_learning_pipeline import TransferLearningPipeline
 
-config = ConfigHandler()
 
-pipelines = {
-    "Fetch Data stage": FetchDataPipeline(config),
-    "Analyze Data stage": AnalyzeDataPipeline(config),
-    "Prepare Datasets stage": PrepareDatasetsPipeline(config),
-    "Base Model stage": BaseModelPipeline(config),
-    "Callbacks stage": CallbacksPipeline(config),
-    "Transfer Learning stage": TransferLearningPipeline(config),
-}
-
-def run_pipeline(stage_name, pipeline_instance):
+def build_stages(config: ConfigHandler) -> list:
     """
-    Run a specific stage of the pipeline and log the start and completion messages.
+    Lists the pipeline stages with the stages each one needs to have completed.
 
     Args:
-        stage_name: Name of the pipeline stage
-        pipeline_instance: Instance of the pipeline to be executed
+        config: The configuration the stages will run with
 
     Returns:
-        None
-
-    Raises:
-        Any exceptions that occur during the pipeline execution
+        List[Stage]: The stages, forming a DAG
 
     """
+    # The prepare stage leaves out the files the analyze stage quarantined, so it has to wait for them
+    prepare_after = ['fetch_data', 'analyze_data'] if config.params.quarantine.enabled else ['fetch_data']
+    return [
+        Stage('fetch_data', "Fetch Data stage", FetchDataPipeline),
+        Stage('analyze_data', "Analyze Data stage", AnalyzeDataPipeline, after=['fetch_data']),
+        Stage('prepare_datasets', "Prepare Datasets stage", PrepareDatasetsPipeline, after=prepare_after),
+        # The base model previews its augmentation on the prepared training set
+        Stage('base_model', "Base Model stage", BaseModelPipeline, after=['prepare_datasets']),
+        Stage('callbacks', "Callbacks stage", CallbacksPipeline),
+        # Class balancing reads the per-class image counts the analyze stage writes
+        Stage('transfer_learning', "Transfer Learning stage", TransferLearningPipeline,
+              after=['analyze_data', 'prepare_datasets', 'base_model', 'callbacks']),
+    ]
+
+if __name__ == '__main__':
     try:
-        logger.info(f">>>>>> stage {stage_name} started <<<<<<")  # Log the start of the pipeline stage
-        pipeline_instance.main()  # Execute the main method of the pipeline instance
-        logger.info(f">>>>>> stage {stage_name} completed <<<<<<\n\nx==========x")  # Log the completion of the pipeline stage
+        config = ConfigHandler()
+        # This process writes the log file for every stage, so the file takes the configured settings
+        config.get_logging_config('scheduler').apply()
+        scheduler = config.get_stage_scheduler_config()
+        scheduler.run(build_stages(config))  # Run the stages concurrently as their dependencies complete
     except Exception as e:
         logger.exception(e)  # Log the exception if an error occurs
-        raise e  # Raise the exception to propagate it further
-
-if __name__ == '__main__':
-    for stage_name, pipeline_instance in pipelines.items():
-        run_pipeline(stage_name, pipeline_instance)  # Execute each pipeline stage using the run_pipeline function
\ No newline at end of file
+        raise e
\ No newline at end of file
@@ -6,6 +6,8 @@ import seaborn as sns
 from pathlib import Path
 from PIL import Image
 import matplotlib.pyplot as plt
+from brainMRI.components.quarantine import FileVerifier
+from brainMRI.components.volumes import VolumeReader, is_volume
 from brainMRI.logging import logger
 from dataclasses import dataclass, field
 from typing import List
@@ -24,6 +26,9 @@ class AnalyzeImageData:
     image_stats_results_path: Path
     plots_path: Path
     root: List[Path] = field(default_factory=list)
+    volume_reader: VolumeReader = None
+    volume_metadata_path: Path = None
+    verifier: FileVerifier = None
 
 
     def __post_init__(self) -> None:
@@ -34,6 +39,7 @@ class AnalyzeImageData:
 
         The collected directory paths are stored in the `self.root` list.
         """
+        self.quarantined = set()
         for root, _, files in os.walk(self.data_folder):
             for _ in files:
                 if root not in self.root:
@@ -45,6 +51,7 @@ class AnalyzeImageData:
         It ensures that the necessary data and analysis are performed for the image dataset.
         """
         try:
+            self.verify_files()
             self.get_image_metadata()
             self.check_image_quality_and_format()
             self.check_image_counts()
@@ -53,6 +60,19 @@ class AnalyzeImageData:
             logger.error(f'Error running all methods: {e}')
             raise e
 
+    def verify_files(self) -> None:
+        """
+        Fully decodes every image and volume in parallel and quarantines the files that fail, so that
+        the checks below and the later stages skip them instead of stopping on the first bad file.
+        """
+        if self.verifier is None:
+            return
+        failures = self.verifier.verify()
+        self.quarantined = {os.path.normpath(os.path.join(self.verifier.data_dir, path)) for path in failures}
+
+    def _is_quarantined(self, image_path) -> bool:
+        return os.path.normpath(str(image_path)) in self.quarantined
+
     def get_image_metadata(self) -> None:
         """
         This method collects metadata for all the images in the `self.data_folder` directory.
@@ -65,16 +85,34 @@ class AnalyzeImageData:
         """
         try:
             metadata = []
+            volumes = []
 
             for dir_path in self.root:
                 label = os.path.basename(dir_path)
 
                 for image_path in Path(dir_path).glob('*'):
-                    image = Image.open(image_path)
-                    width, height = image.size
-                    channels = len(image.getbands())
+                    if self._is_quarantined(image_path):
+                        continue
+                    if self._is_volume(image_path):
+                        # Volumes are described from their headers, without reading any voxels
+                        header = self.volume_reader.header(str(image_path))
+                        width, height = self.volume_reader.slice_size(header)
+                        metadata.append((str(image_path), str(label), width, height, 1))
+                        volumes.append(dict(header, path=str(image_path), label=str(label)))
+                        continue
+                    try:
+                        with Image.open(image_path) as image:
+                            width, height = image.size
+                            channels = len(image.getbands())
+                    except Exception as e:
+                        logger.warning(f"Skipping unreadable image {image_path}: {e}")
+                        continue
                     metadata.append((str(image_path), str(label), width, height, channels))
 
+            if volumes and self.volume_metadata_path:
+                pd.DataFrame(volumes).to_csv(self.volume_metadata_path, index=False)
+                logger.info(f"Header metadata of {len(volumes)} volumes saved to: {self.volume_metadata_path}")
+
             with open(self.image_metadata_path, 'w', newline='') as metadata_file:
                 writer = csv.writer(metadata_file)
                 writer.writerow(['File Path', 'class', 'Width', 'Height', 'Channels'])
@@ -86,6 +124,9 @@ class AnalyzeImageData:
             logger.error(f'Error collecting image metadata: {e}')
             raise e
 
+    def _is_volume(self, image_path) -> bool:
+        return self.volume_reader is not None and is_volume(str(image_path))
+
     def get_image_dimensions(self, image_path: str) -> tuple[int, int,int]:
         """
         Get the width, height, and number of channels of an image.
@@ -100,7 +141,7 @@ class AnalyzeImageData:
             with Image.open(image_path) as img:
                 width, height = img.size
                 channels = len(img.getbands())
-                logger.info(f"Extracted dimensions for {os.path.basename(image_path)}: {width}x{height}x{channels}")
+                logger.debug(f"Extracted dimensions for {os.path.basename(image_path)}: {width}x{height}x{channels}")
                 return (width, height, channels)
         except Exception as e:
             logger.error(f"Error getting dimensions for {os.path.basename(image_path)}: {e}")
@@ -124,6 +165,14 @@ class AnalyzeImageData:
 
             for dir_path in self.root:
                 for image_path in Path(dir_path).glob('*'):
+                    if self._is_quarantined(image_path):
+                        continue
+                    if self._is_volume(image_path):
+                        try:
+                            self.volume_reader.header(str(image_path))
+                        except (OSError, ValueError, ImportError) as e:
+                            format_issues.append((str(image_path), str(e)))
+                        continue
                     try:
                         image = Image.open(image_path)
                         if image.mode not in ('RGB', 'RGBA', 'L', 'P'):
@@ -131,9 +180,8 @@ class AnalyzeImageData:
                         if image.getbands() not in (('R', 'G', 'B'), ('R', 'G', 'B', 'A'),('L',), ('P',)):
                             quality_issues.append((str(image_path), image.getbands()))
                     except Exception as e:
-                        format_issues.append(str(image_path))
-                        raise e
-                        
+                        # One unreadable image is reported, not allowed to stop the check
+                        format_issues.append((str(image_path), str(e)))
 
             with open(self.image_quality_and_format, 'w') as quality_file:
                 if quality_issues:
@@ -150,6 +198,11 @@ class AnalyzeImageData:
                 else:
                     quality_file.write('\nNo image format issues found.\n')
 
+                if self.quarantined:
+                    quality_file.write('\nQuarantined files:\n')
+                    for path in sorted(self.quarantined):
+                        quality_file.write(f"{path}\n")
+
             logger.info("Image quality and format check saved to: image_quality_and_format.txt")
         except Exception as e:
             logger.error(f'Error checking image quality and format: {e}')
@@ -174,7 +227,11 @@ class AnalyzeImageData:
             image_counts = defaultdict(int)
             for dir_path in self.root:
                 label = os.path.basename(dir_path)
-                image_counts[label] = len(list(Path(dir_path).glob('*')))
+                # Every slice of a volume that the prepare stage keeps is one training image
+                for path in Path(dir_path).glob('*'):
+                    if self._is_quarantined(path):
+                        continue
+                    image_counts[label] += self.volume_reader.count_slices(str(path)) if self._is_volume(path) else 1
                 
 
 
@@ -232,7 +289,7 @@ class AnalyzeImageData:
                             'Channels Min', 'Channels Max', 'Channels Mean', 'Channels Std',
                             'Count']
         for index, row in class_stats.iterrows():
-            logger.info(f"Class: {index}, Width Min={row['Width Min']}, Width Max={row['Width Max']}, Width Mean={row['Width Mean']:.2f}, Width Std={row['Width Std']:.2f}, Height Min={row['Height Min']}, Height Max={row['Height Max']}, Height Mean={row['Height Mean']:.2f}, Height Std={row['Height Std']:.2f}, Channels Min={row['Channels Min']}, Channels Max={row['Channels Max']}, Channels Mean={row['Channels Mean']:.2f}, Channels Std={row['Channels Std']:.2f}, Count={row['Count']}")
+            logger.debug(f"Class: {index}, Width Min={row['Width Min']}, Width Max={row['Width Max']}, Width Mean={row['Width Mean']:.2f}, Width Std={row['Width Std']:.2f}, Height Min={row['Height Min']}, Height Max={row['Height Max']}, Height Mean={row['Height Mean']:.2f}, Height Std={row['Height Std']:.2f}, Channels Min={row['Channels Min']}, Channels Max={row['Channels Max']}, Channels Mean={row['Channels Mean']:.2f}, Channels Std={row['Channels Std']:.2f}, Count={row['Count']}")
 
         # Save results to a text file
         with open(self.image_stats_results_path, 'w') as f:
@@ -325,12 +382,18 @@ class AnalyzeImageData:
             # Visualize and save the images
             fig, axes = plt.subplots(len(subfolders), num_images_per_class, figsize=(15, 3 * len(subfolders)))
             for i, subfolder in enumerate(subfolders):
-                class_images = [str(p) for p in Path(subfolder).glob('*')]
+                class_images = [str(p) for p in Path(subfolder).glob('*') if not self._is_quarantined(p)]
                 print(class_images)
                 for j in range(num_images_per_class):
                     image_path = random.choice(class_images)
-                    image = plt.imread(image_path)
-                    axes[i, j].imshow(image)
+                    if self._is_volume(image_path):
+                        # The middle slice of the volume
+                        slices = list(self.volume_reader.slice_paths(image_path, image_path))
+                        image = self.volume_reader.read_slice(slices[len(slices) // 2])
+                        axes[i, j].imshow(image if image is not None else np.zeros((1, 1)), cmap='gray')
+                    else:
+                        image = plt.imread(image_path)
+                        axes[i, j].imshow(image)
                     axes[i, j].set_title(os.path.basename(subfolder))
                     axes[i, j].axis('off')
             
@@ -1,6 +1,7 @@
 from dataclasses import dataclass
 from typing import Tuple
 import tensorflow as tf
+from brainMRI.components.prepare_datasets import load_dataset
 from brainMRI.logging import logger
 import matplotlib.pyplot as plt
 from pathlib import Path
@@ -29,7 +30,7 @@ class DataAugmentation:
 
     def show_aug(self, data_augmentation):
         plt.figure(figsize=(10, 10))
-        train_ds = tf.data.Dataset.load(self.training_dir)
+        train_ds = load_dataset(self.training_dir)
        
         for image, _ in train_ds.take(1):
             plt.figure(figsize=(10, 10))
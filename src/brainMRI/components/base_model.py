@@ -1,6 +1,7 @@
 import os
 from pathlib import Path
 from dataclasses import dataclass
+from functools import cached_property
 import numpy as np
 import tensorflow as tf
 from brainMRI.components.augmentation import DataAugmentation
@@ -12,16 +13,23 @@ class BaseModel:
     weights: str
     include_top: bool
     input_shape: tuple
-    fine_tune_at: int = 0
     use_augmentation: bool = True
     data_augmentation_config: DataAugmentation = None
+    flexible_input: bool = False
 
     def __post_init__(self):
-        self.base_model = tf.keras.applications.VGG16(weights=self.weights,
-                                                     include_top=self.include_top, input_shape=self.input_shape)
+        # A flexible input size lets TransferLearning train at several resolutions (progressive resizing)
+        if self.flexible_input:
+            self.input_shape = (None, None, self.input_shape[-1])
 
+    @cached_property
+    def base_model(self) -> tf.keras.Model:
+        # Built on first use, so that constructing the config does not load the ImageNet weights
+        return tf.keras.applications.VGG16(weights=self.weights, include_top=self.include_top,
+                                           input_shape=self.input_shape)
 
-    def build_model(self, data_augmentation):
+
+    def build_model(self, data_augmentation=None):
         """
         Build the final model, including the base model and the classification layers.
 
@@ -36,6 +44,9 @@ class BaseModel:
             if self.use_augmentation:
                 data_augmentation = self.data_augmentation_config.augmentation()
                 self.data_augmentation_config.show_aug(data_augmentation)
+            # Phase one of TransferLearning trains the head only; the backbone is unfrozen in phase two
+            self.base_model.trainable = False
+
             preprocess_input = tf.keras.applications.vgg16.preprocess_input
             inputs = tf.keras.Input(shape=self.input_shape)
 
@@ -68,16 +79,6 @@ class BaseModel:
             logger.info(f"Number of trainable variables: {len(model.trainable_variables)}")
             logger.info(f"Number of layers in the base model: {len(self.base_model.layers)}")
 
-            # Freeze the base model layers
-            for layer in self.base_model.layers:
-                layer.trainable = False
-
-            # Unfreeze the specified number of layers for fine-tuning
-            if self.fine_tune_at > 0:
-                # Freeze all the layers before the `fine_tune_at` layer
-                for layer in self.base_model.layers[:self.fine_tune_at]:
-                    layer.trainable = False
-
             # Save the model
             model_path = self.root_dir + '/base_model.keras'
             # tf.keras.models.save_model(model, model_path)
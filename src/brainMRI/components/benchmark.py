@@ -0,0 +1,101 @@
+import os
+import json
+import time
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import List
+import numpy as np
+from brainMRI.components.prediction import Prediction
+from brainMRI.logging import logger
+
+
+@dataclass
+class PredictionBenchmark:
+    root_dir: Path
+    batch_sizes: List[int] = field(default_factory=lambda: [1, 8, 32])
+    repeats: int = 20
+    warmup: int = 3
+    seed: int = 123
+
+    def measure(self, function, images: np.ndarray) -> dict:
+        """
+        Times repeated calls of a prediction function on the same batch after a few warm-up calls.
+
+        Returns:
+            dict: The latency percentiles in milliseconds and the throughput in images per second.
+        """
+        for _ in range(self.warmup):
+            function(images)
+
+        latencies = []
+        for _ in range(self.repeats):
+            start = time.perf_counter()
+            function(images)
+            latencies.append(time.perf_counter() - start)
+
+        latencies = np.array(latencies) * 1000
+        return {
+            'p50_ms': float(np.percentile(latencies, 50)),
+            'p95_ms': float(np.percentile(latencies, 95)),
+            'mean_ms': float(latencies.mean()),
+            'images_per_second': float(len(images) / (latencies.mean() / 1000)),
+        }
+
+    def cases(self, predictor: Prediction) -> dict:
+        """
+        Lists the benchmarked prediction paths, keyed by case name.
+
+        Returns:
+            dict: A prediction function for each case.
+        """
+        cases = {
+            'predict': lambda images: predictor.predict(images, tta=False),
+            'predict_tta': lambda images: predictor.predict(images, tta=True),
+        }
+        if predictor.backend != 'onnx':
+            cases['predict_gradcam'] = lambda images: predictor.predict(images, tta=False, explain=True)
+        if predictor.cache is not None:
+            # Every call after the first warm-up call is served from the cache
+            cases['predict_cached'] = lambda images: predictor.predict(images, tta=False)
+        return cases
+
+    def run(self, predictor: Prediction) -> dict:
+        """
+        Measures the latency and throughput of every prediction case at every configured batch size
+        on synthetic images, and saves the results to `benchmark.json`.
+
+        Args:
+            predictor (Prediction): The predictor to benchmark.
+
+        Returns:
+            dict: The benchmark results.
+        """
+        try:
+            rng = np.random.default_rng(self.seed)
+            results = {'image_size': predictor.image_size, 'cases': {}}
+            cache = predictor.cache
+            for batch_size in self.batch_sizes:
+                images = rng.integers(0, 256, size=(batch_size, predictor.image_size, predictor.image_size, 3))
+                images = images.astype(np.uint8)
+                for name, function in self.cases(predictor).items():
+                    # Uncached cases measure the model itself
+                    predictor.cache = cache if name.endswith('_cached') else None
+                    try:
+                        result = self.measure(function, images)
+                    finally:
+                        predictor.cache = cache
+                    results['cases'].setdefault(name, {})[str(batch_size)] = result
+                    logger.info(f"Benchmark {name} batch_size={batch_size}: p50={result['p50_ms']:.2f}ms, "
+                                f"p95={result['p95_ms']:.2f}ms, {result['images_per_second']:.1f} images/s")
+
+            if predictor.tta_config is not None:
+                results['tta_views'] = predictor.tta_config.num_views
+
+            results_path = os.path.join(self.root_dir, 'benchmark.json')
+            with open(results_path, 'w') as f:
+                json.dump(results, f, indent=2)
+            logger.info(f"Benchmark results saved to: {results_path}")
+            return results
+        except Exception as e:
+            logger.error(f'Error running benchmark: {e}')
+            raise e
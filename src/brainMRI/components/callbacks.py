@@ -1,17 +1,152 @@
 from dataclasses import dataclass
 import os
+import queue
+import threading
 from brainMRI.logging import logger
-import os
-from tensorflow.keras.callbacks import ModelCheckpoint, TensorBoard, EarlyStopping, ReduceLROnPlateau
+import tensorflow as tf
+from tensorflow.keras.callbacks import TensorBoard, EarlyStopping, ReduceLROnPlateau
 from pathlib import Path
 import pickle
 
+
+class AsyncModelCheckpoint(tf.keras.callbacks.Callback):
+    """
+    A checkpoint callback that does not block training on disk I/O. At the end of an epoch the weights
+    are copied to host memory, and a background thread loads them into a shadow copy of the model and
+    writes it under a temporary name before renaming it into place, so a checkpoint is never half written.
+
+    Only the `keep_best` checkpoints with the best `monitor` value and the `keep_last` most recent ones
+    are kept. With `keep_last` = 0, a checkpoint is written only when `monitor` improves. With
+    `weights_only`, each checkpoint is a `.weights.h5` file and the architecture is written once to
+    `model.json`. Checkpoints do not include the optimizer state.
+
+    At most one snapshot waits for the writer, so a disk slower than an epoch holds one extra copy of
+    the weights in memory and then slows training down instead of growing without bound.
+    """
+
+    def __init__(self, directory: str, monitor: str = 'val_accuracy', mode: str = 'max', keep_best: int = 3,
+                 keep_last: int = 0, weights_only: bool = False):
+        super().__init__()
+        if mode not in ('min', 'max'):
+            raise ValueError(f"mode must be 'min' or 'max', got {mode}")
+        self.directory = directory
+        self.monitor = monitor
+        self.mode = mode
+        self.keep_best = keep_best
+        self.keep_last = keep_last
+        self.weights_only = weights_only
+        self.best = None
+        # (write sequence, monitored value, path) of the checkpoints on disk, updated by the writer thread.
+        # The sequence orders them by age across fits, which restart the epoch count
+        self.checkpoints = []
+        self._reset_writer()
+
+    def _reset_writer(self) -> None:
+        self._queue = None
+        self._thread = None
+        self._shadow = None
+        self._shadow_of = None
+        self._error = None
+
+    def __getstate__(self):
+        # The writer thread, queue and shadow model are rebuilt when training starts
+        state = self.__dict__.copy()
+        for name in ('_queue', '_thread', '_shadow', '_shadow_of', '_error', '_model'):
+            state[name] = None
+        return state
+
+    def _improved(self, value: float) -> bool:
+        if self.best is None:
+            return True
+        return value > self.best if self.mode == 'max' else value < self.best
+
+    def on_train_begin(self, logs=None):
+        os.makedirs(self.directory, exist_ok=True)
+        # The model changes between training phases (e.g. the head trained alone), so the shadow copy
+        # is rebuilt on the main thread whenever a different model is trained
+        if self._shadow_of is not self.model:
+            self._shadow = tf.keras.models.clone_model(self.model)
+            self._shadow_of = self.model
+            if self.weights_only:
+                with open(os.path.join(self.directory, 'model.json'), 'w') as f:
+                    f.write(self.model.to_json())
+        self._queue = queue.Queue(maxsize=1)
+        self._thread = threading.Thread(target=self._write_loop, name='checkpoint-writer', daemon=True)
+        self._thread.start()
+
+    def on_epoch_end(self, epoch, logs=None):
+        logs = logs or {}
+        if self.monitor not in logs:
+            logger.warning(f"Checkpoint skipped at epoch {epoch + 1}: {self.monitor} is not in the logs")
+            return
+        value = float(logs[self.monitor])
+        improved = self._improved(value)
+        if improved:
+            self.best = value
+        elif not self.keep_last:
+            return
+
+        extension = '.weights.h5' if self.weights_only else '.keras'
+        path = os.path.join(self.directory, f'model-{epoch + 1:02d}-{value:.2f}{extension}')
+        # get_weights copies the variables to host memory; training continues while the copy is written
+        self._queue.put((epoch, value, path, self.model.get_weights()))
+
+    def on_train_end(self, logs=None):
+        self._queue.put(None)
+        self._thread.join()
+        self._queue, self._thread = None, None
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+    def _write_loop(self) -> None:
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            if self._error is not None:
+                continue
+            epoch, value, path, weights = item
+            try:
+                self._shadow.set_weights(weights)
+                tmp_path = path.replace(os.path.basename(path), 'tmp-' + os.path.basename(path))
+                if self.weights_only:
+                    self._shadow.save_weights(tmp_path)
+                else:
+                    self._shadow.save(tmp_path)
+                os.replace(tmp_path, path)
+                sequence = max((checkpoint[0] for checkpoint in self.checkpoints), default=-1) + 1
+                self.checkpoints = [checkpoint for checkpoint in self.checkpoints if checkpoint[2] != path]
+                self.checkpoints.append((sequence, value, path))
+                self._prune()
+                logger.info(f"Checkpoint saved: {path}")
+            except Exception as e:
+                logger.error(f'Error writing checkpoint {path}: {e}')
+                self._error = e
+
+    def _prune(self) -> None:
+        """
+        Deletes the checkpoints that are neither among the best `keep_best` nor the last `keep_last`.
+        """
+        ranked = sorted(self.checkpoints, key=lambda checkpoint: checkpoint[1], reverse=self.mode == 'max')
+        latest = sorted(self.checkpoints, key=lambda checkpoint: checkpoint[0])
+        keep = {checkpoint[2] for checkpoint in ranked[:self.keep_best]}
+        keep.update(checkpoint[2] for checkpoint in latest[len(latest) - self.keep_last:])
+        for checkpoint in self.checkpoints:
+            if checkpoint[2] not in keep and os.path.exists(checkpoint[2]):
+                os.remove(checkpoint[2])
+        self.checkpoints = [checkpoint for checkpoint in self.checkpoints if checkpoint[2] in keep]
+
+
 @dataclass
 class Callbacks:
     root_dir: Path
     patience: int = 5
     factor: float = 0.1
     min_lr: float = 1e-6
+    checkpoint_keep_best: int = 3
+    checkpoint_keep_last: int = 0
+    checkpoint_weights_only: bool = False
 
 
     def get_callbacks(self) -> list:
@@ -27,12 +162,14 @@ class Callbacks:
     """
         
         checkpoint_dir = self.root_dir + '/ckpt'
-        # Create the ModelCheckpoint callback
-        model_checkpoint = ModelCheckpoint(
-            os.path.join(checkpoint_dir, 'model-{epoch:02d}-{val_accuracy:.2f}.keras'),
+        # Create the checkpoint callback; the files are written on a background thread
+        model_checkpoint = AsyncModelCheckpoint(
+            checkpoint_dir,
             monitor='val_accuracy',
-            save_best_only=True,
-            save_weights_only=False
+            mode='max',
+            keep_best=self.checkpoint_keep_best,
+            keep_last=self.checkpoint_keep_last,
+            weights_only=self.checkpoint_weights_only
         )
         log_dir = self.root_dir + '/logs'
         # Create the TensorBoard callback
@@ -0,0 +1,188 @@
+import os
+import json
+import math
+import re
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Dict, List, Optional
+import tensorflow as tf
+from brainMRI.logging import logger
+
+
+@dataclass
+class ClassBalancing:
+    image_counts_path: Path
+    class_names_file: Path
+    split_counts_path: Path = None
+    enabled: bool = True
+    method: str = 'sample'
+    target_distribution: Optional[Dict[str, float]] = None
+    use_class_weights: bool = False
+    shuffle_buffer_size: int = 1000
+    seed: int = 123
+
+    def read_image_counts(self) -> Dict[str, int]:
+        """
+        Reads the per-class image counts written by `AnalyzeImageData.check_image_counts`.
+
+        Returns:
+            Dict[str, int]: The number of images for each class label.
+
+        Raises:
+            ValueError: If no class counts could be found in the file.
+        """
+        pattern = re.compile(r"Number of class '(.+)' images: (\d+)")
+        image_counts = {}
+        with open(self.image_counts_path, 'r') as counts_file:
+            for line in counts_file:
+                match = pattern.match(line.strip())
+                if match:
+                    image_counts[match.group(1)] = int(match.group(2))
+
+        if not image_counts:
+            raise ValueError(f"No class counts found in {self.image_counts_path}")
+        logger.info(f"Loaded image counts: {image_counts}")
+        return image_counts
+
+    def read_train_counts(self) -> Optional[Dict[str, int]]:
+        """
+        Reads the per-class image counts of the training split written by `PrepareDatasets`.
+
+        Returns:
+            Optional[Dict[str, int]]: The number of training images of each class, or None if the datasets
+            were prepared without them.
+        """
+        if self.split_counts_path is None or not os.path.exists(self.split_counts_path):
+            return None
+        with open(self.split_counts_path, 'r') as f:
+            return json.load(f)['train']
+
+    def read_class_names(self) -> List[str]:
+        """
+        Reads the class names in label index order, as saved by `PrepareDatasets`.
+
+        Returns:
+            List[str]: The class names.
+        """
+        with open(self.class_names_file, 'r') as f:
+            return [line.strip() for line in f if line.strip()]
+
+    def get_target_distribution(self) -> List[float]:
+        """
+        Builds the target class distribution aligned with the label indices.
+        A uniform distribution is used when no target distribution is configured.
+
+        Returns:
+            List[float]: The normalised target probability of each class.
+
+        Raises:
+            ValueError: If the configured distribution does not match the class names.
+        """
+        class_names = self.read_class_names()
+        if not self.target_distribution:
+            return [1.0 / len(class_names)] * len(class_names)
+
+        target = dict(self.target_distribution)
+        missing = set(class_names) - set(target)
+        if missing:
+            raise ValueError(f"Target distribution is missing classes: {sorted(missing)}")
+
+        total = sum(float(target[name]) for name in class_names)
+        return [float(target[name]) / total for name in class_names]
+
+    def get_initial_distribution(self) -> List[float]:
+        """
+        Computes the class distribution of the raw dataset from the analyze stage counts.
+
+        Returns:
+            List[float]: The observed probability of each class, aligned with the label indices.
+        """
+        class_names = self.read_class_names()
+        image_counts = self.read_image_counts()
+        total = sum(image_counts[name] for name in class_names)
+        return [image_counts[name] / total for name in class_names]
+
+    def get_class_weights(self) -> Optional[Dict[int, float]]:
+        """
+        Computes inverse-frequency class weights from the analyze stage counts,
+        in the format expected by the `class_weight` argument of `Model.fit`.
+
+        Returns:
+            Optional[Dict[int, float]]: The weight of each label index, or None if class weights are disabled.
+        """
+        if not (self.enabled and self.use_class_weights):
+            return None
+
+        class_names = self.read_class_names()
+        image_counts = self.read_image_counts()
+        total = sum(image_counts[name] for name in class_names)
+        class_weights = {
+            index: total / (len(class_names) * image_counts[name])
+            for index, name in enumerate(class_names)
+        }
+        logger.info(f"Class weights: {class_weights}")
+        return class_weights
+
+    def balance(self, dataset: tf.data.Dataset, batch_size: int):
+        """
+        Resamples a batched (image, label) dataset towards the target class distribution.
+        The returned dataset repeats indefinitely, so the number of steps per epoch is
+        returned alongside it and keeps the epoch length of the original dataset.
+
+        Args:
+            dataset (tf.data.Dataset): The batched training dataset.
+            batch_size (int): The batch size of the balanced dataset.
+
+        Returns:
+            Tuple[tf.data.Dataset, Optional[int]]: The balanced dataset and the number of steps per epoch.
+            The dataset is returned unchanged with None steps if balancing is disabled.
+
+        Raises:
+            ValueError: If the balancing method is unknown, or a class with a target share has no training images.
+        """
+        if not self.enabled or self.method == 'none':
+            return dataset, None
+
+        AUTOTUNE = tf.data.AUTOTUNE
+        # The analyze stage counts cover the validation split too, so they are only a last resort
+        train_counts = self.read_train_counts()
+        class_counts = train_counts if train_counts is not None else self.read_image_counts()
+        steps_per_epoch = int(dataset.cardinality().numpy())
+        if steps_per_epoch < 0:
+            if train_counts is None:
+                logger.warning(f"No training split counts in {self.split_counts_path}, sizing the epoch from "
+                               f"the counts of every image")
+            steps_per_epoch = math.ceil(sum(class_counts.values()) / batch_size)
+
+        target_distribution = self.get_target_distribution()
+        # A class stream with no examples would be filtered and repeated forever without producing one
+        empty = [name for name, share in zip(self.read_class_names(), target_distribution)
+                 if share > 0 and not class_counts.get(name, 0)]
+        if empty:
+            raise ValueError(f"Classes {empty} have no training images to balance towards their target share")
+        samples = dataset.unbatch()
+
+        if self.method == 'sample':
+            # One filtered stream per class; each stream repeats so minority classes never run dry
+            class_datasets = []
+            for index in range(len(target_distribution)):
+                class_dataset = samples.filter(
+                    lambda image, label, index=index: tf.equal(tf.cast(tf.reshape(label, []), tf.int64), index))
+                class_datasets.append(class_dataset.shuffle(self.shuffle_buffer_size, seed=self.seed).repeat())
+
+            balanced = tf.data.Dataset.sample_from_datasets(
+                class_datasets, weights=target_distribution, seed=self.seed)
+        elif self.method == 'rejection':
+            initial_distribution = self.get_initial_distribution()
+            balanced = samples.shuffle(self.shuffle_buffer_size, seed=self.seed).repeat().rejection_resample(
+                lambda image, label: tf.cast(tf.reshape(label, []), tf.int32),
+                target_dist=target_distribution,
+                initial_dist=initial_distribution,
+                seed=self.seed,
+            ).map(lambda class_index, element: element, num_parallel_calls=AUTOTUNE)
+        else:
+            raise ValueError(f"Unknown class balancing method: {self.method}")
+
+        logger.info(f"Balancing training stream with method '{self.method}' towards {target_distribution}, "
+                    f"{steps_per_epoch} steps per epoch")
+        return balanced.batch(batch_size).prefetch(buffer_size=AUTOTUNE), steps_per_epoch
@@ -0,0 +1,250 @@
+import os
+import json
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from dataclasses import dataclass
+from pathlib import Path
+from typing import List, Tuple
+import numpy as np
+import tensorflow as tf
+from PIL import Image
+from brainMRI.components.quarantine import quarantined_paths
+from brainMRI.logging import logger, process_log_queue
+from brainMRI.utils.helpers import limit_worker_threads
+
+
+def _fold_dataset(images: np.ndarray, labels: np.ndarray, indices: np.ndarray, batch_size: int,
+                  shuffle: bool, seed: int) -> tf.data.Dataset:
+    """
+    Streams the images of one fold from the memory-mapped cache in batches.
+
+    Args:
+        images (np.ndarray): The memory-mapped decoded images.
+        labels (np.ndarray): The label of each image.
+        indices (np.ndarray): The indices of the images belonging to the fold.
+        batch_size (int): The batch size.
+        shuffle (bool): Whether to reshuffle the fold on every pass.
+        seed (int): The seed used for shuffling.
+
+    Returns:
+        tf.data.Dataset: The batched (image, label) dataset.
+    """
+    rng = np.random.default_rng(seed)
+
+    def generator():
+        order = rng.permutation(indices) if shuffle else indices
+        for start in range(0, len(order), batch_size):
+            # Sorted indices keep memmap reads sequential within a batch
+            batch = np.sort(order[start:start + batch_size])
+            yield images[batch].astype(np.float32), labels[batch]
+
+    height, width, channels = images.shape[1:]
+    dataset = tf.data.Dataset.from_generator(
+        generator,
+        output_signature=(
+            tf.TensorSpec(shape=(None, height, width, channels), dtype=tf.float32),
+            tf.TensorSpec(shape=(None,), dtype=tf.int32),
+        ),
+    )
+    num_batches = -(-len(indices) // batch_size)
+    return dataset.apply(tf.data.experimental.assert_cardinality(num_batches)).prefetch(tf.data.AUTOTUNE)
+
+
+def _run_fold(fold: int, train_indices: np.ndarray, val_indices: np.ndarray, cache_dir: str, fold_dir: str,
+              config_path: str, params_path: str, epochs: int, seed: int) -> dict:
+    """
+    Trains and evaluates one fold in a worker process, reusing the `BaseModel`,
+    `Callbacks` and `TransferLearning` components configured for the main pipeline.
+
+    Returns:
+        dict: The validation metrics of the fold.
+    """
+    from brainMRI.config.configuration import ConfigHandler
+
+    os.makedirs(fold_dir, exist_ok=True)
+    config = ConfigHandler(Path(config_path), Path(params_path))
+
+    images = np.load(os.path.join(cache_dir, 'images.npy'), mmap_mode='r')
+    labels = np.load(os.path.join(cache_dir, 'labels.npy'))
+    params = config.params.transfer_learning
+    train_dataset = _fold_dataset(images, labels, train_indices, params.batch_size, shuffle=True, seed=seed + fold)
+    val_dataset = _fold_dataset(images, labels, val_indices, params.batch_size, shuffle=False, seed=seed + fold)
+
+    base_model_config = config.get_base_model_config()
+    base_model_config.root_dir = fold_dir
+    base_model_config.build_model(None)
+
+    callbacks_config = config.get_callbacks_config()
+    callbacks_config.root_dir = fold_dir
+    callbacks_config.get_callbacks()
+
+    # Fold models are thrown away, so they are neither registered nor exported for serving
+    transfer_learning = config.get_transfer_learning_config(
+        root_dir=fold_dir,
+        train_dir=None,
+        val_dir=None,
+        model_registry=None,
+        export_saved_model=False,
+        onnx_export=None,
+        base_model_path=os.path.join(fold_dir, 'base_model.keras'),
+        callback_path=os.path.join(fold_dir, 'callbacks.pickle'),
+        epochs=epochs or params.epochs,
+        train_dataset=train_dataset,
+        val_dataset=val_dataset,
+    )
+    transfer_learning.train()
+
+    metrics = transfer_learning.base_model.evaluate(val_dataset, return_dict=True, verbose=0)
+    metrics = {name: float(value) for name, value in metrics.items()}
+    metrics['best_val_accuracy'] = float(max(transfer_learning.history.history['val_accuracy']))
+    metrics['epochs_trained'] = len(transfer_learning.history.history['val_loss'])
+    metrics['train_size'] = int(len(train_indices))
+    metrics['val_size'] = int(len(val_indices))
+    if transfer_learning.evaluation_report is not None:
+        metrics.update({name: transfer_learning.evaluation_report[name] for name in
+                        ('roc_auc', 'pr_auc', 'threshold', 'sensitivity', 'specificity')})
+    return metrics
+
+
+@dataclass
+class CrossValidation:
+    root_dir: Path
+    data_dir: Path
+    config_path: Path
+    params_path: Path
+    image_size: tuple[int, int]
+    n_splits: int = 5
+    max_workers: int = 2
+    threads_per_worker: int = 2
+    epochs: int = 0
+    seed: int = 123
+    quarantine_manifest_path: Path = None
+
+    def cache_images(self) -> Tuple[np.ndarray, List[str]]:
+        """
+        Decodes and resizes every image once into a memory-mapped array shared by all folds.
+        Quarantined files are left out. The cache is reused as long as the file listing and image size are unchanged.
+
+        Returns:
+            Tuple[np.ndarray, List[str]]: The label of each cached image and the class names.
+        """
+        cache_dir = os.path.join(self.root_dir, 'cache')
+        os.makedirs(cache_dir, exist_ok=True)
+
+        class_names = sorted(entry.name for entry in os.scandir(self.data_dir) if entry.is_dir())
+        excluded = quarantined_paths(self.quarantine_manifest_path, self.data_dir)
+        files = []
+        for label, class_name in enumerate(class_names):
+            class_dir = os.path.join(self.data_dir, class_name)
+            for file_name in sorted(os.listdir(class_dir)):
+                if os.path.join(class_name, file_name) in excluded:
+                    continue
+                files.append((os.path.join(class_dir, file_name), label))
+
+        height, width = self.image_size
+        manifest = {'image_size': [height, width], 'class_names': class_names, 'files': [path for path, _ in files]}
+        manifest_path = os.path.join(cache_dir, 'manifest.json')
+        labels = np.array([label for _, label in files], dtype=np.int32)
+
+        if os.path.exists(manifest_path):
+            with open(manifest_path, 'r') as f:
+                if json.load(f) == manifest:
+                    logger.info(f"Reusing decoded image cache at {cache_dir}")
+                    return labels, class_names
+
+        logger.info(f"Decoding {len(files)} images into cache at {cache_dir}")
+        images = np.lib.format.open_memmap(
+            os.path.join(cache_dir, 'images.npy'), mode='w+', dtype=np.uint8, shape=(len(files), height, width, 3))
+        for index, (path, _) in enumerate(files):
+            with Image.open(path) as image:
+                images[index] = np.asarray(image.convert('RGB').resize((width, height), Image.BILINEAR))
+        images.flush()
+        del images
+
+        np.save(os.path.join(cache_dir, 'labels.npy'), labels)
+        with open(manifest_path, 'w') as f:
+            json.dump(manifest, f)
+        return labels, class_names
+
+    def stratified_kfold(self, labels: np.ndarray) -> List[Tuple[np.ndarray, np.ndarray]]:
+        """
+        Builds stratified k-fold splits so that every fold keeps the class proportions of the dataset.
+
+        Args:
+            labels (np.ndarray): The label of each image.
+
+        Returns:
+            List[Tuple[np.ndarray, np.ndarray]]: The (train indices, validation indices) of each fold.
+
+        Raises:
+            ValueError: If a class has fewer images than the number of folds.
+        """
+        rng = np.random.default_rng(self.seed)
+        fold_parts = [[] for _ in range(self.n_splits)]
+        for label in np.unique(labels):
+            class_indices = rng.permutation(np.flatnonzero(labels == label))
+            if len(class_indices) < self.n_splits:
+                raise ValueError(f"Class {label} has {len(class_indices)} images, fewer than {self.n_splits} folds")
+            for fold, part in enumerate(np.array_split(class_indices, self.n_splits)):
+                fold_parts[fold].append(part)
+
+        all_indices = np.arange(len(labels))
+        splits = []
+        for parts in fold_parts:
+            val_indices = np.sort(np.concatenate(parts))
+            train_indices = np.setdiff1d(all_indices, val_indices, assume_unique=True)
+            splits.append((train_indices, val_indices))
+        return splits
+
+    def run(self) -> dict:
+        """
+        Runs all folds in parallel worker processes and aggregates their metrics into one report.
+
+        Returns:
+            dict: The cross-validation report, with per-fold metrics and their mean and standard deviation.
+        """
+        try:
+            labels, class_names = self.cache_images()
+            splits = self.stratified_kfold(labels)
+            np.savez(os.path.join(self.root_dir, 'splits.npz'),
+                     **{f'fold_{fold}_val': val for fold, (_, val) in enumerate(splits)})
+
+            cache_dir = os.path.join(self.root_dir, 'cache')
+            fold_metrics = {}
+            context = multiprocessing.get_context('spawn')
+            logger.info(f"Running {self.n_splits} folds with {self.max_workers} workers "
+                        f"of {self.threads_per_worker} threads each")
+            with ProcessPoolExecutor(max_workers=self.max_workers, mp_context=context,
+                                     initializer=limit_worker_threads,
+                                     initargs=(self.threads_per_worker, process_log_queue())) as executor:
+                futures = {
+                    executor.submit(_run_fold, fold, train_indices, val_indices, cache_dir,
+                                    os.path.join(self.root_dir, f'fold_{fold}'), str(self.config_path),
+                                    str(self.params_path), self.epochs, self.seed): fold
+                    for fold, (train_indices, val_indices) in enumerate(splits)
+                }
+                for future in as_completed(futures):
+                    fold = futures[future]
+                    fold_metrics[fold] = future.result()
+                    logger.info(f"Fold {fold} completed: {fold_metrics[fold]}")
+
+            report = {
+                'n_splits': self.n_splits,
+                'class_names': class_names,
+                'folds': [fold_metrics[fold] for fold in sorted(fold_metrics)],
+                'mean': {},
+                'std': {},
+            }
+            for name in report['folds'][0]:
+                values = np.array([metrics[name] for metrics in report['folds']], dtype=np.float64)
+                report['mean'][name] = float(values.mean())
+                report['std'][name] = float(values.std(ddof=1)) if len(values) > 1 else 0.0
+
+            report_path = os.path.join(self.root_dir, 'cv_report.json')
+            with open(report_path, 'w') as f:
+                json.dump(report, f, indent=2)
+            logger.info(f"Cross-validation report saved to: {report_path}")
+            return report
+        except Exception as e:
+            logger.error(f'Error running cross-validation: {e}')
+            raise e
@@ -0,0 +1,206 @@
+import os
+import json
+import time
+import queue
+import signal
+import multiprocessing
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import List, Optional
+import tensorflow as tf
+from brainMRI.logging import attach_to_parent, logger, process_log_queue
+
+SHARDING_POLICIES = ('off', 'dynamic', 'file', 'data', 'file_or_data', 'hint')
+
+# Policies that split the data by worker index, for which the dispatcher needs the fixed list of workers
+STATIC_POLICIES = ('file', 'data', 'file_or_data', 'hint')
+
+
+def _interrupt(*_):
+    raise KeyboardInterrupt
+
+
+def _run_worker(slot: int, dispatcher_address: str, worker_address: str, port: int, ready, log_queue) -> None:
+    """
+    Runs one tf.data service worker until the process is terminated, announcing itself on `ready`
+    once it has registered with the dispatcher.
+    """
+    attach_to_parent(log_queue)
+    worker = tf.data.experimental.service.WorkerServer(tf.data.experimental.service.WorkerConfig(
+        dispatcher_address=dispatcher_address, worker_address=worker_address, port=port))
+    ready.put(slot)
+    worker.join()
+
+
+@dataclass
+class DataService:
+    """
+    Moves the input pipeline off the trainer: a tf.data service dispatcher and `num_workers` worker
+    processes run the load, decode and resize graph of a dataset, and the trainer only receives the
+    finished batches, so input throughput scales with the workers instead of competing with training
+    for the same cores.
+
+    Without `dispatcher_address`, the dispatcher runs in this process on `dispatcher_port` and the
+    workers connect to it over localhost. With it, this process joins the dispatcher at that address
+    and adds its `num_workers` workers to it; workers on other hosts register with `worker_host` as
+    the name the trainer reaches them by. Workers read the prepared datasets from the same paths as
+    the trainer, so remote hosts need them on shared storage.
+
+    `sharding_policy` says how the workers split a dataset: `dynamic` hands out splits on demand so
+    each element is produced once per epoch, `off` has every worker produce the whole dataset, and
+    `file`, `data`, `file_or_data` and `hint` shard it statically by worker index, which needs every
+    worker listed in `worker_addresses`, or a `worker_port` to list the local workers from.
+    """
+    root_dir: Path
+    dispatcher_address: Optional[str] = None
+    dispatcher_port: int = 5050
+    num_workers: int = 2
+    worker_host: str = 'localhost'
+    worker_port: int = 0
+    worker_addresses: List[str] = field(default_factory=list)
+    sharding_policy: str = 'dynamic'
+    max_outstanding_requests: int = 0
+    compression: str = 'none'
+    startup_timeout: float = 120.0
+
+    def __post_init__(self):
+        if self.sharding_policy not in SHARDING_POLICIES:
+            raise ValueError(f"Unknown sharding policy: {self.sharding_policy}, expected one of {SHARDING_POLICIES}")
+        if self.sharding_policy in STATIC_POLICIES and not self.worker_addresses and not self.worker_port:
+            raise ValueError(f"{self.sharding_policy} sharding needs worker_addresses or a worker_port")
+        self._dispatcher = None
+        self._workers = []
+
+    def _worker_addresses(self) -> List[str]:
+        if self.sharding_policy not in STATIC_POLICIES:
+            return []
+        return self.worker_addresses or [f'{self.worker_host}:{self.worker_port + slot}'
+                                         for slot in range(self.num_workers)]
+
+    @property
+    def address(self) -> str:
+        """
+        The dispatcher the trainer and workers connect to, as `grpc://host:port`.
+        """
+        if self._dispatcher is not None:
+            return self._dispatcher.target
+        if not self.dispatcher_address:
+            raise RuntimeError("The data service is not running, call start() first")
+        return self.dispatcher_address if '://' in self.dispatcher_address else f'grpc://{self.dispatcher_address}'
+
+    def start(self) -> str:
+        """
+        Starts the local dispatcher, unless one is configured, and the local workers, and waits for
+        every worker to register.
+
+        Returns:
+            str: The dispatcher address.
+
+        Raises:
+            RuntimeError: If a worker exits or does not start within `startup_timeout` seconds.
+        """
+        try:
+            if self._dispatcher is None and not self.dispatcher_address:
+                self._dispatcher = tf.data.experimental.service.DispatchServer(
+                    tf.data.experimental.service.DispatcherConfig(
+                        port=self.dispatcher_port, worker_addresses=self._worker_addresses() or None))
+            address = self.address
+            dispatcher_address = address.split('://', 1)[1]
+
+            # Spawned workers start a clean TensorFlow runtime instead of a fork of the trainer's
+            context = multiprocessing.get_context('spawn')
+            ready = context.Queue()
+            for slot in range(len(self._workers), self.num_workers):
+                port = self.worker_port + slot if self.worker_port else 0
+                process = context.Process(
+                    target=_run_worker, name=f'data_service_worker_{slot}',
+                    args=(slot, dispatcher_address, f'{self.worker_host}:%port%', port, ready, process_log_queue()),
+                    daemon=True)
+                process.start()
+                self._workers.append(process)
+
+            started = set()
+            deadline = time.monotonic() + self.startup_timeout
+            while len(started) < len(self._workers):
+                try:
+                    started.add(ready.get(timeout=1.0))
+                except queue.Empty:
+                    pass
+                exited = [process.name for process in self._workers if not process.is_alive()]
+                if exited:
+                    raise RuntimeError(f"Data service workers exited on start-up: {exited}")
+                if time.monotonic() > deadline:
+                    raise RuntimeError(f"Data service workers did not start within {self.startup_timeout}s")
+            report = {
+                'address': address,
+                'local_dispatcher': self._dispatcher is not None,
+                'local_workers': len(self._workers),
+                'worker_host': self.worker_host,
+                'sharding_policy': self.sharding_policy,
+                'worker_addresses': self._worker_addresses(),
+            }
+            os.makedirs(self.root_dir, exist_ok=True)
+            with open(os.path.join(self.root_dir, 'data_service.json'), 'w') as f:
+                json.dump(report, f, indent=2)
+            logger.info(f"Data service at {address} with {len(self._workers)} local workers, "
+                        f"{self.sharding_policy} sharding")
+            return address
+        except Exception as e:
+            logger.error(f'Error starting the data service: {e}')
+            self.stop()
+            raise e
+
+    def stop(self) -> None:
+        """
+        Stops the local workers and the local dispatcher.
+        """
+        for process in self._workers:
+            if process.is_alive():
+                process.terminate()
+        for process in self._workers:
+            process.join(10.0)
+            if process.is_alive():
+                process.kill()
+                process.join()
+        self._workers = []
+        if self._dispatcher is not None:
+            self._dispatcher._stop()
+            self._dispatcher = None
+
+    def distribute(self, dataset: tf.data.Dataset) -> tf.data.Dataset:
+        """
+        Hands a dataset to the data service: its graph runs on the workers and the returned dataset
+        streams the elements they produce. Each iteration, such as each Keras epoch, is a new job.
+
+        Args:
+            dataset (tf.data.Dataset): A dataset built from files, without Python functions, which the
+                workers cannot run.
+
+        Returns:
+            tf.data.Dataset: The dataset read from the service.
+        """
+        policy = getattr(tf.data.experimental.service.ShardingPolicy, self.sharding_policy.upper())
+        return dataset.apply(tf.data.experimental.service.distribute(
+            processing_mode=policy,
+            service=self.address,
+            max_outstanding_requests=self.max_outstanding_requests or None,
+            compression='AUTO' if self.compression == 'auto' else None,
+        )).prefetch(tf.data.AUTOTUNE)
+
+    def serve(self) -> None:
+        """
+        Runs the dispatcher and workers of this host until the process is interrupted or terminated,
+        for a host that only serves input to trainers elsewhere.
+        """
+        previous_handler = signal.signal(signal.SIGTERM, _interrupt)
+        try:
+            self.start()
+            while all(process.is_alive() for process in self._workers):
+                time.sleep(1.0)
+            raise RuntimeError(f"Data service workers exited: "
+                               f"{[process.name for process in self._workers if not process.is_alive()]}")
+        except KeyboardInterrupt:
+            logger.info("Stopping the data service")
+        finally:
+            self.stop()
+            signal.signal(signal.SIGTERM, previous_handler)
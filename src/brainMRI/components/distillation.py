@@ -0,0 +1,300 @@
+import os
+import json
+import shutil
+import hashlib
+import dataclasses
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import List
+import numpy as np
+import tensorflow as tf
+from brainMRI.components.benchmark import PredictionBenchmark
+from brainMRI.components.evaluation import Evaluation
+from brainMRI.components.onnx_export import OnnxExport
+from brainMRI.components.prepare_datasets import load_dataset
+from brainMRI.components.runtime_config import RuntimeConfig
+from brainMRI.logging import logger
+
+STUDENTS = ('small_cnn', 'mobilenet_v3_small')
+
+# Probabilities are clipped like Keras clips them in binary cross-entropy before taking logits
+_EPSILON = 1e-7
+
+
+def _logits(probabilities: tf.Tensor) -> tf.Tensor:
+    probabilities = tf.clip_by_value(probabilities, _EPSILON, 1 - _EPSILON)
+    return tf.math.log(probabilities) - tf.math.log1p(-probabilities)
+
+
+@tf.keras.utils.register_keras_serializable(package='brainMRI')
+class DistillationLoss(tf.keras.losses.Loss):
+    """
+    Mixes the cross-entropy with the teacher's soft labels at `temperature` and the cross-entropy with
+    the true labels: `soft_weight * T^2 * soft + (1 - soft_weight) * hard`. The T^2 factor keeps the
+    gradient of the soft term on the same scale whatever the temperature.
+
+    The targets hold the true label and the teacher logit side by side, shaped (batch, 2), and the
+    predictions are the student's probabilities.
+    """
+
+    def __init__(self, temperature: float = 4.0, soft_weight: float = 0.7, **kwargs):
+        super().__init__(**kwargs)
+        self.temperature = temperature
+        self.soft_weight = soft_weight
+
+    def call(self, y_true, y_pred):
+        labels, teacher_logits = y_true[:, 0:1], y_true[:, 1:2]
+        student_logits = _logits(tf.cast(y_pred, tf.float32))
+        hard = tf.nn.sigmoid_cross_entropy_with_logits(labels, student_logits)
+        soft_targets = tf.sigmoid(teacher_logits / self.temperature)
+        soft = tf.nn.sigmoid_cross_entropy_with_logits(soft_targets, student_logits / self.temperature)
+        loss = self.soft_weight * self.temperature ** 2 * soft + (1 - self.soft_weight) * hard
+        return tf.reduce_mean(loss, axis=-1)
+
+    def get_config(self):
+        config = super().get_config()
+        config.update({'temperature': self.temperature, 'soft_weight': self.soft_weight})
+        return config
+
+
+def _label_accuracy(y_true, y_pred):
+    return tf.cast(tf.equal(y_true[:, 0:1], tf.cast(y_pred >= 0.5, y_true.dtype)), tf.float32)
+
+
+@dataclass
+class Distillation:
+    """
+    Distils the trained VGG16 model (the teacher) into a compact student CNN for CPU and edge serving.
+
+    The teacher labels the prepared train and validation datasets once, and the images are saved with
+    the label and the teacher logit. This soft-label cache is reused for as long as the teacher and the
+    datasets are unchanged. The student is then trained on the soft labels with `DistillationLoss`. It
+    takes the same input size and outputs the same sigmoid probability as the teacher, so it can replace
+    the teacher in prediction, evaluation, Grad-CAM and ONNX export.
+    """
+    root_dir: Path
+    teacher_path: Path
+    train_dir: Path
+    val_dir: Path
+    image_size: tuple[int, int]
+    student: str = 'small_cnn'
+    width: int = 32
+    alpha: float = 1.0
+    pretrained: bool = True
+    temperature: float = 4.0
+    soft_weight: float = 0.7
+    epochs: int = 30
+    batch_size: int = 32
+    shuffle_buffer_size: int = 1000
+    learning_rate: float = 1e-3
+    patience: int = 5
+    latency_batch_sizes: List[int] = field(default_factory=lambda: [1, 32])
+    latency_repeats: int = 20
+    evaluation: Evaluation = None
+    onnx_export: OnnxExport = None
+    runtime_config: RuntimeConfig = None
+
+    def __post_init__(self):
+        if self.student not in STUDENTS:
+            raise ValueError(f"Unknown student: {self.student}, expected one of {STUDENTS}")
+
+    def build_student(self) -> tf.keras.Model:
+        """
+        Builds the student: either four conv blocks of `width`, 2x`width`, 4x`width` and 8x`width`
+        filters, or MobileNetV3-Small with width multiplier `alpha`. Both are followed by the head the
+        teacher uses: global average pooling and a single sigmoid unit.
+
+        Returns:
+            tf.keras.Model: The student, taking images in [0, 255] like the teacher.
+        """
+        inputs = tf.keras.Input(shape=(*self.image_size, 3))
+        if self.student == 'mobilenet_v3_small':
+            backbone = tf.keras.applications.MobileNetV3Small(
+                input_shape=(*self.image_size, 3), alpha=self.alpha, include_top=False,
+                weights='imagenet' if self.pretrained else None, include_preprocessing=True)
+            x = backbone(inputs)
+        else:
+            x = tf.keras.layers.Rescaling(1 / 255)(inputs)
+            for block in range(4):
+                filters = self.width * 2 ** block
+                for _ in range(2):
+                    x = tf.keras.layers.Conv2D(filters, 3, padding='same', use_bias=False)(x)
+                    x = tf.keras.layers.BatchNormalization()(x)
+                    x = tf.keras.layers.ReLU()(x)
+                if block < 3:
+                    x = tf.keras.layers.MaxPooling2D()(x)
+        x = tf.keras.layers.GlobalAveragePooling2D()(x)
+        outputs = tf.keras.layers.Dense(1, activation='sigmoid')(x)
+        return tf.keras.Model(inputs, outputs, name=f'student_{self.student}')
+
+    def _fingerprint(self) -> str:
+        """
+        Identifies the teacher and the prepared datasets the soft labels were computed from.
+        """
+        parts = []
+        for path in (self.teacher_path, self.train_dir, self.val_dir):
+            files = [str(path)] if os.path.isfile(path) else [
+                os.path.join(root, name) for root, _, names in os.walk(path) for name in names]
+            for file_path in sorted(files):
+                stat = os.stat(file_path)
+                parts.append(f'{file_path}:{stat.st_size}:{stat.st_mtime_ns}')
+        return hashlib.sha256('\n'.join(sorted(parts)).encode()).hexdigest()[:16]
+
+    def soft_labels(self, teacher: tf.keras.Model) -> dict:
+        """
+        Returns the train and validation datasets with soft labels, computing them with the teacher the
+        first time. Each split is saved under a temporary name and renamed when complete, so an
+        interrupted run never leaves a partial cache behind.
+
+        Returns:
+            dict: Batches of (images, [label, teacher logit]) for 'train', shuffled, and 'val'.
+        """
+        cache_dir = os.path.join(self.root_dir, 'soft_labels')
+        key_dir = os.path.join(cache_dir, self._fingerprint())
+        # Caches of an older teacher or older datasets are never read again
+        if os.path.isdir(cache_dir):
+            for name in os.listdir(cache_dir):
+                if os.path.join(cache_dir, name) != key_dir:
+                    shutil.rmtree(os.path.join(cache_dir, name), ignore_errors=True)
+
+        datasets = {}
+        for split, dataset_dir in (('train', self.train_dir), ('val', self.val_dir)):
+            split_dir = os.path.join(key_dir, split)
+            if not os.path.isdir(split_dir):
+                logger.info(f"Computing the teacher's soft labels for the {split} dataset")
+                dataset = load_dataset(dataset_dir, batch_size=self.batch_size)
+                if self.runtime_config is not None:
+                    dataset = dataset.with_options(self.runtime_config.dataset_options())
+                dataset = dataset.map(lambda images, labels: (images, tf.concat(
+                    [tf.cast(tf.reshape(labels, (-1, 1)), tf.float32), _logits(teacher(images, training=False))],
+                    axis=1)))
+                tmp_dir = split_dir + '.tmp'
+                shutil.rmtree(tmp_dir, ignore_errors=True)
+                dataset.save(tmp_dir)
+                os.rename(tmp_dir, split_dir)
+            else:
+                logger.info(f"Reusing the teacher's soft labels for the {split} dataset from {split_dir}")
+            dataset = tf.data.Dataset.load(split_dir)
+            if split == 'train':
+                # The cache keeps the order the images were labelled in, so they are reshuffled every epoch
+                dataset = dataset.unbatch().shuffle(self.shuffle_buffer_size).batch(self.batch_size)
+            datasets[split] = dataset.prefetch(tf.data.AUTOTUNE)
+        return datasets
+
+    def train(self, teacher: tf.keras.Model, datasets: dict) -> tf.keras.Model:
+        """
+        Trains the student on the soft labels, stopping early on the validation loss and keeping the
+        best weights.
+
+        Returns:
+            tf.keras.Model: The trained student.
+        """
+        student = self.build_student()
+        logger.info(f"Student {student.name}: {student.count_params():,} parameters, "
+                    f"teacher: {teacher.count_params():,}")
+        student.compile(
+            loss=DistillationLoss(self.temperature, self.soft_weight),
+            optimizer=tf.keras.optimizers.Adam(learning_rate=self.learning_rate),
+            metrics=[tf.keras.metrics.MeanMetricWrapper(_label_accuracy, name='accuracy')])
+        student.fit(
+            datasets['train'],
+            epochs=self.epochs,
+            validation_data=datasets['val'],
+            callbacks=[tf.keras.callbacks.EarlyStopping(monitor='val_loss', patience=self.patience,
+                                                        restore_best_weights=True)])
+        # The saved student is compiled like the teacher, so loading it needs nothing from this module
+        student.compile(loss=tf.keras.losses.BinaryCrossentropy(),
+                        metrics=[tf.keras.metrics.BinaryAccuracy(threshold=0.5, name='accuracy')])
+        return student
+
+    def compare(self, teacher: tf.keras.Model, student: tf.keras.Model, val_dataset: tf.data.Dataset) -> dict:
+        """
+        Compares the student with the teacher: validation metrics, agreement of their predicted classes,
+        parameter count, and latency at each of `latency_batch_sizes` on synthetic images.
+
+        Returns:
+            dict: The teacher and student figures, and the student's accuracy parity and speed-up.
+        """
+        labelled = val_dataset.map(lambda images, targets: (images, targets[:, 0]))
+        reports = {}
+        # The student's report goes next to it, where the predictor looks for the operating threshold
+        for name, model, report_name in (('teacher', teacher, 'teacher_evaluation.json'),
+                                         ('student', student, 'evaluation.json')):
+            report_path = os.path.join(self.root_dir, report_name)
+            reports[name] = self.evaluation.evaluate(model, labelled, report_path) if self.evaluation else {}
+
+        agreements, count = 0, 0
+        for images, targets in val_dataset:
+            student_classes = student.predict_on_batch(images)[:, 0] >= 0.5
+            agreements += int(np.sum(student_classes == (targets[:, 1].numpy() >= 0)))
+            count += len(student_classes)
+
+        rng = np.random.default_rng(123)
+        benchmark = PredictionBenchmark(self.root_dir, batch_sizes=self.latency_batch_sizes,
+                                        repeats=self.latency_repeats)
+        comparison = {'temperature': self.temperature, 'soft_weight': self.soft_weight}
+        for name, model in (('teacher', teacher), ('student', student)):
+            figures = {'parameters': int(model.count_params()), 'latency': {}}
+            figures.update({metric: reports[name][metric] for metric in
+                            ('accuracy', 'roc_auc', 'pr_auc', 'threshold') if metric in reports[name]})
+            for batch_size in self.latency_batch_sizes:
+                images = rng.integers(0, 256, size=(batch_size, *self.image_size, 3)).astype(np.float32)
+                figures['latency'][str(batch_size)] = benchmark.measure(model.predict_on_batch, images)
+            comparison[name] = figures
+
+        comparison['agreement'] = agreements / count if count else None
+        if 'accuracy' in reports['teacher'] and 'accuracy' in reports['student']:
+            comparison['accuracy_parity'] = reports['student']['accuracy'] / max(reports['teacher']['accuracy'],
+                                                                                 _EPSILON)
+        comparison['parameter_ratio'] = comparison['student']['parameters'] / comparison['teacher']['parameters']
+        teacher_latency, student_latency = comparison['teacher']['latency'], comparison['student']['latency']
+        comparison['speedup'] = {
+            batch_size: teacher_latency[batch_size]['p50_ms'] / student_latency[batch_size]['p50_ms']
+            for batch_size in student_latency
+        }
+        return comparison
+
+    def run(self) -> dict:
+        """
+        Distils the teacher into the student, saves the student to `student.keras` (with its evaluation
+        report next to it, so the predictor picks up its threshold), optionally exports it to ONNX, and
+        saves the comparison with the teacher to `distillation.json`.
+
+        Returns:
+            dict: The comparison with the teacher.
+        """
+        try:
+            os.makedirs(self.root_dir, exist_ok=True)
+            teacher = tf.keras.models.load_model(self.teacher_path, safe_mode=False, compile=False)
+            datasets = self.soft_labels(teacher)
+            student = self.train(teacher, datasets)
+
+            student_path = os.path.join(self.root_dir, 'student.keras')
+            tmp_path = os.path.join(self.root_dir, 'student.tmp.keras')
+            student.save(tmp_path)
+            os.replace(tmp_path, student_path)
+            logger.info(f"Student saved to: {student_path}")
+
+            comparison = self.compare(teacher, student, datasets['val'])
+            comparison['student_path'] = student_path
+            if self.onnx_export is not None:
+                # The student is exported directly: `OnnxExport.run` would export the promoted registry
+                # version, the teacher. The model and parity report go next to the student, where the
+                # predictor looks for `model.onnx`
+                onnx_export = dataclasses.replace(self.onnx_export, root_dir=self.root_dir, model_registry=None)
+                onnx_path = os.path.join(self.root_dir, 'model.onnx')
+                onnx_export.export(student, onnx_path)
+                onnx_export.check_parity(student, onnx_path)
+                comparison['onnx_path'] = onnx_path
+
+            report_path = os.path.join(self.root_dir, 'distillation.json')
+            with open(report_path, 'w') as f:
+                json.dump(comparison, f, indent=2)
+            logger.info(f"Student accuracy parity {comparison.get('accuracy_parity', float('nan')):.3f}, "
+                        f"agreement {comparison['agreement']:.3f}, "
+                        f"{comparison['parameter_ratio']:.1%} of the teacher's parameters, "
+                        f"speed-up {comparison['speedup']}; report saved to: {report_path}")
+            return comparison
+        except Exception as e:
+            logger.error(f'Error distilling the model: {e}')
+            raise e
@@ -0,0 +1,244 @@
+import os
+import json
+import time
+from dataclasses import dataclass
+from pathlib import Path
+import numpy as np
+import tensorflow as tf
+from brainMRI.components.model_registry import ModelRegistry
+from brainMRI.components.prepare_datasets import load_dataset
+from brainMRI.logging import logger
+
+THRESHOLD_STRATEGIES = ('youden', 'f1', 'min_sensitivity', 'fixed')
+
+# The report metrics stored with a registered version
+REGISTRY_METRICS = ('roc_auc', 'pr_auc', 'sensitivity', 'specificity', 'brier')
+
+
+class BinaryMetricsAccumulator:
+    """
+    Accumulates binary classification statistics batch by batch, so a dataset is evaluated in a single
+    pass without keeping its predictions. Probabilities are counted into `num_thresholds` - 1 equal-width
+    bins per class; the counts above each grid threshold give the confusion matrix at every threshold.
+    """
+
+    def __init__(self, num_thresholds: int = 201, calibration_bins: int = 10):
+        self.thresholds = np.linspace(0.0, 1.0, num_thresholds)
+        self.calibration_bins = calibration_bins
+        self.positives = np.zeros(num_thresholds, dtype=np.int64)
+        self.negatives = np.zeros(num_thresholds, dtype=np.int64)
+        self.bin_counts = np.zeros(calibration_bins, dtype=np.int64)
+        self.bin_probabilities = np.zeros(calibration_bins)
+        self.bin_positives = np.zeros(calibration_bins)
+        self.log_loss = 0.0
+        self.brier = 0.0
+        self.count = 0
+
+    def update(self, labels: np.ndarray, probabilities: np.ndarray) -> None:
+        labels = np.asarray(labels).reshape(-1).astype(bool)
+        probabilities = np.clip(np.asarray(probabilities, dtype=np.float64).reshape(-1), 0.0, 1.0)
+
+        # probability >= thresholds[k] exactly when its bin index is >= k
+        grid = len(self.thresholds) - 1
+        bins = np.floor(probabilities * grid + 1e-9).astype(np.int64)
+        self.positives += np.bincount(bins[labels], minlength=grid + 1)
+        self.negatives += np.bincount(bins[~labels], minlength=grid + 1)
+
+        calibration = np.minimum((probabilities * self.calibration_bins).astype(np.int64), self.calibration_bins - 1)
+        self.bin_counts += np.bincount(calibration, minlength=self.calibration_bins)
+        self.bin_probabilities += np.bincount(calibration, weights=probabilities, minlength=self.calibration_bins)
+        self.bin_positives += np.bincount(calibration, weights=labels, minlength=self.calibration_bins)
+
+        eps = 1e-7
+        clipped = np.clip(probabilities, eps, 1 - eps)
+        self.log_loss -= float(np.sum(np.where(labels, np.log(clipped), np.log(1 - clipped))))
+        self.brier += float(np.sum((probabilities - labels) ** 2))
+        self.count += len(labels)
+
+    def curves(self) -> dict:
+        """
+        Returns:
+            dict: The true and false positive counts, sensitivity, specificity, precision and F1 at every
+                grid threshold.
+        """
+        tp = np.cumsum(self.positives[::-1])[::-1]
+        fp = np.cumsum(self.negatives[::-1])[::-1]
+        total_positives, total_negatives = self.positives.sum(), self.negatives.sum()
+        sensitivity = tp / max(total_positives, 1)
+        specificity = 1 - fp / max(total_negatives, 1)
+        precision = np.divide(tp, tp + fp, out=np.ones(len(tp)), where=(tp + fp) > 0)
+        f1 = np.divide(2 * precision * sensitivity, precision + sensitivity,
+                       out=np.zeros(len(tp)), where=(precision + sensitivity) > 0)
+        return {'tp': tp, 'fp': fp, 'fn': total_positives - tp, 'tn': total_negatives - fp,
+                'sensitivity': sensitivity, 'specificity': specificity, 'precision': precision, 'f1': f1}
+
+    def roc_auc(self, curves: dict) -> float:
+        # Thresholds run from low to high, so the ROC points are reversed to make the FPR ascending
+        fpr = np.concatenate([[0.0], (1 - curves['specificity'])[::-1]])
+        tpr = np.concatenate([[0.0], curves['sensitivity'][::-1]])
+        return float(np.sum(np.diff(fpr) * (tpr[1:] + tpr[:-1]) / 2))
+
+    def pr_auc(self, curves: dict) -> float:
+        # Average precision: the precision at each threshold weighted by the recall gained there
+        recall = np.concatenate([curves['sensitivity'], [0.0]])
+        return float(np.sum((recall[:-1] - recall[1:]) * curves['precision']))
+
+    def calibration(self) -> dict:
+        """
+        Returns:
+            dict: The reliability table and the expected calibration error.
+        """
+        counts = np.maximum(self.bin_counts, 1)
+        mean_probability = self.bin_probabilities / counts
+        positive_rate = self.bin_positives / counts
+        weights = self.bin_counts / max(self.count, 1)
+        edges = np.linspace(0.0, 1.0, self.calibration_bins + 1)
+        bins = [{'lower': float(edges[i]), 'upper': float(edges[i + 1]), 'count': int(self.bin_counts[i]),
+                 'mean_probability': float(mean_probability[i]), 'positive_rate': float(positive_rate[i])}
+                for i in range(self.calibration_bins)]
+        return {'bins': bins, 'ece': float(np.sum(weights * np.abs(mean_probability - positive_rate)))}
+
+
+@dataclass
+class Evaluation:
+    root_dir: Path
+    dataset_dir: Path
+    batch_size: int = 256
+    num_thresholds: int = 201
+    calibration_bins: int = 10
+    threshold_strategy: str = 'youden'
+    min_sensitivity: float = 0.95
+    default_threshold: float = 0.5
+    model_registry: ModelRegistry = None
+
+    def __post_init__(self):
+        if self.threshold_strategy not in THRESHOLD_STRATEGIES:
+            raise ValueError(f"Unknown threshold strategy: {self.threshold_strategy}, "
+                             f"expected one of {THRESHOLD_STRATEGIES}")
+
+    def choose_threshold(self, thresholds: np.ndarray, curves: dict) -> int:
+        """
+        Picks the operating threshold on the grid.
+
+        - youden: maximises sensitivity + specificity - 1.
+        - f1: maximises F1.
+        - min_sensitivity: maximises specificity among the thresholds with sensitivity >= `min_sensitivity`.
+        - fixed: the grid threshold closest to `default_threshold`.
+
+        Returns:
+            int: The index of the chosen threshold.
+        """
+        if self.threshold_strategy == 'youden':
+            return int(np.argmax(curves['sensitivity'] + curves['specificity'] - 1))
+        if self.threshold_strategy == 'f1':
+            return int(np.argmax(curves['f1']))
+        if self.threshold_strategy == 'min_sensitivity':
+            eligible = np.flatnonzero(curves['sensitivity'] >= self.min_sensitivity)
+            if len(eligible) == 0:
+                logger.warning(f"No threshold reaches a sensitivity of {self.min_sensitivity}, using the lowest")
+                return 0
+            return int(eligible[np.argmax(curves['specificity'][eligible])])
+        return int(np.argmin(np.abs(thresholds - self.default_threshold)))
+
+    def evaluate(self, model, dataset: tf.data.Dataset = None, report_path: Path = None) -> dict:
+        """
+        Streams the dataset through the model once and writes the evaluation report: the confusion matrix,
+        sensitivity, specificity and precision at the chosen threshold, ROC-AUC, PR-AUC, log loss, Brier
+        score, calibration bins and the per-threshold table. Only one batch of images is held at a time.
+
+        Args:
+            model (tf.keras.Model): The model to evaluate.
+            dataset (tf.data.Dataset, optional): Batches of (images, labels). Defaults to `dataset_dir`
+                re-batched to `batch_size`.
+            report_path (Path, optional): Where to write the report. Defaults to `evaluation.json` in `root_dir`.
+
+        Returns:
+            dict: The report.
+        """
+        try:
+            if dataset is None:
+                dataset = load_dataset(self.dataset_dir, batch_size=self.batch_size)
+            else:
+                dataset = dataset.unbatch().batch(self.batch_size)
+
+            start = time.perf_counter()
+            accumulator = BinaryMetricsAccumulator(self.num_thresholds, self.calibration_bins)
+            for images, labels in dataset.prefetch(tf.data.AUTOTUNE):
+                probabilities = model.predict_on_batch(images)
+                accumulator.update(labels.numpy(), probabilities)
+            if accumulator.count == 0:
+                raise ValueError(f"The evaluation dataset is empty: {self.dataset_dir}")
+
+            thresholds = accumulator.thresholds
+            curves = accumulator.curves()
+            index = self.choose_threshold(thresholds, curves)
+            report = {
+                'samples': accumulator.count,
+                'positives': int(accumulator.positives.sum()),
+                'seconds': time.perf_counter() - start,
+                'threshold_strategy': self.threshold_strategy,
+                'threshold': float(thresholds[index]),
+                'confusion_matrix': {name: int(curves[name][index]) for name in ('tp', 'fp', 'tn', 'fn')},
+                'accuracy': float((curves['tp'][index] + curves['tn'][index]) / accumulator.count),
+                'sensitivity': float(curves['sensitivity'][index]),
+                'specificity': float(curves['specificity'][index]),
+                'precision': float(curves['precision'][index]),
+                'f1': float(curves['f1'][index]),
+                'roc_auc': accumulator.roc_auc(curves),
+                'pr_auc': accumulator.pr_auc(curves),
+                'log_loss': accumulator.log_loss / accumulator.count,
+                'brier': accumulator.brier / accumulator.count,
+                'calibration': accumulator.calibration(),
+                'thresholds': [
+                    {'threshold': float(threshold), 'sensitivity': float(sensitivity),
+                     'specificity': float(specificity), 'precision': float(precision)}
+                    for threshold, sensitivity, specificity, precision in
+                    zip(thresholds, curves['sensitivity'], curves['specificity'], curves['precision'])
+                ],
+            }
+
+            report_path = report_path or os.path.join(self.root_dir, 'evaluation.json')
+            os.makedirs(os.path.dirname(report_path) or '.', exist_ok=True)
+            with open(report_path, 'w') as f:
+                json.dump(report, f, indent=2)
+            logger.info(f"Evaluated {accumulator.count} images in {report['seconds']:.1f}s: "
+                        f"ROC-AUC {report['roc_auc']:.4f}, PR-AUC {report['pr_auc']:.4f}, "
+                        f"threshold {report['threshold']:.3f} ({self.threshold_strategy}) with sensitivity "
+                        f"{report['sensitivity']:.3f} and specificity {report['specificity']:.3f}")
+            logger.info(f"Evaluation report saved to: {report_path}")
+            return report
+        except Exception as e:
+            logger.error(f'Error evaluating model: {e}')
+            raise e
+
+    def run(self, model_path: Path) -> dict:
+        """
+        Evaluates a saved `.keras` model and writes the report to `root_dir` and to `evaluation.json` next
+        to the model, where the predictor picks up the operating threshold. With a model registry, the
+        promoted version is evaluated instead, and its threshold and metrics are stored in the version's
+        metadata, which the predictor reads first.
+
+        Args:
+            model_path (Path): The trained model, used when no registry version is promoted.
+
+        Returns:
+            dict: The report.
+        """
+        version = None
+        if self.model_registry is not None:
+            model_path, version = self.model_registry.resolve(model_path)
+        model = tf.keras.models.load_model(model_path, safe_mode=False, compile=False)
+        report = self.evaluate(model)
+        if version is not None:
+            val_metrics = dict(self.model_registry.metadata(version).get('val_metrics', {}),
+                               **{name: report[name] for name in REGISTRY_METRICS})
+            self.model_registry.update_metadata(version, {'threshold': report['threshold'], 'val_metrics': val_metrics})
+
+        # Written last: the predictor reloads the model when the report next to it changes
+        report_path = os.path.join(os.path.dirname(model_path), 'evaluation.json')
+        tmp_path = f'{report_path}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(report, f, indent=2)
+        os.replace(tmp_path, report_path)
+        logger.info(f"Evaluation report saved to: {report_path}")
+        return report
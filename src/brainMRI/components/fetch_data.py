@@ -36,13 +36,17 @@ class FetchData:
             logger.info(f"Saving file to: {file_path}")
             logger.info(f"Total file size: {total_size / (1024 * 1024):.2f} MB")
 
+            logged_step = -1
             with open(file_path, 'wb') as file:
                 for chunk in response.iter_content(chunk_size=block_size):
                     if chunk:
                         file.write(chunk)
                         downloaded += len(chunk)
-                        progress = round((downloaded / total_size) * 100, 2)
-                        logger.info(f'Downloaded {progress}% of the file')
+                        # Report progress in 5% steps rather than per chunk
+                        progress = round((downloaded / total_size) * 100, 2) if total_size else 0
+                        if int(progress // 5) > logged_step:
+                            logged_step = int(progress // 5)
+                            logger.info(f'Downloaded {progress}% of the file')
 
             logger.info('Download complete!')
             logger.info(f"File saved to: {file_path}")
@@ -0,0 +1,336 @@
+import os
+import json
+import math
+import time
+import sqlite3
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Dict, List, Tuple
+import numpy as np
+import tensorflow as tf
+import yaml
+from brainMRI.logging import logger, process_log_queue
+from brainMRI.components.prepare_datasets import load_dataset
+from brainMRI.utils.helpers import limit_worker_threads
+
+
+def _connect(db_path: str) -> sqlite3.Connection:
+    """
+    Opens the trial results store. WAL mode lets concurrent trial workers write without blocking readers.
+    """
+    connection = sqlite3.connect(db_path, timeout=60)
+    connection.execute('PRAGMA journal_mode=WAL')
+    connection.execute(
+        'CREATE TABLE IF NOT EXISTS trials ('
+        'trial_id INTEGER PRIMARY KEY, bracket INTEGER, params TEXT, status TEXT, epochs INTEGER, '
+        'val_loss REAL, val_accuracy REAL, started REAL, finished REAL)')
+    connection.execute(
+        'CREATE TABLE IF NOT EXISTS epochs ('
+        'trial_id INTEGER, epoch INTEGER, val_loss REAL, val_accuracy REAL, PRIMARY KEY (trial_id, epoch))')
+    return connection
+
+
+def _apply_overrides(params, overrides: Dict[str, object]) -> None:
+    """
+    Applies dotted `params.yaml` keys (e.g. `transfer_learning.learning_rate`) to a loaded params box.
+    """
+    for key, value in overrides.items():
+        *sections, name = key.split('.')
+        node = params
+        for section in sections:
+            node = node[section]
+        if name not in node:
+            raise KeyError(f"Unknown params key in search space: {key}")
+        node[name] = value
+
+
+class _MedianPruner(tf.keras.callbacks.Callback):
+    """
+    Records the per-epoch validation loss of a trial and stops it when it is worse than
+    the median of the other trials of its rung at the same epoch. Stopping the trial also stops
+    the training stages and phases of `transfer_learning` that have not started yet.
+    """
+
+    def __init__(self, db_path: str, trial_id: int, peers: List[int], warmup_epochs: int, enabled: bool,
+                 transfer_learning=None):
+        super().__init__()
+        self.db_path = db_path
+        self.trial_id = trial_id
+        self.peers = [peer for peer in peers if peer != trial_id]
+        self.warmup_epochs = warmup_epochs
+        self.enabled = enabled
+        self.transfer_learning = transfer_learning
+        self.pruned = False
+
+    def on_epoch_end(self, epoch, logs=None):
+        logs = logs or {}
+        val_loss = float(logs.get('val_loss', math.inf))
+        with _connect(self.db_path) as connection:
+            connection.execute('INSERT OR REPLACE INTO epochs VALUES (?, ?, ?, ?)',
+                               (self.trial_id, epoch, val_loss, float(logs.get('val_accuracy', 0.0))))
+            # Only the trials of the same rung are compared, not those of other brackets or earlier searches
+            others = [row[0] for row in connection.execute(
+                f"SELECT val_loss FROM epochs WHERE epoch = ? AND trial_id IN ({', '.join('?' * len(self.peers))})",
+                (epoch, *self.peers))] if self.peers else []
+
+        if self.enabled and epoch >= self.warmup_epochs and others and val_loss > float(np.median(others)):
+            logger.info(f"Pruning trial {self.trial_id} at epoch {epoch}: val_loss {val_loss:.4f} "
+                        f"above median {float(np.median(others)):.4f}")
+            self.pruned = True
+            self.model.stop_training = True
+            if self.transfer_learning is not None:
+                self.transfer_learning.stop_training = True
+
+
+def _run_trial(trial_id: int, overrides: Dict[str, object], epochs: int, initial_epoch: int, max_epochs: int,
+               trial_dir: str, config_path: str, params_path: str, db_path: str, peers: List[int],
+               median_pruning: bool, warmup_epochs: int) -> dict:
+    """
+    Trains one trial up to `epochs` in a worker process. Trials promoted to a larger budget
+    resume from the model saved at the end of their previous rung, in the phase it stopped in.
+
+    Returns:
+        dict: The best validation loss and accuracy reached, and whether the trial was pruned.
+    """
+    from brainMRI.config.configuration import ConfigHandler
+
+    os.makedirs(trial_dir, exist_ok=True)
+    config = ConfigHandler(Path(config_path), Path(params_path))
+    _apply_overrides(config.params, overrides)
+    params = config.params.transfer_learning
+
+    # The prepared datasets are shared read-only by every trial; only the batching differs
+    train_dataset = load_dataset(config.config.transfer_learning.train_dir)
+    val_dataset = load_dataset(config.config.transfer_learning.val_dir)
+    if params.batch_size != config.params.prepare_datasets.batch_size:
+        train_dataset = train_dataset.unbatch().batch(params.batch_size)
+        val_dataset = val_dataset.unbatch().batch(params.batch_size)
+
+    if initial_epoch == 0:
+        base_model_config = config.get_base_model_config()
+        base_model_config.root_dir = trial_dir
+        base_model_config.build_model(None)
+        model_path = os.path.join(trial_dir, 'base_model.keras')
+    else:
+        model_path = os.path.join(trial_dir, 'model.keras')
+
+    callbacks_config = config.get_callbacks_config()
+    callbacks_config.root_dir = trial_dir
+    callbacks_config.get_callbacks()
+
+    # The largest budget is split between the head and fine-tuning phases in the configured proportion, the
+    # same for every rung, so that a rung ending inside the head phase is resumed in it and not fine-tuned
+    head_epochs = min(epochs, round(max_epochs * params.epochs / (params.epochs + params.fine_tune_epochs)))
+    transfer_learning = config.get_transfer_learning_config(
+        root_dir=trial_dir,
+        train_dir=None,
+        val_dir=None,
+        # Trial models are only compared on their validation loss: not registered, evaluated or exported
+        model_registry=None,
+        evaluation=None,
+        export_saved_model=False,
+        onnx_export=None,
+        base_model_path=model_path,
+        callback_path=os.path.join(trial_dir, 'callbacks.pickle'),
+        epochs=head_epochs,
+        fine_tune_epochs=epochs - head_epochs,
+        train_dataset=train_dataset.prefetch(tf.data.AUTOTUNE),
+        val_dataset=val_dataset.prefetch(tf.data.AUTOTUNE),
+    )
+    pruner = _MedianPruner(db_path, trial_id, peers, warmup_epochs, median_pruning, transfer_learning)
+    transfer_learning.callbacks.append(pruner)
+    transfer_learning.train(initial_epoch=initial_epoch)
+
+    history = transfer_learning.history.history
+    return {
+        'val_loss': float(min(history['val_loss'])),
+        'val_accuracy': float(max(history['val_accuracy'])),
+        'epochs': initial_epoch + len(history['val_loss']),
+        'pruned': pruner.pruned,
+    }
+
+
+@dataclass
+class HyperparameterSearch:
+    root_dir: Path
+    config_path: Path
+    params_path: Path
+    search_space: Dict[str, dict]
+    strategy: str = 'hyperband'
+    num_trials: int = 16
+    min_epochs: int = 1
+    max_epochs: int = 27
+    eta: int = 3
+    max_workers: int = 2
+    threads_per_worker: int = 2
+    median_pruning: bool = True
+    prune_warmup_epochs: int = 2
+    seed: int = 123
+    next_trial_id: int = field(default=0, init=False)
+
+    def __post_init__(self):
+        self.db_path = os.path.join(self.root_dir, 'trials.db')
+        self.rng = np.random.default_rng(self.seed)
+        with _connect(self.db_path) as connection:
+            row = connection.execute('SELECT MAX(trial_id) FROM trials').fetchone()
+        self.next_trial_id = 0 if row[0] is None else row[0] + 1
+
+    def sample(self) -> Dict[str, object]:
+        """
+        Draws one configuration from the search space.
+
+        Returns:
+            Dict[str, object]: The sampled value of each dotted params key.
+
+        Raises:
+            ValueError: If a search space entry has an unknown type.
+        """
+        overrides = {}
+        for key, spec in self.search_space.items():
+            kind = spec['type']
+            if kind == 'choice':
+                value = spec['values'][int(self.rng.integers(len(spec['values'])))]
+            elif kind == 'uniform':
+                value = float(self.rng.uniform(float(spec['low']), float(spec['high'])))
+            elif kind == 'loguniform':
+                value = float(math.exp(self.rng.uniform(math.log(float(spec['low'])), math.log(float(spec['high'])))))
+            elif kind == 'int':
+                value = int(self.rng.integers(int(spec['low']), int(spec['high']) + 1))
+            else:
+                raise ValueError(f"Unknown search space type '{kind}' for {key}")
+            overrides[key] = value
+        return overrides
+
+    def _run_rung(self, executor: ProcessPoolExecutor, trials: List[Tuple[int, dict]], bracket: int,
+                  epochs: int, initial_epoch: int) -> Dict[int, dict]:
+        """
+        Runs a group of trials concurrently to the same epoch budget and records them in the results store.
+
+        Returns:
+            Dict[int, dict]: The result of each trial.
+        """
+        with _connect(self.db_path) as connection:
+            for trial_id, overrides in trials:
+                connection.execute(
+                    'INSERT OR REPLACE INTO trials VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                    (trial_id, bracket, json.dumps(overrides), 'running', initial_epoch, None, None, time.time(), None))
+
+        peers = [trial_id for trial_id, _ in trials]
+        futures = {
+            executor.submit(_run_trial, trial_id, overrides, epochs, initial_epoch, self.max_epochs,
+                            os.path.join(self.root_dir, f'trial_{trial_id:04d}'), str(self.config_path),
+                            str(self.params_path), self.db_path, peers, self.median_pruning,
+                            self.prune_warmup_epochs): trial_id
+            for trial_id, overrides in trials
+        }
+        results = {}
+        for future in as_completed(futures):
+            trial_id = futures[future]
+            try:
+                result = future.result()
+                status = 'pruned' if result['pruned'] else 'completed'
+            except Exception as e:
+                logger.error(f"Trial {trial_id} failed: {e}")
+                result = {'val_loss': math.inf, 'val_accuracy': 0.0, 'epochs': initial_epoch, 'pruned': True}
+                status = 'failed'
+
+            results[trial_id] = result
+            with _connect(self.db_path) as connection:
+                connection.execute(
+                    'UPDATE trials SET status = ?, epochs = ?, val_loss = ?, val_accuracy = ?, finished = ? '
+                    'WHERE trial_id = ?',
+                    (status, result['epochs'], result['val_loss'], result['val_accuracy'], time.time(), trial_id))
+            logger.info(f"Trial {trial_id} {status} after {result['epochs']} epochs: "
+                        f"val_loss={result['val_loss']:.4f}, val_accuracy={result['val_accuracy']:.4f}")
+        return results
+
+    def _successive_halving(self, executor: ProcessPoolExecutor, bracket: int, num_trials: int,
+                            min_epochs: int) -> None:
+        """
+        Runs one successive halving bracket: every rung trains the surviving trials for `eta` times
+        more epochs and only the best `1 / eta` of them are promoted to the next rung.
+        """
+        trials = []
+        for _ in range(num_trials):
+            trials.append((self.next_trial_id, self.sample()))
+            self.next_trial_id += 1
+
+        epochs, initial_epoch = min_epochs, 0
+        while trials:
+            results = self._run_rung(executor, trials, bracket, min(epochs, self.max_epochs), initial_epoch)
+            if epochs >= self.max_epochs:
+                break
+            ranked = sorted((trial for trial in trials if not results[trial[0]]['pruned']),
+                            key=lambda trial: results[trial[0]]['val_loss'])
+            trials = ranked[:len(trials) // self.eta]
+            initial_epoch, epochs = epochs, epochs * self.eta
+
+    def run(self) -> dict:
+        """
+        Runs the configured search strategy and writes the best configuration found.
+
+        Returns:
+            dict: The best trial, with its params overrides and validation metrics.
+
+        Raises:
+            ValueError: If the search strategy is unknown.
+        """
+        try:
+            context = multiprocessing.get_context('spawn')
+            with ProcessPoolExecutor(max_workers=self.max_workers, mp_context=context,
+                                     initializer=limit_worker_threads,
+                                     initargs=(self.threads_per_worker, process_log_queue())) as executor:
+                if self.strategy == 'random':
+                    trials = []
+                    for _ in range(self.num_trials):
+                        trials.append((self.next_trial_id, self.sample()))
+                        self.next_trial_id += 1
+                    self._run_rung(executor, trials, 0, self.max_epochs, 0)
+                elif self.strategy == 'successive_halving':
+                    self._successive_halving(executor, 0, self.num_trials, self.min_epochs)
+                elif self.strategy == 'hyperband':
+                    s_max = int(math.log(self.max_epochs / self.min_epochs, self.eta) + 1e-9)
+                    for bracket, s in enumerate(range(s_max, -1, -1)):
+                        num_trials = int(math.ceil((s_max + 1) / (s + 1) * self.eta ** s))
+                        min_epochs = max(1, int(self.max_epochs * self.eta ** -s))
+                        logger.info(f"Hyperband bracket {bracket}: {num_trials} trials from {min_epochs} epochs")
+                        self._successive_halving(executor, bracket, num_trials, min_epochs)
+                else:
+                    raise ValueError(f"Unknown search strategy: {self.strategy}")
+
+            return self.save_best()
+        except Exception as e:
+            logger.error(f'Error running hyper-parameter search: {e}')
+            raise e
+
+    def save_best(self) -> dict:
+        """
+        Writes the best trial to `best_trial.json` and a full `best_params.yaml` with its overrides applied.
+
+        Returns:
+            dict: The best trial.
+        """
+        with _connect(self.db_path) as connection:
+            row = connection.execute(
+                "SELECT trial_id, params, epochs, val_loss, val_accuracy FROM trials "
+                "WHERE status IN ('completed', 'pruned') AND val_loss IS NOT NULL "
+                "ORDER BY epochs DESC, val_loss ASC LIMIT 1").fetchone()
+        if row is None:
+            raise ValueError('No successful trials recorded')
+
+        best = {'trial_id': row[0], 'params': json.loads(row[1]), 'epochs': row[2],
+                'val_loss': row[3], 'val_accuracy': row[4]}
+        with open(os.path.join(self.root_dir, 'best_trial.json'), 'w') as f:
+            json.dump(best, f, indent=2)
+
+        with open(self.params_path, 'r') as f:
+            params = yaml.safe_load(f)
+        _apply_overrides(params, best['params'])
+        best_params_path = os.path.join(self.root_dir, 'best_params.yaml')
+        with open(best_params_path, 'w') as f:
+            yaml.safe_dump(params, f, sort_keys=False)
+
+        logger.info(f"Best trial {best['trial_id']}: {best}. Params saved to: {best_params_path}")
+        return best
@@ -0,0 +1,154 @@
+import os
+import json
+import errno
+import time
+import shutil
+import tempfile
+from dataclasses import dataclass
+from pathlib import Path
+from typing import List, Optional, Tuple
+from brainMRI.logging import logger
+
+
+@dataclass
+class ModelRegistry:
+    root_dir: Path
+    keep_versions: int = 5
+
+    def __post_init__(self):
+        self.versions_dir = os.path.join(self.root_dir, 'versions')
+        self.current_path = os.path.join(self.root_dir, 'CURRENT')
+        os.makedirs(self.versions_dir, exist_ok=True)
+
+    def versions(self) -> List[str]:
+        """
+        Lists the registered versions, oldest first.
+        """
+        return sorted(name for name in os.listdir(self.versions_dir) if name.startswith('v'))
+
+    def version_dir(self, version: str) -> str:
+        return os.path.join(self.versions_dir, version)
+
+    def model_path(self, version: str) -> str:
+        return os.path.join(self.version_dir(version), 'model.keras')
+
+    def metadata(self, version: str) -> dict:
+        with open(os.path.join(self.version_dir(version), 'metadata.json'), 'r') as f:
+            return json.load(f)
+
+    def update_metadata(self, version: str, updates: dict) -> dict:
+        """
+        Merges `updates` into the metadata of a registered version, such as the operating threshold of a
+        later evaluation. The file is written under a temporary name and renamed over the old one.
+
+        Returns:
+            dict: The updated metadata.
+        """
+        metadata = dict(self.metadata(version), **updates)
+        fd, tmp_path = tempfile.mkstemp(prefix='.metadata-', dir=self.version_dir(version))
+        with os.fdopen(fd, 'w') as f:
+            json.dump(metadata, f, indent=2)
+        os.replace(tmp_path, os.path.join(self.version_dir(version), 'metadata.json'))
+        return metadata
+
+    def current(self) -> Optional[str]:
+        """
+        Returns the promoted version, or None if nothing has been promoted yet.
+        """
+        try:
+            with open(self.current_path, 'r') as f:
+                return f.read().strip() or None
+        except FileNotFoundError:
+            return None
+
+    def resolve(self, model_path: Path) -> Tuple[str, Optional[str]]:
+        """
+        Finds the model the predictor serves: the promoted version's model, or `model_path` if nothing
+        has been promoted yet. Stages that add to the served model, such as its ONNX export, write next to it.
+
+        Args:
+            model_path (Path): The model outside the registry.
+
+        Returns:
+            Tuple[str, Optional[str]]: The model file and its version, None for `model_path`.
+        """
+        version = self.current()
+        if version is None:
+            return str(model_path), None
+        return self.model_path(version), version
+
+    def register(self, model_path: Path, metadata: dict, artifacts: dict = None) -> str:
+        """
+        Copies a saved model into a new version directory. The directory is fully written under a
+        temporary name first and then renamed, so readers never see a partially written version. The
+        rename also reserves the version number: a concurrent registration that took the same number
+        first makes it fail, and the next number is tried.
+
+        Args:
+            model_path (Path): The saved `.keras` model.
+            metadata (dict): Validation metrics, params hash, class names and any other metadata.
+            artifacts (dict, optional): Extra files or directories to store with the version, keyed by target name.
+
+        Returns:
+            str: The new version.
+        """
+        staging_dir = None
+        try:
+            staging_dir = tempfile.mkdtemp(prefix='.staging-', dir=self.root_dir)
+            shutil.copy2(model_path, os.path.join(staging_dir, 'model.keras'))
+            for name, source in (artifacts or {}).items():
+                if os.path.isdir(source):
+                    shutil.copytree(source, os.path.join(staging_dir, name))
+                else:
+                    shutil.copy2(source, os.path.join(staging_dir, name))
+
+            while True:
+                existing = self.versions()
+                version = f"v{int(existing[-1][1:]) + 1 if existing else 1:04d}"
+                with open(os.path.join(staging_dir, 'metadata.json'), 'w') as f:
+                    json.dump(dict(metadata, version=version, created=time.time()), f, indent=2)
+                try:
+                    # Renaming onto a non-empty directory fails, so only one registration gets each version
+                    os.rename(staging_dir, self.version_dir(version))
+                    break
+                except OSError as e:
+                    if e.errno not in (errno.EEXIST, errno.ENOTEMPTY):
+                        raise
+            staging_dir = None
+            logger.info(f"Registered model version {version} from {model_path}")
+            return version
+        except Exception as e:
+            logger.error(f'Error registering model {model_path}: {e}')
+            if staging_dir is not None:
+                shutil.rmtree(staging_dir, ignore_errors=True)
+            raise e
+
+    def promote(self, version: str) -> None:
+        """
+        Atomically points `CURRENT` at a registered version, then removes old unpromoted versions.
+
+        Raises:
+            ValueError: If the version does not exist.
+        """
+        if not os.path.exists(self.model_path(version)):
+            raise ValueError(f"Unknown model version: {version}")
+
+        fd, tmp_path = tempfile.mkstemp(prefix='.CURRENT-', dir=self.root_dir)
+        with os.fdopen(fd, 'w') as f:
+            f.write(version)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.current_path)
+        logger.info(f"Promoted model version {version}")
+        self.prune()
+
+    def prune(self) -> None:
+        """
+        Keeps the newest `keep_versions` versions and the promoted one.
+        """
+        current = self.current()
+        versions = self.versions()
+        for version in versions[:max(0, len(versions) - self.keep_versions)]:
+            if version != current:
+                shutil.rmtree(self.version_dir(version), ignore_errors=True)
+                logger.info(f"Removed old model version {version}")
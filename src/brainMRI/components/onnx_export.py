@@ -0,0 +1,112 @@
+import os
+import json
+from dataclasses import dataclass
+from pathlib import Path
+import numpy as np
+import tensorflow as tf
+from brainMRI.components.model_registry import ModelRegistry
+from brainMRI.components.retrieval import pooled_embedding_model
+from brainMRI.logging import logger
+
+
+@dataclass
+class OnnxExport:
+    root_dir: Path
+    image_size: int
+    opset: int = 17
+    parity_samples: int = 8
+    parity_tolerance: float = 1e-4
+    seed: int = 123
+    model_registry: ModelRegistry = None
+
+    def export(self, model, onnx_path: Path) -> str:
+        """
+        Converts a Keras model to ONNX with tf2onnx, with the pooled embedding as a second output after
+        the prediction, so the predictor can index scored images from the same forward pass. The file is
+        written under a temporary name and renamed, so a serving replica never loads a half-written model.
+
+        Args:
+            model (tf.keras.Model): The trained model.
+            onnx_path (Path): Where to write the `.onnx` file.
+
+        Returns:
+            str: The path of the exported model.
+        """
+        try:
+            tmp_path = f'{onnx_path}.tmp'
+            input_signature = [tf.TensorSpec((None, self.image_size, self.image_size, 3), tf.float32, name='images')]
+            pooled_embedding_model(model).export(tmp_path, format='onnx', verbose=False,
+                                                 input_signature=input_signature, opset_version=self.opset)
+            os.replace(tmp_path, onnx_path)
+            logger.info(f"ONNX model exported to: {onnx_path}")
+            return str(onnx_path)
+        except Exception as e:
+            logger.error(f'Error exporting model to ONNX: {e}')
+            raise e
+
+    def check_parity(self, model, onnx_path: Path) -> dict:
+        """
+        Runs the same random images through the Keras model and through onnxruntime on CPU, and
+        compares the prediction and embedding outputs. The comparison is saved to `onnx_parity.json` in `root_dir`.
+
+        Args:
+            model (tf.keras.Model): The reference Keras model.
+            onnx_path (Path): The exported ONNX model.
+
+        Returns:
+            dict: The maximum and mean absolute output difference.
+
+        Raises:
+            ValueError: If the maximum difference exceeds `parity_tolerance`.
+        """
+        import onnxruntime as ort
+
+        rng = np.random.default_rng(self.seed)
+        images = rng.integers(0, 256, size=(self.parity_samples, self.image_size, self.image_size, 3))
+        images = images.astype(np.float32)
+
+        session = ort.InferenceSession(str(onnx_path), providers=['CPUExecutionProvider'])
+        expected = pooled_embedding_model(model)(images, training=False)
+        actual = session.run(None, {session.get_inputs()[0].name: images})
+
+        difference = np.concatenate([
+            np.abs(np.asarray(output, np.float64) - np.asarray(onnx_output, np.float64)).ravel()
+            for output, onnx_output in zip(expected, actual)])
+        report = {
+            'onnx_path': str(onnx_path),
+            'samples': self.parity_samples,
+            'max_abs_diff': float(difference.max()),
+            'mean_abs_diff': float(difference.mean()),
+            'tolerance': self.parity_tolerance,
+        }
+        report['passed'] = report['max_abs_diff'] <= self.parity_tolerance
+
+        report_path = os.path.join(self.root_dir, 'onnx_parity.json')
+        with open(report_path, 'w') as f:
+            json.dump(report, f, indent=2)
+        logger.info(f"ONNX parity: max abs diff {report['max_abs_diff']:.2e} over {self.parity_samples} images")
+
+        if not report['passed']:
+            raise ValueError(f"ONNX output differs from Keras by {report['max_abs_diff']:.2e}, "
+                             f"above the tolerance of {self.parity_tolerance:.2e}")
+        return report
+
+    def run(self, model_path: Path) -> str:
+        """
+        Exports a saved `.keras` model to `model.onnx` next to it and checks the output parity. With a
+        model registry, the promoted version is exported instead, into its version directory, where the
+        predictor loads it from.
+
+        Args:
+            model_path (Path): The trained model, used when no registry version is promoted.
+
+        Returns:
+            str: The path of the exported model.
+        """
+        if self.model_registry is not None:
+            model_path, _ = self.model_registry.resolve(model_path)
+        model = tf.keras.models.load_model(model_path, safe_mode=False, compile=False)
+        onnx_path = os.path.join(os.path.dirname(model_path), 'model.onnx')
+        self.export(model, onnx_path)
+        self.check_parity(model, onnx_path)
+        return onnx_path
@@ -0,0 +1,518 @@
+import os
+import csv
+import json
+import base64
+import hashlib
+import time
+import threading
+from collections import namedtuple
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import List
+import numpy as np
+from PIL import Image
+from brainMRI.components.model_registry import ModelRegistry
+from brainMRI.components.prediction_cache import PredictionCache
+from brainMRI.components.retrieval import SimilarCaseIndex, pooled_embedding_model
+from brainMRI.components.tensor_payload import decode_tensor
+from brainMRI.components.test_time_augmentation import TestTimeAugmentation
+from brainMRI.logging import logger
+
+# `embedder` runs the forward pass that returns [prediction, pooled embedding], when similar-case indexing needs it
+ServingModel = namedtuple('ServingModel',
+                          ['model', 'version', 'class_names', 'source', 'threshold', 'path', 'embedder'],
+                          defaults=(None,))
+
+
+class SavedModelRunner:
+    """
+    Calls the pre-traced `serve` endpoint of an exported SavedModel with the same interface as a Keras model.
+    """
+
+    def __init__(self, saved_model):
+        self.saved_model = saved_model
+        # Exports written by TransferLearning also have an endpoint returning the pooled embedding
+        self.with_embeddings = self._with_embeddings if hasattr(saved_model, 'serve_embeddings') else None
+
+    def __call__(self, images, training=False):
+        return self.saved_model.serve(np.asarray(images, dtype=np.float32))
+
+    def _with_embeddings(self, images):
+        return self.saved_model.serve_embeddings(np.asarray(images, dtype=np.float32))
+
+
+class OnnxRunner:
+    """
+    Runs an exported ONNX model through onnxruntime's CPU execution provider with the same interface
+    as a Keras model, so serving does not need to import TensorFlow.
+    """
+
+    def __init__(self, onnx_path: str, intra_op_threads: int = 0, inter_op_threads: int = 0):
+        import onnxruntime as ort
+
+        options = ort.SessionOptions()
+        # 0 lets onnxruntime pick a thread count from the available cores
+        options.intra_op_num_threads = intra_op_threads
+        options.inter_op_num_threads = inter_op_threads
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        self.session = ort.InferenceSession(onnx_path, sess_options=options, providers=['CPUExecutionProvider'])
+        self.input_name = self.session.get_inputs()[0].name
+        self.output_names = [output.name for output in self.session.get_outputs()]
+        # Exports written by OnnxExport have the pooled embedding as a second output
+        self.with_embeddings = self._with_embeddings if len(self.output_names) > 1 else None
+
+    def __call__(self, images, training=False):
+        return self.session.run(self.output_names[:1], {self.input_name: np.asarray(images, dtype=np.float32)})[0]
+
+    def _with_embeddings(self, images):
+        return self.session.run(self.output_names[:2], {self.input_name: np.asarray(images, dtype=np.float32)})
+
+
+@dataclass
+class Prediction:
+    model_path: Path
+    class_names_file: Path
+    image_size: int
+    batch_size: int = 32
+    threshold: float = 0.5
+    tta: bool = False
+    tta_config: TestTimeAugmentation = None
+    cache: PredictionCache = None
+    registry: ModelRegistry = None
+    watch_interval: float = 5.0
+    use_saved_model: bool = True
+    backend: str = 'tensorflow'
+    intra_op_threads: int = 0
+    inter_op_threads: int = 0
+    warmup_batch_sizes: List[int] = field(default_factory=lambda: [1])
+    use_evaluated_threshold: bool = True
+    explain: bool = False
+    gradcam_alpha: float = 0.4
+    retrieval: SimilarCaseIndex = None
+    index_scored: bool = True
+    max_tensor_images: int = 1024
+
+    def __post_init__(self):
+        if self.backend not in ('tensorflow', 'onnx'):
+            raise ValueError(f"Unknown prediction backend: {self.backend}")
+        self.load_timings = {}
+        self._watcher = None
+        self._stop_watching = threading.Event()
+        self._reload_lock = threading.Lock()
+        self._explainer_lock = threading.Lock()
+        self._gradcam = None
+        self._serving = self._load(self._resolve_source())
+        if self.cache is not None:
+            self.cache.invalidate(self.model_version)
+
+    @property
+    def serving(self) -> ServingModel:
+        return self._serving
+
+    @property
+    def model(self):
+        return self._serving.model
+
+    @property
+    def model_version(self) -> str:
+        return self._serving.version
+
+    @property
+    def class_names(self) -> List[str]:
+        return self._serving.class_names
+
+    def _resolve_source(self):
+        """
+        Finds the model to serve: the promoted registry version if there is one, otherwise `model_path`.
+        The source identifies the model and its evaluation report cheaply, so it can be polled to detect
+        a new model or a re-evaluated threshold.
+
+        Returns:
+            Tuple[str, str, Optional[str]]: The model file, its source identifier and its registry version.
+        """
+        model_path, version = self.model_path, None
+        if self.registry is not None:
+            model_path, version = self.registry.resolve(self.model_path)
+        if version is not None:
+            source_id = version
+        else:
+            stat = os.stat(model_path)
+            source_id = f'{stat.st_mtime_ns}:{stat.st_size}'
+        try:
+            source_id += f':{os.stat(os.path.join(os.path.dirname(model_path), "evaluation.json")).st_mtime_ns}'
+        except FileNotFoundError:
+            pass
+        return model_path, source_id, version
+
+    def _load(self, source) -> ServingModel:
+        """
+        Loads and warms up a model without touching the model currently serving traffic.
+
+        Returns:
+            ServingModel: The loaded model with its version and class names.
+        """
+        model_path, source_id, registry_version = source
+        class_names = []
+        threshold = None
+        if registry_version is not None:
+            version = registry_version
+            metadata = self.registry.metadata(registry_version)
+            class_names = metadata.get('class_names', [])
+            threshold = metadata.get('threshold')
+        else:
+            digest = hashlib.sha256()
+            with open(model_path, 'rb') as f:
+                for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                    digest.update(chunk)
+            version = digest.hexdigest()[:16]
+        if not class_names:
+            with open(self.class_names_file, 'r') as f:
+                class_names = [line.strip() for line in f if line.strip()]
+        # The operating threshold picked by the evaluation stage, stored with the model
+        evaluation_path = os.path.join(os.path.dirname(model_path), 'evaluation.json')
+        if threshold is None and os.path.exists(evaluation_path):
+            with open(evaluation_path, 'r') as f:
+                threshold = json.load(f).get('threshold')
+        if threshold is None or not self.use_evaluated_threshold:
+            threshold = self.threshold
+
+        start = time.perf_counter()
+        saved_model_dir = os.path.join(os.path.dirname(model_path), 'serving')
+        if self.backend == 'onnx':
+            onnx_path = os.path.join(os.path.dirname(model_path), 'model.onnx')
+            if not os.path.exists(onnx_path):
+                raise FileNotFoundError(f"No ONNX model next to {model_path}; export one with the ONNX export stage")
+            model = OnnxRunner(onnx_path, self.intra_op_threads, self.inter_op_threads)
+            model_format = 'onnx'
+        elif self.use_saved_model and os.path.isdir(saved_model_dir):
+            import tensorflow as tf
+            model = SavedModelRunner(tf.saved_model.load(saved_model_dir))
+            model_format = 'saved_model'
+        else:
+            import tensorflow as tf
+            # Serving needs no optimizer state, and skipping it avoids deserialising training-only objects
+            model = tf.keras.models.load_model(model_path, safe_mode=False, compile=False)
+            model_format = 'keras'
+
+        # Scored images are indexed with the embedding of the forward pass that scored them
+        embedder = None
+        if self.retrieval is not None and self.index_scored:
+            if model_format == 'keras':
+                joint = pooled_embedding_model(model)
+                embedder = lambda images: joint(images, training=False)
+            else:
+                embedder = model.with_embeddings
+                if embedder is None:
+                    logger.warning(f"The {model_format} export has no embedding output, scored images are "
+                                   f"embedded again for the similar-case index; re-export the model to avoid it")
+        load_seconds = time.perf_counter() - start
+
+        # Run every batch shape the model will see before it takes traffic
+        start = time.perf_counter()
+        warmup_sizes = set(self.warmup_batch_sizes)
+        if self.tta_config is not None:
+            warmup_sizes |= {size * self.tta_config.num_views for size in self.warmup_batch_sizes}
+        for size in sorted(warmup_sizes):
+            model(np.zeros((size, self.image_size, self.image_size, 3), dtype=np.float32), training=False)
+            if embedder is not None:
+                embedder(np.zeros((size, self.image_size, self.image_size, 3), dtype=np.float32))
+        warmup_seconds = time.perf_counter() - start
+
+        self.load_timings = {
+            'format': model_format,
+            'load_seconds': load_seconds,
+            'warmup_seconds': warmup_seconds,
+            'warmup_batch_sizes': sorted(warmup_sizes),
+        }
+        logger.info(f"Loaded {model_format} model {version} from {model_path} with classes {class_names} "
+                    f"and threshold {threshold:.3f} in {load_seconds:.2f}s, warmed up in {warmup_seconds:.2f}s")
+        return ServingModel(model, version, class_names, source_id, threshold, model_path, embedder)
+
+    def reload_if_changed(self) -> bool:
+        """
+        Loads and warms up a new model if the registry or the model file changed, then swaps it in.
+        Requests already running keep the model they started with, so no in-flight batch is dropped.
+
+        Returns:
+            bool: Whether a new model was swapped in.
+        """
+        with self._reload_lock:
+            source = self._resolve_source()
+            if source[1] == self._serving.source:
+                return False
+            serving = self._load(source)
+            self._serving = serving
+            if self.cache is not None:
+                self.cache.invalidate(serving.version)
+            logger.info(f"Now serving model {serving.version}")
+            return True
+
+    def start_watching(self) -> None:
+        """
+        Starts a background thread that polls for a new model every `watch_interval` seconds.
+        """
+        if self._watcher is not None:
+            return
+
+        def watch():
+            while not self._stop_watching.wait(self.watch_interval):
+                try:
+                    self.reload_if_changed()
+                except Exception as e:
+                    logger.error(f'Error reloading model: {e}')
+
+        self._watcher = threading.Thread(target=watch, name='model-watcher', daemon=True)
+        self._watcher.start()
+        logger.info(f"Watching for new models every {self.watch_interval}s")
+
+    def stop_watching(self) -> None:
+        self._stop_watching.set()
+
+    def _explainer(self, serving: ServingModel):
+        """
+        Builds the Grad-CAM explainer of the serving model once per model version. SavedModel and ONNX
+        runners have no Keras graph to take gradients through, so the `.keras` model is loaded for them.
+
+        Returns:
+            GradCam: The explainer.
+        """
+        with self._explainer_lock:
+            if self._gradcam is None or self._gradcam[0] != serving.version:
+                if self.backend == 'onnx':
+                    raise ValueError("Grad-CAM explanations need the tensorflow backend")
+                import tensorflow as tf
+                from brainMRI.components.grad_cam import GradCam
+
+                model = serving.model
+                if not isinstance(model, tf.keras.Model):
+                    model = tf.keras.models.load_model(serving.path, safe_mode=False, compile=False)
+                self._gradcam = (serving.version, GradCam(model, alpha=self.gradcam_alpha))
+            return self._gradcam[1]
+
+    def load_image(self, image) -> np.ndarray:
+        """
+        Decodes an image file and resizes it to the model input size.
+
+        Args:
+            image: A path or a binary file-like object.
+
+        Returns:
+            np.ndarray: The RGB pixel buffer as uint8, shaped (image_size, image_size, 3).
+        """
+        with Image.open(image) as img:
+            img = img.convert('RGB').resize((self.image_size, self.image_size), Image.BILINEAR)
+            return np.asarray(img, dtype=np.uint8)
+
+    def load_tensor(self, data: bytes) -> np.ndarray:
+        """
+        Reads a batch of images that are already pixel arrays from a `.npy` or length-prefixed tensor
+        payload (see `tensor_payload`), without decoding or resizing them. The batch is a view of
+        `data`; it is converted to float32 one forward-pass batch at a time.
+
+        Args:
+            data (bytes): A payload holding uint8, float16 or float32 pixel values on the 0-255 scale,
+                shaped (batch, image_size, image_size, 3) for RGB, (batch, image_size, image_size, 1) or
+                (batch, image_size, image_size) for grayscale slices.
+
+        Returns:
+            np.ndarray: The images, shaped (batch, image_size, image_size, 3).
+
+        Raises:
+            ValueError: If the payload is malformed, or its shape or size does not fit the model.
+        """
+        images = decode_tensor(data)
+        if images.ndim == 3:
+            images = images[..., None]
+        size = (self.image_size, self.image_size)
+        if images.ndim != 4 or images.shape[1:3] != size or images.shape[3] not in (1, 3):
+            raise ValueError(f"Expected a tensor shaped (batch, {self.image_size}, {self.image_size}, 3), "
+                             f"(batch, {self.image_size}, {self.image_size}, 1) or "
+                             f"(batch, {self.image_size}, {self.image_size}), got {images.shape}")
+        if not 0 < len(images) <= self.max_tensor_images:
+            raise ValueError(f"A tensor holds 1 to {self.max_tensor_images} images, got {len(images)}")
+        if images.shape[3] == 1:
+            # Grayscale is repeated into RGB as PIL's convert('RGB') does for uploaded files, as a view
+            images = np.broadcast_to(images, images.shape[:3] + (3,))
+        return images
+
+    def _forward(self, serving: ServingModel, images: np.ndarray, tta: bool):
+        """
+        Runs one batch through the model. With test-time augmentation, every view of every image is
+        stacked into a single forward pass and the view outputs are averaged per image. Otherwise the
+        pass also returns the pooled embeddings when the serving model has an embedder.
+
+        Returns:
+            Tuple[np.ndarray, Optional[np.ndarray]]: The positive-class probability of each image, and
+                its embedding or None.
+        """
+        if tta and self.tta_config is not None:
+            views = self.tta_config.views(images)
+            outputs = np.asarray(serving.model(views, training=False))
+            return self.tta_config.average(outputs, len(images)).reshape(len(images)), None
+        if serving.embedder is not None:
+            outputs, embeddings = serving.embedder(images)[:2]
+            return np.asarray(outputs).reshape(len(images)), np.asarray(embeddings)
+        return np.asarray(serving.model(images, training=False)).reshape(len(images)), None
+
+    def predict(self, images: np.ndarray, tta: bool = None, explain: bool = None,
+                names: List[str] = None) -> List[dict]:
+        """
+        Predicts the class of a batch of preprocessed images. With a similar-case index and
+        `index_scored`, the scored images are added to the index with their predicted class.
+
+        Args:
+            images (np.ndarray): The images, shaped (batch, image_size, image_size, 3).
+            tta (bool, optional): Whether to use test-time augmentation. Defaults to the configured `tta`.
+            explain (bool, optional): Whether to add a Grad-CAM overlay of each image, as a base64 PNG in
+                `gradcam`. Defaults to the configured `explain`.
+            names (List[str], optional): The name to index each image under, such as its path.
+
+        Returns:
+            List[dict]: The predicted class and positive-class probability of each image.
+        """
+        tta = self.tta if tta is None else tta
+        explain = self.explain if explain is None else explain
+        if self._watcher is None:
+            self.reload_if_changed()
+        # The whole request is served by the model that was current when it started
+        serving = self._serving
+        images = np.asarray(images)
+        num_views = self.tta_config.num_views if tta and self.tta_config is not None else 1
+
+        probabilities = np.empty(len(images), dtype=np.float64)
+        embeddings = None
+        gradcams = [None] * len(images)
+        missing = list(range(len(images)))
+        if self.cache is not None:
+            keys = [self.cache.key(image, serving.version, f'views={num_views}') for image in images]
+            missing = []
+            for index, key in enumerate(keys):
+                cached = self.cache.get(key)
+                if cached is None:
+                    missing.append(index)
+                else:
+                    probabilities[index] = cached['probability']
+                    gradcams[index] = cached.get('gradcam')
+
+        if missing:
+            # Converted one batch at a time, so a large request never holds a float32 copy of all of it
+            pending = images if len(missing) == len(images) else images[missing]
+            batches = [self._forward(serving, pending[start:start + self.batch_size].astype(np.float32), tta)
+                       for start in range(0, len(pending), self.batch_size)]
+            outputs = np.concatenate([batch_outputs for batch_outputs, _ in batches])
+            probabilities[missing] = outputs
+            if batches[0][1] is not None:
+                embeddings = np.concatenate([batch_embeddings for _, batch_embeddings in batches])
+            if self.cache is not None:
+                for index, probability in zip(missing, outputs):
+                    if not explain:
+                        self.cache.put(keys[index], {'probability': float(probability)}, serving.version)
+
+        if explain:
+            # Explained in batches like the forward pass; cached with the probability
+            unexplained = [index for index in range(len(images)) if gradcams[index] is None]
+            explainer = self._explainer(serving) if unexplained else None
+            for start in range(0, len(unexplained), self.batch_size):
+                batch = unexplained[start:start + self.batch_size]
+                for index, gradcam in zip(batch, explainer.explain(images[batch], serving.threshold)):
+                    gradcams[index] = gradcam
+                    if self.cache is not None:
+                        self.cache.put(keys[index], {'probability': float(probabilities[index]), 'gradcam': gradcam},
+                                       serving.version)
+
+        predictions = [
+            {
+                'class': serving.class_names[int(probability >= serving.threshold)],
+                'probability': float(probability),
+                'views': num_views,
+                **({'gradcam': gradcam} if explain else {}),
+            }
+            for probability, gradcam in zip(probabilities, gradcams)
+        ]
+
+        if self.retrieval is not None and self.index_scored:
+            # Indexed on a background thread; images served from the cache have no embedding and are embedded there
+            labels = [prediction['class'] for prediction in predictions]
+            scored = set(missing)
+            cached = [index for index in range(len(images)) if index not in scored]
+            for indices, batch_embeddings in ((missing, embeddings), (cached, None)):
+                if indices:
+                    batch_names = [names[index] for index in indices] if names else None
+                    self.retrieval.submit(serving, images[indices], batch_names, [labels[index] for index in indices],
+                                          'scored', probabilities[indices], batch_embeddings)
+        return predictions
+
+    def similar(self, images: np.ndarray, k: int = None):
+        """
+        Finds the indexed images most similar to each of a batch of preprocessed images.
+
+        Returns:
+            Tuple[List[List[dict]], dict]: The neighbours of each image, best first, and the timings.
+
+        Raises:
+            ValueError: If similar-case retrieval is not enabled or the index belongs to another model.
+        """
+        if self.retrieval is None:
+            raise ValueError("Similar-case retrieval is not enabled")
+        if self._watcher is None:
+            self.reload_if_changed()
+        return self.retrieval.query(self._serving, np.asarray(images), k)
+
+    def predict_files(self, image_files: list, tta: bool = None, explain: bool = None,
+                      names: List[str] = None) -> List[dict]:
+        """
+        Decodes and predicts a list of image files.
+
+        Args:
+            image_files (list): Paths or binary file-like objects.
+            tta (bool, optional): Whether to use test-time augmentation.
+            explain (bool, optional): Whether to add Grad-CAM overlays.
+            names (List[str], optional): The name of each file. Defaults to the paths.
+
+        Returns:
+            List[dict]: The prediction of each image.
+        """
+        images = np.stack([self.load_image(image_file) for image_file in image_files])
+        if names is None:
+            names = [str(image_file) if isinstance(image_file, (str, Path)) else None for image_file in image_files]
+        return self.predict(images, tta=tta, explain=explain, names=names)
+
+    def score_directory(self, input_dir: Path, output_path: Path, tta: bool = None, explain: bool = None) -> None:
+        """
+        Bulk scorer: predicts every image under `input_dir` in batches and writes one CSV row per image.
+        Rows are written as each batch completes, so memory stays bounded by the batch size.
+
+        Args:
+            input_dir (Path): The directory to score, searched recursively.
+            output_path (Path): The CSV file to write.
+            tta (bool, optional): Whether to use test-time augmentation.
+            explain (bool, optional): Whether to write a Grad-CAM overlay PNG per image to a `gradcam`
+                directory next to the CSV, mirroring the input layout.
+        """
+        try:
+            image_paths = sorted(str(path) for path in Path(input_dir).rglob('*') if path.is_file())
+            os.makedirs(os.path.dirname(output_path) or '.', exist_ok=True)
+            logger.info(f"Scoring {len(image_paths)} images from {input_dir}")
+
+            explain = self.explain if explain is None else explain
+            gradcam_dir = os.path.join(os.path.dirname(output_path), 'gradcam')
+            with open(output_path, 'w', newline='') as output_file:
+                writer = csv.writer(output_file)
+                writer.writerow(['File Path', 'class', 'probability', 'views'] + (['gradcam'] if explain else []))
+                for start in range(0, len(image_paths), self.batch_size):
+                    batch_paths = image_paths[start:start + self.batch_size]
+                    for path, result in zip(batch_paths, self.predict_files(batch_paths, tta=tta, explain=explain)):
+                        row = [path, result['class'], f"{result['probability']:.6f}", result['views']]
+                        if explain:
+                            relative_path = os.path.splitext(os.path.relpath(path, input_dir))[0]
+                            gradcam_path = os.path.join(gradcam_dir, relative_path + '.png')
+                            os.makedirs(os.path.dirname(gradcam_path), exist_ok=True)
+                            with open(gradcam_path, 'wb') as f:
+                                f.write(base64.b64decode(result['gradcam']))
+                            row.append(gradcam_path)
+                        writer.writerow(row)
+
+            logger.info(f"Predictions saved to: {output_path}")
+        except Exception as e:
+            logger.error(f'Error scoring directory {input_dir}: {e}')
+            raise e
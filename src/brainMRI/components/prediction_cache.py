@@ -0,0 +1,191 @@
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Optional
+import numpy as np
+from brainMRI.logging import logger
+
+
+@dataclass
+class PredictionCache:
+    """
+    A two-tier prediction cache: an in-process LRU dictionary in front of an optional SQLite table
+    shared across restarts and worker processes.
+
+    The disk tier keeps a running total of its size in memory instead of summing the table on every
+    insert, and collects the last-access times of disk hits to write them in one batch. Every
+    `sync_every` disk hits and inserts, the batch is written and the total is re-read from the table,
+    which also picks up what other processes sharing the file wrote.
+    """
+    max_entries: int = 10000
+    ttl_seconds: float = 86400
+    disk_path: Path = None
+    max_disk_bytes: int = 512 * 1024 * 1024
+    sync_every: int = 256
+
+    def __post_init__(self):
+        self._lock = threading.Lock()
+        self._memory = OrderedDict()
+        self._stats = {'memory_hits': 0, 'disk_hits': 0, 'misses': 0, 'evictions': 0}
+        self._disk = None
+        # Last-access times of disk hits not written yet, the running size of the disk tier, and the
+        # disk operations since they were last synced
+        self._accessed = {}
+        self._disk_bytes = 0
+        self._unsynced = 0
+        if self.disk_path:
+            os.makedirs(os.path.dirname(self.disk_path) or '.', exist_ok=True)
+            self._disk = sqlite3.connect(self.disk_path, check_same_thread=False)
+            self._disk.execute('PRAGMA journal_mode=WAL')
+            self._disk.execute(
+                'CREATE TABLE IF NOT EXISTS predictions ('
+                'key TEXT PRIMARY KEY, model_version TEXT, value TEXT, size INTEGER, created REAL, last_access REAL)')
+            self._disk.execute('CREATE INDEX IF NOT EXISTS predictions_last_access ON predictions (last_access)')
+            self._disk.commit()
+            self._sync()
+
+    def _sync(self) -> None:
+        """
+        Writes the collected last-access times and re-reads the size of the disk tier. Called with the lock held.
+        """
+        if self._accessed:
+            self._disk.executemany('UPDATE predictions SET last_access = ? WHERE key = ?',
+                                   [(last_access, key) for key, last_access in self._accessed.items()])
+            self._disk.commit()
+            self._accessed = {}
+        self._disk_bytes = self._disk.execute('SELECT COALESCE(SUM(size), 0) FROM predictions').fetchone()[0]
+        self._unsynced = 0
+
+    def _count_disk_operation(self) -> None:
+        self._unsynced += 1
+        if self._unsynced >= self.sync_every:
+            self._sync()
+
+    @staticmethod
+    def key(image: np.ndarray, model_version: str, variant: str = '') -> str:
+        """
+        Builds the cache key of an image from its decoded, resized pixel buffer and the model version.
+
+        Args:
+            image (np.ndarray): The preprocessed image.
+            model_version (str): The version of the model producing the prediction.
+            variant (str): Anything else that changes the prediction, such as test-time augmentation.
+
+        Returns:
+            str: The hex digest of the key.
+        """
+        image = np.ascontiguousarray(image)
+        digest = hashlib.blake2b(digest_size=16)
+        digest.update(f'{model_version}|{variant}|{image.dtype.str}|{image.shape}'.encode())
+        digest.update(memoryview(image).cast('B'))
+        return digest.hexdigest()
+
+    def get(self, key: str) -> Optional[dict]:
+        """
+        Looks a key up in the in-process tier, then in the on-disk tier. Disk hits are promoted to memory.
+
+        Returns:
+            Optional[dict]: The cached value, or None on a miss or an expired entry.
+        """
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                created, value = entry
+                if now - created <= self.ttl_seconds:
+                    self._memory.move_to_end(key)
+                    self._stats['memory_hits'] += 1
+                    return value
+                del self._memory[key]
+
+            if self._disk is not None:
+                row = self._disk.execute('SELECT value, created FROM predictions WHERE key = ?', (key,)).fetchone()
+                if row is not None and now - row[1] <= self.ttl_seconds:
+                    self._accessed[key] = now
+                    value = json.loads(row[0])
+                    self._put_memory(key, row[1], value)
+                    self._stats['disk_hits'] += 1
+                    self._count_disk_operation()
+                    return value
+
+            self._stats['misses'] += 1
+            return None
+
+    def _put_memory(self, key: str, created: float, value: dict) -> None:
+        self._memory[key] = (created, value)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+            self._stats['evictions'] += 1
+
+    def put(self, key: str, value: dict, model_version: str) -> None:
+        """
+        Stores a value in both tiers, evicting the least recently used entries beyond the size limits.
+
+        Args:
+            key (str): The cache key.
+            value (dict): The JSON-serialisable prediction.
+            model_version (str): The version of the model that produced the value.
+        """
+        now = time.time()
+        with self._lock:
+            self._put_memory(key, now, value)
+            if self._disk is None:
+                return
+
+            payload = json.dumps(value)
+            size = len(payload) + len(key)
+            replaced = self._disk.execute('SELECT size FROM predictions WHERE key = ?', (key,)).fetchone()
+            self._disk.execute('INSERT OR REPLACE INTO predictions VALUES (?, ?, ?, ?, ?, ?)',
+                               (key, model_version, payload, size, now, now))
+            self._accessed.pop(key, None)
+            self._disk_bytes += size - (replaced[0] if replaced else 0)
+            if self._disk_bytes > self.max_disk_bytes:
+                # Eviction goes by last access, so the collected accesses are written first
+                self._sync()
+            if self._disk_bytes > self.max_disk_bytes:
+                # Drop the least recently used rows until the tier is back under 90% of its budget
+                evicted = []
+                rows = self._disk.execute('SELECT key, size FROM predictions ORDER BY last_access')
+                for row_key, row_size in rows:
+                    if self._disk_bytes <= self.max_disk_bytes * 0.9:
+                        break
+                    evicted.append((row_key,))
+                    self._disk_bytes -= row_size
+                rows.close()
+                self._disk.executemany('DELETE FROM predictions WHERE key = ?', evicted)
+                self._stats['evictions'] += len(evicted)
+            self._disk.commit()
+            self._count_disk_operation()
+
+    def invalidate(self, model_version: str = None) -> None:
+        """
+        Drops every cached prediction that was not produced by `model_version` (all of them if None).
+        """
+        with self._lock:
+            self._memory.clear()
+            if self._disk is not None:
+                self._disk.execute('DELETE FROM predictions WHERE model_version IS NOT ?', (model_version,))
+                self._disk.commit()
+                self._sync()
+        logger.info(f"Prediction cache invalidated for model version {model_version}")
+
+    def metrics(self) -> dict:
+        """
+        Returns the hit/miss counters and the size of each tier.
+        """
+        with self._lock:
+            metrics = dict(self._stats)
+            lookups = metrics['memory_hits'] + metrics['disk_hits'] + metrics['misses']
+            metrics['hit_rate'] = (metrics['memory_hits'] + metrics['disk_hits']) / lookups if lookups else 0.0
+            metrics['memory_entries'] = len(self._memory)
+            if self._disk is not None:
+                metrics['disk_entries'] = self._disk.execute('SELECT COUNT(*) FROM predictions').fetchone()[0]
+                metrics['disk_bytes'] = self._disk_bytes
+            return metrics
@@ -1,9 +1,158 @@
-from dataclasses import dataclass
-from typing import Tuple
+from dataclasses import dataclass, field
+from typing import Iterator, List, Tuple
+from brainMRI.components.runtime_config import RuntimeConfig
+from brainMRI.components.quarantine import IMAGE_EXTENSIONS, quarantined_paths
+from brainMRI.components.volumes import VOLUME_EXTENSIONS, VolumeReader, is_volume, split_slice_path
 from brainMRI.logging import logger
+from brainMRI.utils.helpers import get_rss_mb, get_peak_rss_mb
 import tensorflow as tf
+import numpy as np
 from pathlib import Path
+from PIL import Image
+import gc
+import shutil
+import io
 import os
+import glob
+import json
+import sqlite3
+import hashlib
+
+
+
+def size_key(image_size) -> str:
+    """
+    Names a resolution variant, e.g. `128x128`.
+    """
+    height, width = image_size
+    return f'{height}x{width}'
+
+
+def load_dataset(dataset_dir: Path, batch_size: int = None, image_size: list = None,
+                 splittable: bool = False) -> tf.data.Dataset:
+    """
+    Loads a prepared dataset: TFRecord shards listed in a `manifest.json` written by the streaming
+    prepare mode, or a dataset saved with `tf.data.Dataset.save` otherwise. Datasets prepared with
+    resolution variants can be loaded at any of their sizes; other sizes are resized on the fly.
+
+    Args:
+        dataset_dir (Path): The prepared train or validation dataset directory.
+        batch_size (int, optional): The batch size. Defaults to the prepare batch size.
+        image_size (list, optional): The [height, width] to load. Defaults to the full prepare size.
+        splittable (bool, optional): Reads a saved dataset as a range over its shard files, which the
+            tf.data service can hand out to its workers with dynamic sharding. TFRecord shards always are.
+
+    Returns:
+        tf.data.Dataset: Batches of (float32 images, int32 labels).
+    """
+    manifest_path = os.path.join(dataset_dir, 'manifest.json')
+    if not os.path.exists(manifest_path):
+        dataset = tf.data.Dataset.load(str(dataset_dir))
+        if splittable:
+            # Counts the shard files of every saved run, a stale run only adds empty splits
+            splits = max(1, len(glob.glob(os.path.join(dataset_dir, '*', '*.shard'))))
+            dataset = tf.data.Dataset.range(splits).flat_map(lambda index: tf.data.Dataset.load(
+                str(dataset_dir), reader_func=lambda shards: shards.shard(splits, index).flat_map(lambda shard: shard)))
+        images_spec = dataset.element_spec[0]
+        if isinstance(images_spec, dict):
+            # Saved with resolution variants: pick the requested one, or the full size
+            key = size_key(image_size) if image_size is not None else None
+            if key not in images_spec:
+                key = max(images_spec, key=lambda name: images_spec[name].shape[1] * images_spec[name].shape[2])
+            dataset = dataset.map(lambda images, label: (images[key], label))
+        if image_size is not None and list(dataset.element_spec[0].shape[1:3]) != list(image_size):
+            dataset = dataset.map(lambda image, label: (tf.image.resize(image, image_size), label))
+        if batch_size:
+            dataset = dataset.unbatch().batch(batch_size)
+        return dataset
+
+    with open(manifest_path, 'r') as f:
+        manifest = json.load(f)
+    feature, (height, width) = 'image', manifest['image_size']
+    if image_size is not None and size_key(image_size) != size_key(manifest['image_size']):
+        if size_key(image_size) in manifest.get('variants', []):
+            feature, (height, width) = f'image_{size_key(image_size)}', image_size
+    features = {
+        feature: tf.io.FixedLenFeature([], tf.string),
+        'label': tf.io.FixedLenFeature([], tf.int64),
+    }
+
+    def parse(record):
+        example = tf.io.parse_single_example(record, features)
+        image = tf.cast(tf.reshape(tf.io.decode_png(example[feature], channels=3), (height, width, 3)), tf.float32)
+        if image_size is not None and [height, width] != list(image_size):
+            image = tf.image.resize(image, image_size)
+        return image, tf.cast(example['label'], tf.int32)
+
+    files = [os.path.join(dataset_dir, shard['file']) for shard in manifest['shards']]
+    dataset = tf.data.TFRecordDataset(files, num_parallel_reads=tf.data.AUTOTUNE)
+    dataset = dataset.map(parse, num_parallel_calls=tf.data.AUTOTUNE)
+    return dataset.batch(batch_size or manifest['batch_size']).prefetch(tf.data.AUTOTUNE)
+
+
+def _read_manifest(dataset_dir: str) -> dict:
+    manifest_path = os.path.join(dataset_dir, 'manifest.json')
+    if not os.path.exists(manifest_path):
+        return None
+    with open(manifest_path, 'r') as f:
+        return json.load(f)
+
+
+def _connect_index(index_path: str) -> sqlite3.Connection:
+    """
+    Opens the ingest index, which records every ingested file with its content hash, split and shard.
+    """
+    connection = sqlite3.connect(index_path)
+    connection.execute(
+        'CREATE TABLE IF NOT EXISTS files ('
+        'path TEXT PRIMARY KEY, content_hash TEXT, split TEXT, label INTEGER, shard TEXT, size INTEGER, mtime_ns INTEGER)')
+    connection.execute('CREATE INDEX IF NOT EXISTS files_content_hash ON files (content_hash)')
+    return connection
+
+
+class _ShardWriter:
+    """
+    Writes TFRecord shards of at most `shard_size` examples and lists them in `manifest.json`.
+    When continuing an existing manifest, new examples always go to new shards, so existing shards
+    are never rewritten.
+    """
+
+    def __init__(self, output_dir: str, shard_size: int, manifest: dict, existing: dict = None):
+        self.output_dir = output_dir
+        self.shard_size = shard_size
+        self.manifest = dict(existing) if existing else dict(manifest, shards=[], num_examples=0)
+        self._writer = None
+        os.makedirs(output_dir, exist_ok=True)
+
+    def write(self, example: bytes) -> str:
+        if self._writer is None or self.manifest['shards'][-1]['count'] >= self.shard_size:
+            self._rotate()
+        self._writer.write(example)
+        self.manifest['shards'][-1]['count'] += 1
+        self.manifest['num_examples'] += 1
+        return self.manifest['shards'][-1]['file']
+
+    def _rotate(self) -> None:
+        self.flush(close=True)
+        name = f"shard-{len(self.manifest['shards']):05d}.tfrecord"
+        self._writer = tf.io.TFRecordWriter(os.path.join(self.output_dir, name))
+        self.manifest['shards'].append({'file': name, 'count': 0})
+
+    def flush(self, close: bool = False) -> None:
+        if self._writer is None:
+            return
+        self._writer.flush()
+        if close:
+            self._writer.close()
+            self._writer = None
+
+    def close(self) -> dict:
+        self.flush(close=True)
+        manifest_path = os.path.join(self.output_dir, 'manifest.json')
+        with open(manifest_path + '.tmp', 'w') as f:
+            json.dump(self.manifest, f, indent=2)
+        os.replace(manifest_path + '.tmp', manifest_path)
+        return self.manifest
 
 @dataclass
 class PrepareDatasets:
@@ -15,6 +164,15 @@ class PrepareDatasets:
     labels: str
     subset: str
     seed: int
+    runtime_config: RuntimeConfig = None
+    mode: str = 'directory'
+    shard_size: int = 1024
+    max_rss_mb: int = 0
+    rss_check_interval: int = 256
+    incremental: bool = True
+    variant_sizes: List[list] = field(default_factory=list)
+    volume_reader: VolumeReader = None
+    quarantine_manifest_path: Path = None
 
     def prepare_datasets(self):
         """
@@ -24,26 +182,44 @@ class PrepareDatasets:
             Tuple[tf.data.Dataset, tf.data.Dataset]: The prepared training and validation datasets.
 
         Raises:
-            None
+            ValueError: If the prepare mode is unknown.
         """
+        if self.mode == 'streaming':
+            return self.prepare_streaming()
+        if self.mode != 'directory':
+            raise ValueError(f"Unknown prepare mode: {self.mode}")
 
         AUTOTUNE = tf.data.AUTOTUNE
         logger.info("Loading image datasets from directory: %s", self.data_dir)
-        train_dataset, val_dataset = tf.keras.utils.image_dataset_from_directory(
-            self.data_dir,
-            validation_split=self.validation_split,
-            image_size=self.image_size,
-            batch_size=self.batch_size,
-            labels=self.labels,
-            subset=self.subset,
-            seed=self.seed,
-        )
-        self.class_names = train_dataset.class_names
+        if self.labels != 'inferred':
+            raise ValueError("Labels must be inferred from the directory structure")
+
+        # Split membership depends only on each file's content, so adding images never moves existing ones
+        self.class_names = self._class_names()
+        splits = {'train': ([], []), 'val': ([], [])}
+        for relative_path, label in self._walk(self.class_names):
+            path = os.path.join(self.data_dir, relative_path)
+            data = self._read(path)
+            if data is None:
+                continue
+            content_hash = hashlib.sha256(data).hexdigest()
+            paths, labels = splits[self.assign_split(self._split_key(relative_path, content_hash))]
+            paths.append(path)
+            labels.append(label)
+        logger.info(f"Found {len(splits['train'][0])} training and {len(splits['val'][0])} validation images")
+        self._save_split_counts({split: {name: labels.count(label) for label, name in enumerate(self.class_names)}
+                                 for split, (_, labels) in splits.items()})
+        train_dataset = self._directory_dataset(*splits['train'])
+        val_dataset = self._directory_dataset(*splits['val'])
         logger.info("Saving class names to file: %s/class_names.txt", self.save_dir)
         with open(self.save_dir + '/class_names.txt', 'w') as f:
             f.write('\n'.join(self.class_names))
 
         logger.info("Class names: %s", self.class_names)
+        if self.runtime_config is not None:
+            train_dataset = train_dataset.with_options(self.runtime_config.dataset_options())
+            val_dataset = val_dataset.with_options(self.runtime_config.dataset_options())
+
         logger.info("Prefetching datasets")
         train_dataset = train_dataset.prefetch(buffer_size=AUTOTUNE)
         val_dataset = val_dataset.prefetch(buffer_size=AUTOTUNE)
@@ -53,4 +229,305 @@ class PrepareDatasets:
         val_dataset.save(self.save_dir + '/val_dataset')
 
         logger.info("Datasets prepared successfully")
-        return train_dataset, val_dataset
\ No newline at end of file
+        return train_dataset, val_dataset
+
+    def _class_names(self) -> list:
+        return sorted(entry.name for entry in os.scandir(self.data_dir) if entry.is_dir())
+
+    def _save_split_counts(self, counts: dict) -> None:
+        """
+        Writes the number of images of each class in each split to `split_counts.json`, from which class
+        balancing sizes its epochs when the length of the training dataset is unknown.
+        """
+        os.makedirs(self.save_dir, exist_ok=True)
+        counts_path = os.path.join(self.save_dir, 'split_counts.json')
+        with open(counts_path + '.tmp', 'w') as f:
+            json.dump(counts, f, indent=2)
+        os.replace(counts_path + '.tmp', counts_path)
+
+    def _directory_dataset(self, paths: list, labels: list) -> tf.data.Dataset:
+        """
+        Builds a batched dataset of resized float32 images from a list of files, shuffled once with `seed`.
+        With resolution variants, each element holds a dict of the images keyed by size.
+        """
+        def decode_file(path):
+            return tf.io.decode_image(tf.io.read_file(path), channels=3, expand_animations=False)
+
+        def read_slice(name):
+            # An empty slice is read as a zero-size image, which is filtered out below
+            image = self.volume_reader.read_slice(name.decode())
+            return np.zeros((0, 0), np.uint8) if image is None else image
+
+        def decode_slice(path):
+            # Volume slices are read and windowed by the volume reader as uint8 arrays, without a PNG round trip
+            image = tf.numpy_function(read_slice, [path], tf.uint8)
+            image.set_shape([None, None])
+            return tf.image.grayscale_to_rgb(image[..., None])
+
+        def decode(path):
+            if self.volume_reader is None:
+                return decode_file(path)
+            pattern = '.*(' + '|'.join(extension.replace('.', r'\.') for extension in VOLUME_EXTENSIONS) + ')(#.*)?'
+            return tf.cond(tf.strings.regex_full_match(tf.strings.lower(path), pattern),
+                           lambda: decode_slice(path), lambda: decode_file(path))
+
+        def resize(image, label):
+            if not self.variant_sizes:
+                return tf.image.resize(image, self.image_size), label
+            # Every resolution variant is resized from the same decoded image
+            sizes = [self.image_size, *self.variant_sizes]
+            return {size_key(size): tf.image.resize(image, size) for size in sizes}, label
+
+        # The explicit dtype keeps an empty split a dataset of strings
+        dataset = tf.data.Dataset.from_tensor_slices((tf.constant(paths, tf.string), np.array(labels, dtype=np.int32)))
+        if paths:
+            dataset = dataset.shuffle(len(paths), seed=self.seed, reshuffle_each_iteration=False)
+        dataset = dataset.map(lambda path, label: (decode(path), label), num_parallel_calls=tf.data.AUTOTUNE)
+        if self.volume_reader is not None:
+            # Slices that became empty since they were listed are dropped here, not reported as unreadable
+            dataset = dataset.filter(lambda image, label: tf.size(image) > 0)
+        # Files that became unreadable after the last verification are dropped instead of failing the stage
+        dataset = dataset.map(resize, num_parallel_calls=tf.data.AUTOTUNE).ignore_errors(log_warning=True)
+        return dataset.batch(self.batch_size)
+
+    def _walk(self, class_names: list) -> Iterator[Tuple[str, int]]:
+        """
+        Lazily yields the image files under `data_dir` with their label, one class directory at a time
+        in round-robin, so that shards mix the classes without ever listing the whole tree. With a volume
+        reader, every slice of a NIfTI volume or multi-frame DICOM file is yielded as one image, listed
+        from the header only. Files in the quarantine manifest are left out.
+
+        Yields:
+            Tuple[str, int]: The path of the image relative to `data_dir` and its class index.
+        """
+        excluded = quarantined_paths(self.quarantine_manifest_path, self.data_dir)
+        if excluded:
+            logger.info(f"Excluding {len(excluded)} quarantined files")
+
+        def walk_class(label):
+            class_dir = os.path.join(self.data_dir, class_names[label])
+            for root, dirs, files in os.walk(class_dir):
+                dirs.sort()
+                for name in sorted(files):
+                    path = os.path.join(root, name)
+                    relative_path = os.path.relpath(path, self.data_dir)
+                    if relative_path in excluded:
+                        continue
+                    if name.lower().endswith(IMAGE_EXTENSIONS):
+                        yield relative_path, label
+                    elif self.volume_reader is not None and name.lower().endswith(VOLUME_EXTENSIONS):
+                        try:
+                            slice_paths = list(self.volume_reader.slice_paths(path, relative_path))
+                        except (OSError, ValueError, ImportError) as e:
+                            logger.warning(f"Skipping unreadable volume {path}: {e}")
+                            continue
+                        for slice_path in slice_paths:
+                            yield slice_path, label
+
+        walkers = [walk_class(label) for label in range(len(class_names))]
+        while walkers:
+            for walker in list(walkers):
+                item = next(walker, None)
+                if item is None:
+                    walkers.remove(walker)
+                else:
+                    yield item
+
+    def _read(self, path: str) -> bytes:
+        """
+        Reads the bytes of one image: the file itself, or a PNG of the windowed slice of a volume.
+
+        Returns:
+            bytes: The image, or None for an empty slice skipped by the volume reader.
+        """
+        if self.volume_reader is not None:
+            return self.volume_reader.read_item(path)
+        with open(path, 'rb') as f:
+            return f.read()
+
+    def _split_key(self, relative_path: str, content_hash: str) -> str:
+        """
+        The key an image is split by: its content hash, or for volume slices the volume, and for DICOM
+        files their series directory, so that the slices of one scan never straddle both splits.
+        """
+        if self.volume_reader is None or not is_volume(relative_path):
+            return content_hash
+        volume_path = split_slice_path(relative_path)[0]
+        return os.path.dirname(volume_path) if volume_path.lower().endswith('.dcm') else volume_path
+
+    def assign_split(self, key: str) -> str:
+        """
+        Assigns an image to the train or validation split from a hash of its key, so that the
+        assignment needs no global shuffle and does not depend on the other files.
+
+        Args:
+            key (str): The identifier of the image, normally the hash of its content.
+
+        Returns:
+            str: 'train' or 'val'.
+        """
+        digest = hashlib.sha256(key.encode()).digest()
+        return 'val' if int.from_bytes(digest[:8], 'big') / 2 ** 64 < self.validation_split else 'train'
+
+    def _encode(self, data: bytes, relative_path: str, label: int) -> bytes:
+        """
+        Decodes one image, resizes it to the full size and to every resolution variant, and serialises
+        it as a `tf.train.Example` with one PNG payload per size.
+        """
+        def png(img, size):
+            buffer = io.BytesIO()
+            img.resize((size[1], size[0]), Image.BILINEAR).save(buffer, format='PNG')
+            return tf.train.Feature(bytes_list=tf.train.BytesList(value=[buffer.getvalue()]))
+
+        with Image.open(io.BytesIO(data)) as img:
+            img = img.convert('RGB')
+            feature = {'image': png(img, self.image_size)}
+            for size in self.variant_sizes:
+                feature[f'image_{size_key(size)}'] = png(img, size)
+        feature['label'] = tf.train.Feature(int64_list=tf.train.Int64List(value=[label]))
+        feature['path'] = tf.train.Feature(bytes_list=tf.train.BytesList(value=[relative_path.encode()]))
+        return tf.train.Example(features=tf.train.Features(feature=feature)).SerializeToString()
+
+    def _check_memory(self, writers: dict) -> None:
+        """
+        Enforces `max_rss_mb`: flushes the shard writers and collects garbage when the process is over
+        the limit, and stops the stage if that does not bring it back under.
+
+        Raises:
+            MemoryError: If the resident set size stays above `max_rss_mb`.
+        """
+        if not self.max_rss_mb or get_rss_mb() <= self.max_rss_mb:
+            return
+        for writer in writers.values():
+            writer.flush()
+        gc.collect()
+        rss = get_rss_mb()
+        if rss > self.max_rss_mb:
+            raise MemoryError(f"Prepare stage uses {rss:.0f} MB, above max_rss_mb={self.max_rss_mb}")
+
+    def prepare_streaming(self):
+        """
+        Prepares the datasets without holding the file listing or the decoded images in memory. The tree
+        is walked lazily, each image is assigned to a split from a hash of its content and written to
+        fixed-size TFRecord shards, and only one encoded image is alive at a time.
+
+        Every ingested file is recorded in `ingest_index.sqlite`. With `incremental`, files already in the
+        index (same size and modification time) are skipped without being read, and new files are
+        appended to new shards, so an ingest costs in proportion to the new data and existing shards and
+        split memberships never change. Shards are append-only: images that were modified or deleted
+        since they were ingested stay in the shards until a full re-prepare (`incremental: False`).
+
+        Returns:
+            Tuple[tf.data.Dataset, tf.data.Dataset]: The prepared training and validation datasets.
+
+        Raises:
+            ValueError: If labels are not inferred from the directory structure, or if the classes or
+                image size changed since the existing shards were written.
+            MemoryError: If the resident set size exceeds `max_rss_mb`.
+        """
+        try:
+            if self.labels != 'inferred':
+                raise ValueError("The streaming prepare mode only supports labels inferred from directories")
+
+            class_names = self._class_names()
+            manifest = {
+                'class_names': class_names,
+                'image_size': list(self.image_size),
+                'variants': [size_key(size) for size in self.variant_sizes],
+                'batch_size': self.batch_size,
+            }
+            dataset_dirs = {split: os.path.join(self.save_dir, f'{split}_dataset') for split in ('train', 'val')}
+            existing = {split: _read_manifest(dataset_dir) for split, dataset_dir in dataset_dirs.items()}
+            index = _connect_index(os.path.join(self.save_dir, 'ingest_index.sqlite'))
+
+            incremental = self.incremental and all(existing.values())
+            if incremental:
+                for key in ('class_names', 'image_size', 'variants'):
+                    if existing['train'].get(key, []) != manifest[key]:
+                        raise ValueError(f"{key} changed from {existing['train'][key]} to {manifest[key]}, "
+                                         f"set prepare_datasets.incremental to False to re-prepare")
+            else:
+                for dataset_dir in dataset_dirs.values():
+                    shutil.rmtree(dataset_dir, ignore_errors=True)
+                index.execute('DELETE FROM files')
+                existing = {split: None for split in dataset_dirs}
+
+            with open(os.path.join(self.save_dir, 'class_names.txt'), 'w') as f:
+                f.write('\n'.join(class_names))
+            logger.info("Class names: %s", class_names)
+
+            writers = {
+                split: _ShardWriter(dataset_dir, self.shard_size, manifest, existing[split])
+                for split, dataset_dir in dataset_dirs.items()
+            }
+            counts = {'added': 0, 'unchanged': 0, 'duplicates': 0, 'modified': 0, 'skipped': 0}
+            for index_position, (relative_path, label) in enumerate(self._walk(class_names)):
+                path = os.path.join(self.data_dir, relative_path)
+                # Slices of a volume are unchanged as long as the volume file is
+                stat = os.stat(split_slice_path(path)[0])
+                row = index.execute('SELECT size, mtime_ns FROM files WHERE path = ?', (relative_path,)).fetchone()
+                if row is not None and tuple(row) == (stat.st_size, stat.st_mtime_ns):
+                    counts['unchanged'] += 1
+                    continue
+
+                try:
+                    data = self._read(path)
+                except (OSError, ValueError) as e:
+                    counts['skipped'] += 1
+                    logger.warning(f"Skipping unreadable image {relative_path}: {e}")
+                    continue
+                if data is None:
+                    counts['skipped'] += 1
+                    continue
+                content_hash = hashlib.sha256(data).hexdigest()
+                split = self.assign_split(self._split_key(relative_path, content_hash))
+                shard = None
+                if index.execute('SELECT 1 FROM files WHERE content_hash = ?', (content_hash,)).fetchone():
+                    # Same content under another name, already in the shards
+                    counts['duplicates'] += 1
+                else:
+                    try:
+                        example = self._encode(data, relative_path, label)
+                    except (OSError, ValueError) as e:
+                        counts['skipped'] += 1
+                        logger.warning(f"Skipping unreadable image {relative_path}: {e}")
+                        continue
+                    shard = writers[split].write(example)
+                    counts['modified' if row is not None else 'added'] += 1
+
+                index.execute('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?)',
+                              (relative_path, content_hash, split, label, shard, stat.st_size, stat.st_mtime_ns))
+                if index_position % self.rss_check_interval == 0:
+                    self._check_memory(writers)
+
+            # The index only records the new files once their shards are complete and listed in the manifests
+            manifests = {split: writer.close() for split, writer in writers.items()}
+            index.commit()
+            split_counts = {split: {name: 0 for name in class_names} for split in dataset_dirs}
+            for split, label, count in index.execute(
+                    'SELECT split, label, COUNT(*) FROM files WHERE shard IS NOT NULL GROUP BY split, label'):
+                split_counts[split][class_names[label]] = count
+            self._save_split_counts(split_counts)
+            index.close()
+
+            report = {
+                'mode': 'streaming',
+                'incremental': incremental,
+                'examples': {split: manifest['num_examples'] for split, manifest in manifests.items()},
+                'shards': {split: len(manifest['shards']) for split, manifest in manifests.items()},
+                **counts,
+                'peak_rss_mb': get_peak_rss_mb(),
+                'max_rss_mb': self.max_rss_mb,
+            }
+            if counts['modified']:
+                logger.warning(f"{counts['modified']} images changed since they were ingested; the old versions "
+                               f"stay in the shards until a full re-prepare")
+            with open(os.path.join(self.save_dir, 'prepare_report.json'), 'w') as f:
+                json.dump(report, f, indent=2)
+            logger.info(f"Added {counts['added']} images ({counts['unchanged']} unchanged), now {report['examples']} "
+                        f"images in {report['shards']} shards, peak RSS {report['peak_rss_mb']:.0f} MB")
+
+            return load_dataset(dataset_dirs['train']), load_dataset(dataset_dirs['val'])
+        except Exception as e:
+            logger.error(f'Error preparing streaming datasets: {e}')
+            raise e
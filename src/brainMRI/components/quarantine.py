@@ -0,0 +1,242 @@
+import os
+import json
+import time
+import queue
+import shutil
+import multiprocessing
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Dict, Iterator, List, Set
+from PIL import Image
+from brainMRI.components.volumes import VOLUME_EXTENSIONS, VolumeReader
+from brainMRI.logging import attach_to_parent, logger, process_log_queue
+
+IMAGE_EXTENSIONS = ('.bmp', '.gif', '.jpeg', '.jpg', '.png')
+
+# The formats tf.io.decode_image can decode
+DECODABLE_FORMATS = ('BMP', 'GIF', 'JPEG', 'PNG')
+
+
+def verify_file(path: str, volume_reader: VolumeReader = None) -> None:
+    """
+    Fully decodes one image, or every slice of one volume, as the prepare stage will.
+
+    Raises:
+        Exception: Whatever the decoder raises for a corrupt, truncated or undecodable file.
+    """
+    if volume_reader is not None and path.lower().endswith(VOLUME_EXTENSIONS):
+        for slice_path in volume_reader.slice_paths(path, path):
+            volume_reader.read_slice(slice_path)
+        return
+    with Image.open(path) as image:
+        if image.format not in DECODABLE_FORMATS:
+            raise ValueError(f"{image.format} images cannot be decoded by TensorFlow")
+        # Only decoding every pixel catches a truncated file, Image.verify() reads the structure alone
+        image.load()
+
+
+def _verify_worker(slot: int, tasks, results, volume_reader: VolumeReader, log_queue) -> None:
+    """
+    Announces itself on `results` once started, then verifies the files sent on `tasks` one at a time
+    until it receives None, and reports each one on `results` as (slot, index, error, fatal).
+    """
+    attach_to_parent(log_queue)
+    results.put((slot, None, None, False))
+    while True:
+        task = tasks.get()
+        if task is None:
+            return
+        index, path = task
+        try:
+            verify_file(path, volume_reader)
+            results.put((slot, index, None, False))
+        except ImportError as e:
+            # A missing decoder says nothing about the file, so it stops the verification instead
+            results.put((slot, index, str(e), True))
+        except Exception as e:
+            results.put((slot, index, f"{type(e).__name__}: {e}", False))
+
+
+def load_manifest(manifest_path: Path) -> dict:
+    """
+    Returns:
+        dict: The quarantine manifest, or an empty one if there is none yet.
+    """
+    if not manifest_path or not os.path.exists(manifest_path):
+        return {'files': {}}
+    with open(manifest_path, 'r') as f:
+        return json.load(f)
+
+
+def quarantined_paths(manifest_path: Path, data_dir: Path) -> Set[str]:
+    """
+    Lists the quarantined files still under `data_dir`. A file modified since it was quarantined, for
+    instance uploaded again, is not excluded any more and is verified again by the next run.
+
+    Returns:
+        Set[str]: The paths of the files to exclude, relative to `data_dir`.
+    """
+    excluded = set()
+    for relative_path, entry in load_manifest(manifest_path)['files'].items():
+        try:
+            stat = os.stat(os.path.join(data_dir, relative_path))
+        except OSError:
+            continue
+        if (stat.st_size, stat.st_mtime_ns) == (entry['size'], entry['mtime_ns']):
+            excluded.add(relative_path)
+    return excluded
+
+
+@dataclass
+class FileVerifier:
+    """
+    Fully decodes every image and volume under `data_dir` in parallel worker processes, each file with a
+    `timeout` in seconds, and records the files that fail in a quarantine manifest. A worker that hangs
+    or crashes on a file is killed and replaced, so one bad file never stops the verification. With
+    `move`, quarantined files are also moved from `data_dir` to `quarantine_dir`.
+    """
+    data_dir: Path
+    manifest_path: Path
+    quarantine_dir: Path
+    workers: int = 0
+    timeout: float = 30.0
+    move: bool = False
+    volume_reader: VolumeReader = None
+
+    def _files(self) -> Iterator[str]:
+        extensions = IMAGE_EXTENSIONS + (VOLUME_EXTENSIONS if self.volume_reader is not None else ())
+        for root, dirs, files in os.walk(self.data_dir):
+            dirs.sort()
+            for name in sorted(files):
+                if name.lower().endswith(extensions):
+                    yield os.path.relpath(os.path.join(root, name), self.data_dir)
+
+    def _run(self, paths: List[str], workers: int) -> Dict[str, str]:
+        """
+        Verifies the files with a pool of worker processes, handing each worker one file at a time so
+        that the file it is stuck on is known. A worker gets its first file once it has started, so its
+        start-up time does not count against the timeout.
+
+        Returns:
+            Dict[str, str]: The reason each failed file failed, keyed by its relative path.
+
+        Raises:
+            ImportError: If a decoder needed for the files is not installed.
+        """
+        context = multiprocessing.get_context('spawn')
+        results = context.Queue()
+        tasks = iter(enumerate(paths))
+        slots = {}
+        failures = {}
+
+        def start(slot):
+            inbox = context.Queue()
+            process = context.Process(target=_verify_worker, args=(slot, inbox, results, self.volume_reader,
+                                                                              process_log_queue()), daemon=True)
+            process.start()
+            # Until the worker announces itself, its task is pending and only a crash is checked for
+            slots[slot] = {'process': process, 'inbox': inbox, 'task': (None, None), 'started': None}
+
+        def assign(slot):
+            task = next(tasks, None)
+            slots[slot]['task'] = task
+            if task is None:
+                slots[slot]['inbox'].put(None)
+                return
+            slots[slot]['inbox'].put((task[0], os.path.join(self.data_dir, task[1])))
+            slots[slot]['started'] = time.monotonic()
+
+        for slot in range(workers):
+            start(slot)
+
+        done = 0
+        log_every = max(1, len(paths) // 10)
+        next_log = log_every
+        try:
+            while any(state['task'] is not None for state in slots.values()):
+                try:
+                    result = results.get(timeout=1.0)
+                except queue.Empty:
+                    result = None
+
+                if result is not None:
+                    slot, index, error, fatal = result
+                    state = slots[slot]
+                    # A result for another task came from a worker of this slot that was already replaced
+                    if state['task'] is not None and state['task'][0] == index:
+                        if fatal:
+                            raise ImportError(error)
+                        if error:
+                            failures[state['task'][1]] = error
+                        if index is not None:
+                            done += 1
+                        assign(slot)
+
+                now = time.monotonic()
+                for slot, state in list(slots.items()):
+                    if state['task'] is None:
+                        continue
+                    if state['started'] is not None and now - state['started'] > self.timeout:
+                        reason = f"Timed out after {self.timeout}s"
+                    elif not state['process'].is_alive():
+                        reason = f"Decoder crashed with exit code {state['process'].exitcode}"
+                    else:
+                        continue
+                    if state['started'] is None:
+                        raise RuntimeError(f"Verification worker exited on start-up with code {state['process'].exitcode}")
+                    failures[state['task'][1]] = reason
+                    done += 1
+                    state['process'].kill()
+                    start(slot)
+
+                if done >= next_log:
+                    next_log += log_every
+                    logger.info(f"Verified {done}/{len(paths)} files, {len(failures)} failed")
+        finally:
+            for state in slots.values():
+                if state['process'].is_alive():
+                    state['process'].kill()
+                state['process'].join()
+        return failures
+
+    def verify(self) -> Dict[str, str]:
+        """
+        Verifies every file and rewrites the quarantine manifest. Entries of files moved out by earlier
+        runs are kept; entries of files that now decode are dropped.
+
+        Returns:
+            Dict[str, str]: The reason each quarantined file failed, keyed by its path relative to `data_dir`.
+        """
+        try:
+            paths = list(self._files())
+            workers = min(self.workers or os.cpu_count() or 1, max(1, len(paths)))
+            logger.info(f"Verifying {len(paths)} files with {workers} workers, {self.timeout}s per file")
+            failures = self._run(paths, workers)
+
+            files = {path: entry for path, entry in load_manifest(self.manifest_path)['files'].items()
+                     if entry.get('moved_to')}
+            detected_at = datetime.now(timezone.utc).isoformat()
+            for relative_path, reason in sorted(failures.items()):
+                path = os.path.join(self.data_dir, relative_path)
+                stat = os.stat(path)
+                entry = {'reason': reason, 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns,
+                         'detected_at': detected_at, 'moved_to': None}
+                if self.move:
+                    entry['moved_to'] = os.path.join(self.quarantine_dir, relative_path)
+                    os.makedirs(os.path.dirname(entry['moved_to']), exist_ok=True)
+                    shutil.move(path, entry['moved_to'])
+                files[relative_path] = entry
+                logger.warning(f"Quarantined {relative_path}: {reason}")
+
+            manifest = {'data_dir': str(self.data_dir), 'verified': len(paths), 'failed': len(failures), 'files': files}
+            os.makedirs(os.path.dirname(self.manifest_path) or '.', exist_ok=True)
+            temporary_path = f'{self.manifest_path}.tmp'
+            with open(temporary_path, 'w') as f:
+                json.dump(manifest, f, indent=2)
+            os.replace(temporary_path, self.manifest_path)
+            logger.info(f"Verified {len(paths)} files, {len(failures)} quarantined, manifest saved to: {self.manifest_path}")
+            return failures
+        except Exception as e:
+            logger.error(f'Error verifying files: {e}')
+            raise e
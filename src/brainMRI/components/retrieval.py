@@ -0,0 +1,530 @@
+import os
+import json
+import time
+import queue
+import shutil
+import sqlite3
+import hashlib
+import threading
+from dataclasses import dataclass
+from pathlib import Path
+from typing import List, Optional, Tuple
+import numpy as np
+from brainMRI.components.quarantine import IMAGE_EXTENSIONS
+from brainMRI.logging import logger
+
+
+def _normalise(vectors: np.ndarray) -> np.ndarray:
+    vectors = np.asarray(vectors, dtype=np.float32)
+    return vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+
+
+def pooled_embedding_model(model):
+    """
+    Builds a model with two outputs from a model built by BaseModel: its prediction and the pooled
+    embedding its GlobalAveragePooling2D layer feeds to the classifier, so that one forward pass gives both.
+
+    Args:
+        model (tf.keras.Model): The classifier.
+
+    Returns:
+        tf.keras.Model: The model returning [prediction, embedding].
+
+    Raises:
+        ValueError: If the model has no GlobalAveragePooling2D layer.
+    """
+    import tensorflow as tf
+
+    pooling = next((layer for layer in model.layers
+                    if isinstance(layer, tf.keras.layers.GlobalAveragePooling2D)), None)
+    if pooling is None:
+        raise ValueError("Embeddings need a model with a GlobalAveragePooling2D head, as built by BaseModel")
+    return tf.keras.Model(model.input, [model.output, pooling.output])
+
+
+def _merge_top_k(best, similarities: np.ndarray, rows: np.ndarray, k: int):
+    """
+    Merges a block of (query, row) similarities into the running top `k` rows of each query.
+    """
+    rows = np.broadcast_to(rows, similarities.shape)
+    if best is not None:
+        similarities = np.concatenate([best[0], similarities], axis=1)
+        rows = np.concatenate([best[1], rows], axis=1)
+    if similarities.shape[1] > k:
+        keep = np.argpartition(-similarities, k - 1, axis=1)[:, :k]
+        similarities, rows = np.take_along_axis(similarities, keep, 1), np.take_along_axis(rows, keep, 1)
+    return similarities, rows
+
+
+@dataclass
+class SimilarCaseIndex:
+    """
+    Finds the prior scans most similar to a query image by the cosine similarity of their pooled
+    embeddings, the GlobalAveragePooling2D output of the model built by BaseModel.
+
+    Embeddings are stored normalised in a float16 matrix memory-mapped from `embeddings.f16` in
+    `root_dir`, with the name, label and source of each row in `index.sqlite`. Up to `exact_max_items`
+    rows are searched exactly with blocked matrix products; past that, an IVF index of `num_lists`
+    spherical k-means centroids searches the `num_probes` lists nearest to each query. New rows join
+    their nearest list, and the centroids are retrained once the index has grown `retrain_growth`
+    times since they were last trained. Training runs on a snapshot of the rows, so searches go on
+    while it runs.
+
+    The predictor hands scored images to `submit`, which queues them for a background thread, so
+    neither the embedding nor a retraining ever runs inside a request; when `queue_size` batches are
+    already waiting, further scored images are not indexed.
+
+    Embeddings only compare within one model, so the index belongs to the model version it was built
+    with, and queries or additions with another version raise until it is rebuilt. One process
+    writes the index at a time.
+    """
+    root_dir: Path
+    data_dir: Path
+    batch_size: int = 64
+    exact_max_items: int = 20000
+    num_lists: int = 0
+    num_probes: int = 8
+    block_rows: int = 65536
+    retrain_growth: float = 2.0
+    kmeans_iterations: int = 10
+    max_training_rows: int = 100000
+    top_k: int = 5
+    max_k: int = 100
+    queue_size: int = 256
+
+    def __post_init__(self):
+        self._lock = threading.RLock()
+        self._train_lock = threading.Lock()
+        self._embedder = None
+        self._queue = queue.Queue(self.queue_size)
+        self._worker = None
+        self._dropped = 0
+        self._open()
+
+    @property
+    def model_version(self) -> Optional[str]:
+        return self._meta['model_version']
+
+    @property
+    def count(self) -> int:
+        return self._meta['count']
+
+    def _path(self, name: str) -> str:
+        return os.path.join(self.root_dir, name)
+
+    def _open(self) -> None:
+        """
+        Opens the index files. Rows written after the last saved count, by a writer that stopped
+        half-way through an addition, are dropped.
+        """
+        os.makedirs(self.root_dir, exist_ok=True)
+        self._meta = {'model_version': None, 'dim': None, 'count': 0, 'trained_count': 0}
+        if os.path.exists(self._path('meta.json')):
+            with open(self._path('meta.json'), 'r') as f:
+                self._meta.update(json.load(f))
+
+        self._db = sqlite3.connect(self._path('index.sqlite'), check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute(
+            'CREATE TABLE IF NOT EXISTS items ('
+            'row INTEGER PRIMARY KEY, key TEXT UNIQUE, name TEXT, label TEXT, source TEXT, probability REAL, added REAL)')
+        self._db.execute('CREATE INDEX IF NOT EXISTS items_name ON items (name)')
+        self._db.execute('DELETE FROM items WHERE row >= ?', (self.count,))
+        self._db.commit()
+
+        self._embeddings = None
+        if self.count:
+            row_bytes = self._meta['dim'] * np.dtype(np.float16).itemsize
+            with open(self._path('embeddings.f16'), 'r+b') as f:
+                f.truncate(self.count * row_bytes)
+            self._embeddings = np.memmap(self._path('embeddings.f16'), dtype=np.float16, mode='r',
+                                         shape=(self.count, self._meta['dim']))
+
+        self._centroids = None
+        self._lists = {}
+        if self._meta['trained_count'] and os.path.exists(self._path('centroids.npy')):
+            self._centroids = np.load(self._path('centroids.npy'))
+            with open(self._path('lists.i32'), 'r+b') as f:
+                f.truncate(self.count * np.dtype(np.int32).itemsize)
+            self._set_lists(np.fromfile(self._path('lists.i32'), dtype=np.int32))
+
+    def _save_meta(self) -> None:
+        temporary_path = self._path('meta.json.tmp')
+        with open(temporary_path, 'w') as f:
+            json.dump(self._meta, f, indent=2)
+        os.replace(temporary_path, self._path('meta.json'))
+
+    def reset(self, model_version: str = None) -> None:
+        """
+        Empties the index, for instance to rebuild it for a new model version.
+        """
+        with self._lock:
+            self._db.close()
+            shutil.rmtree(self.root_dir, ignore_errors=True)
+            self._open()
+            self._meta['model_version'] = model_version
+            self._save_meta()
+        logger.info(f"Similar-case index reset for model version {model_version}")
+
+    def _check_version(self, serving) -> None:
+        if self.model_version is not None and self.model_version != serving.version:
+            raise ValueError(f"The similar-case index was built with model {self.model_version}, not the serving "
+                             f"model {serving.version}; rebuild it with the retrieval stage")
+
+    def embed(self, serving, images: np.ndarray) -> np.ndarray:
+        """
+        Computes the normalised pooled embeddings of preprocessed images with the serving model, through
+        its two-output embedder when it has one. Otherwise the `.keras` model is loaded, as SavedModel and
+        ONNX exports without an embedding output only expose the prediction.
+
+        Returns:
+            np.ndarray: The float32 embeddings, shaped (batch, dim).
+        """
+        import tensorflow as tf
+
+        with self._lock:
+            if self._embedder is None or self._embedder[0] != serving.version:
+                embedder = serving.embedder
+                if embedder is None:
+                    model = serving.model
+                    if not isinstance(model, tf.keras.Model):
+                        model = tf.keras.models.load_model(serving.path, safe_mode=False, compile=False)
+                    joint = pooled_embedding_model(model)
+                    embedder = lambda images: joint(images, training=False)
+                self._embedder = (serving.version, embedder)
+            embedder = self._embedder[1]
+
+        return _normalise(np.concatenate([
+            np.asarray(embedder(np.asarray(images[start:start + self.batch_size], dtype=np.float32))[1])
+            for start in range(0, len(images), self.batch_size)
+        ]))
+
+    @staticmethod
+    def key(image: np.ndarray) -> str:
+        """
+        Identifies an image by its preprocessed pixel buffer, so the same image is indexed once.
+        """
+        image = np.ascontiguousarray(image)
+        digest = hashlib.blake2b(digest_size=16)
+        digest.update(f'{image.dtype.str}|{image.shape}'.encode())
+        digest.update(memoryview(image).cast('B'))
+        return digest.hexdigest()
+
+    def _unknown(self, keys: List[str]) -> List[int]:
+        """
+        Returns the positions of the keys that are not in the index, the first of any repeated key.
+        """
+        placeholders = ','.join('?' * len(keys))
+        known = {row[0] for row in self._db.execute(f'SELECT key FROM items WHERE key IN ({placeholders})', keys)}
+        new = []
+        for index, key in enumerate(keys):
+            if key not in known:
+                known.add(key)
+                new.append(index)
+        return new
+
+    def add(self, serving, images: np.ndarray, names: List[str], labels: List[str], source: str,
+            probabilities: List[float] = None, embeddings: np.ndarray = None) -> int:
+        """
+        Embeds and appends images that are not in the index yet. The forward pass runs outside the
+        index lock, so searches are not held up by it.
+
+        Args:
+            serving (ServingModel): The model to embed the images with.
+            images (np.ndarray): The preprocessed images, shaped (batch, image_size, image_size, 3).
+            names (List[str]): A name per image, such as its path; None names it by its key.
+            labels (List[str]): The class of each image, known or predicted.
+            source (str): Where the images come from, `dataset` or `scored`.
+            probabilities (List[float], optional): The predicted positive-class probability of each image.
+            embeddings (np.ndarray, optional): The pooled embedding of each image, from the forward pass that
+                scored it, instead of embedding the images again.
+
+        Returns:
+            int: The number of images added.
+        """
+        images = np.asarray(images)
+        keys = [self.key(image) for image in images]
+        with self._lock:
+            self._check_version(serving)
+            new = self._unknown(keys)
+        if not new:
+            return 0
+        if embeddings is not None:
+            vectors = _normalise(np.asarray(embeddings)[new])
+        else:
+            vectors = self.embed(serving, images[new])
+
+        with self._lock:
+            self._check_version(serving)
+            # Another writer may have added some of the images in the meantime
+            keep = self._unknown([keys[index] for index in new])
+            new, vectors = [new[position] for position in keep], vectors[keep]
+            if not new:
+                return 0
+
+            first_row = self.count
+            with open(self._path('embeddings.f16'), 'ab') as f:
+                f.write(vectors.astype(np.float16).tobytes())
+            if self._centroids is not None:
+                assignments = self._assign(vectors)
+                with open(self._path('lists.i32'), 'ab') as f:
+                    f.write(assignments.tobytes())
+                # Searches hold on to the lists they started with, so they are replaced rather than changed
+                lists = dict(self._lists)
+                rows = np.arange(first_row, first_row + len(new), dtype=np.int64)
+                for assignment in np.unique(assignments).tolist():
+                    lists[assignment] = np.concatenate([lists.get(assignment, np.empty(0, np.int64)),
+                                                        rows[assignments == assignment]])
+                self._lists = lists
+
+            now = time.time()
+            self._db.executemany('INSERT INTO items VALUES (?, ?, ?, ?, ?, ?, ?)', [
+                (first_row + offset, keys[index], names[index] if names and names[index] else keys[index],
+                 labels[index], source, float(probabilities[index]) if probabilities is not None else None, now)
+                for offset, index in enumerate(new)])
+            self._db.commit()
+
+            self._meta.update(model_version=serving.version, dim=int(vectors.shape[1]), count=first_row + len(new))
+            self._save_meta()
+            self._embeddings = np.memmap(self._path('embeddings.f16'), dtype=np.float16, mode='r',
+                                         shape=(self.count, self._meta['dim']))
+            retrain = self.count > self.exact_max_items and (
+                self._centroids is None or self.count >= self._meta['trained_count'] * self.retrain_growth)
+        if retrain:
+            self.train()
+        return len(new)
+
+    def submit(self, serving, images: np.ndarray, names: List[str], labels: List[str], source: str,
+               probabilities: List[float] = None, embeddings: np.ndarray = None) -> bool:
+        """
+        Queues images for `add` on the background indexing thread, which is started on first use, and
+        returns at once. The arguments are those of `add`.
+
+        Returns:
+            bool: Whether the images were queued; they are dropped when `queue_size` batches are waiting.
+        """
+        with self._lock:
+            if self._worker is None:
+                self._worker = threading.Thread(target=self._drain, name='similar-case-indexer', daemon=True)
+                self._worker.start()
+        try:
+            self._queue.put_nowait((serving, images, names, labels, source, probabilities, embeddings))
+            return True
+        except queue.Full:
+            with self._lock:
+                self._dropped += 1
+            logger.warning(f"The similar-case indexing queue is full, {len(images)} scored images not indexed")
+            return False
+
+    def _drain(self) -> None:
+        while True:
+            batch = self._queue.get()
+            try:
+                self.add(*batch)
+            except Exception as e:
+                # The prediction stands without the index; a stale index is rebuilt by the retrieval stage
+                logger.warning(f'Scored images not indexed: {e}')
+            finally:
+                self._queue.task_done()
+
+    def flush(self) -> None:
+        """
+        Waits until every queued batch has been added.
+        """
+        self._queue.join()
+
+    def _rows(self, start: int, end: int) -> np.ndarray:
+        return np.asarray(self._embeddings[start:end], dtype=np.float32)
+
+    def _assign(self, vectors: np.ndarray, centroids: np.ndarray = None) -> np.ndarray:
+        centroids = self._centroids if centroids is None else centroids
+        return np.argmax(vectors @ centroids.T, axis=1).astype(np.int32)
+
+    def _set_lists(self, assignments: np.ndarray) -> None:
+        order = np.argsort(assignments, kind='stable')
+        lists, starts = np.unique(assignments[order], return_index=True)
+        self._lists = dict(zip(lists.tolist(), np.split(order.astype(np.int64), starts[1:])))
+
+    def train(self) -> None:
+        """
+        Trains the IVF centroids with spherical k-means on a sample of the rows, then assigns every row
+        to its nearest centroid. The work runs on the rows present when it starts, without the index
+        lock; rows added in the meantime are assigned when the new lists are swapped in.
+        """
+        with self._train_lock:
+            with self._lock:
+                count, embeddings, model_version = self.count, self._embeddings, self.model_version
+            start = time.perf_counter()
+            rng = np.random.default_rng(0)
+            num_lists = min(self.num_lists or int(np.sqrt(count)), count)
+            sample_rows = np.sort(rng.choice(count, min(count, self.max_training_rows), replace=False))
+            sample = np.asarray(embeddings[sample_rows], dtype=np.float32)
+
+            centroids = sample[rng.choice(len(sample), num_lists, replace=False)]
+            for _ in range(self.kmeans_iterations):
+                assignments = np.argmax(sample @ centroids.T, axis=1)
+                sums = np.zeros_like(centroids)
+                np.add.at(sums, assignments, sample)
+                empty = np.bincount(assignments, minlength=num_lists) == 0
+                # An empty list is re-seeded with a random row so that every list stays in use
+                sums[empty] = sample[rng.choice(len(sample), int(empty.sum()))]
+                centroids = _normalise(sums)
+            assignments = [self._assign(np.asarray(embeddings[block:min(block + self.block_rows, count)],
+                                                   dtype=np.float32), centroids)
+                           for block in range(0, count, self.block_rows)]
+
+            with self._lock:
+                if self.count < count or self.model_version != model_version:
+                    # The index was reset while training
+                    return
+                assignments.extend(self._assign(self._rows(block, min(block + self.block_rows, self.count)),
+                                                centroids)
+                                   for block in range(count, self.count, self.block_rows))
+                assignments = np.concatenate(assignments)
+                np.save(self._path('centroids.npy'), centroids)
+                assignments.tofile(self._path('lists.i32'))
+                self._centroids = centroids
+                self._set_lists(assignments)
+                self._meta['trained_count'] = self.count
+                self._save_meta()
+            logger.info(f"Trained {num_lists} IVF lists over {count} embeddings "
+                        f"in {time.perf_counter() - start:.2f}s")
+
+    def search(self, vectors: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Finds the `k` rows most similar to each normalised query vector.
+
+        Returns:
+            Tuple[np.ndarray, np.ndarray]: The similarities and rows of each query, best first, shaped
+                (queries, k) or narrower when the index has fewer rows.
+        """
+        with self._lock:
+            embeddings, centroids, lists, count = self._embeddings, self._centroids, self._lists, self.count
+        vectors = np.asarray(vectors, dtype=np.float32)
+        k = min(k, count)
+        if k == 0:
+            return np.empty((len(vectors), 0), np.float32), np.empty((len(vectors), 0), np.int64)
+
+        if centroids is None:
+            best = None
+            for block in range(0, count, self.block_rows):
+                rows = np.arange(block, min(block + self.block_rows, count))
+                best = _merge_top_k(best, vectors @ np.asarray(embeddings[block:rows[-1] + 1], np.float32).T, rows, k)
+            similarities, rows = best
+        else:
+            probes = np.argsort(-(vectors @ centroids.T), axis=1)[:, :self.num_probes]
+            similarities = np.full((len(vectors), k), -np.inf, dtype=np.float32)
+            rows = np.full((len(vectors), k), -1, dtype=np.int64)
+            for index, (vector, probe) in enumerate(zip(vectors, probes)):
+                candidates = np.sort(np.concatenate([lists.get(int(list_id), np.empty(0, np.int64))
+                                                     for list_id in probe]))
+                if not len(candidates):
+                    continue
+                found = _merge_top_k(None, (np.asarray(embeddings[candidates], np.float32) @ vector)[None],
+                                     candidates[None], k)
+                similarities[index, :found[0].shape[1]], rows[index, :found[1].shape[1]] = found[0][0], found[1][0]
+
+        order = np.argsort(-similarities, axis=1)
+        return np.take_along_axis(similarities, order, 1), np.take_along_axis(rows, order, 1)
+
+    def query(self, serving, images: np.ndarray, k: int = None) -> Tuple[List[List[dict]], dict]:
+        """
+        Finds the indexed images most similar to each query image.
+
+        Args:
+            serving (ServingModel): The model to embed the query images with.
+            images (np.ndarray): The preprocessed query images.
+            k (int, optional): The number of neighbours, at most `max_k`. Defaults to `top_k`.
+
+        Returns:
+            Tuple[List[List[dict]], dict]: The neighbours of each image with their name, label, source,
+                probability and similarity, best first, and the embedding and search times in ms.
+
+        Raises:
+            ValueError: If the index was built with another model version.
+        """
+        self._check_version(serving)
+        k = min(k or self.top_k, self.max_k)
+        start = time.perf_counter()
+        vectors = self.embed(serving, images)
+        embedded = time.perf_counter()
+        similarities, rows = self.search(vectors, k)
+        searched = time.perf_counter()
+
+        found = [int(row) for row in np.unique(rows) if row >= 0]
+        with self._lock:
+            items = {}
+            for block in range(0, len(found), 500):
+                chunk = found[block:block + 500]
+                placeholders = ','.join('?' * len(chunk))
+                items.update((row[0], row[1:]) for row in self._db.execute(
+                    f'SELECT row, name, label, source, probability FROM items WHERE row IN ({placeholders})', chunk))
+        neighbours = [
+            [dict(zip(('name', 'label', 'source', 'probability'), items[int(row)]), similarity=float(similarity))
+             for similarity, row in zip(query_similarities, query_rows) if int(row) in items]
+            for query_similarities, query_rows in zip(similarities, rows)
+        ]
+        timings = {'embed_ms': (embedded - start) * 1000, 'search_ms': (searched - embedded) * 1000}
+        return neighbours, timings
+
+    def _files(self):
+        for root, dirs, files in os.walk(self.data_dir):
+            dirs.sort()
+            for name in sorted(files):
+                if name.lower().endswith(IMAGE_EXTENSIONS):
+                    yield os.path.relpath(os.path.join(root, name), self.data_dir)
+
+    def build(self, prediction) -> dict:
+        """
+        Indexes every image under `data_dir`, labelled by its class folder, in batches. Images already
+        indexed are skipped, so only new images are embedded; an index built with another model version
+        is emptied and rebuilt.
+
+        Args:
+            prediction (Prediction): The predictor whose serving model and preprocessing are used.
+
+        Returns:
+            dict: The index statistics.
+        """
+        try:
+            serving = prediction.serving
+            if self.model_version is not None and self.model_version != serving.version:
+                logger.warning(f"Rebuilding the similar-case index of model {self.model_version} "
+                               f"for model {serving.version}")
+                self.reset(serving.version)
+
+            with self._lock:
+                indexed = {row[0] for row in self._db.execute("SELECT name FROM items WHERE source = 'dataset'")}
+            paths = [path for path in self._files() if path not in indexed]
+            logger.info(f"Indexing {len(paths)} new images from {self.data_dir}, {len(indexed)} already indexed")
+
+            added = 0
+            start = time.perf_counter()
+            for batch_start in range(0, len(paths), self.batch_size):
+                batch = paths[batch_start:batch_start + self.batch_size]
+                images = np.stack([prediction.load_image(os.path.join(self.data_dir, path)) for path in batch])
+                labels = [path.split(os.sep)[0] if os.sep in path else '' for path in batch]
+                added += self.add(serving, images, batch, labels, 'dataset')
+            stats = dict(self.stats(), added=added, seconds=time.perf_counter() - start)
+            logger.info(f"Similar-case index built: {stats}")
+            return stats
+        except Exception as e:
+            logger.error(f'Error building the similar-case index: {e}')
+            raise e
+
+    def stats(self) -> dict:
+        """
+        Returns the size of the index, how it is searched and the model version it belongs to.
+        """
+        with self._lock:
+            sources = dict(self._db.execute('SELECT source, COUNT(*) FROM items GROUP BY source').fetchall())
+            return {
+                'model_version': self.model_version,
+                'items': self.count,
+                'sources': sources,
+                'dim': self._meta['dim'],
+                'search': 'ivf' if self._centroids is not None else 'exact',
+                'lists': len(self._centroids) if self._centroids is not None else 0,
+                'queued': self._queue.qsize(),
+                'dropped': self._dropped,
+            }
@@ -0,0 +1,124 @@
+import os
+import sys
+import json
+import time
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import List
+from brainMRI.logging import logger
+
+ROLES = ('prepare', 'train', 'serve', 'analyze')
+
+
+@dataclass
+class RuntimeConfig:
+    role: str
+    root_dir: Path
+    intra_op_threads: int = 0
+    inter_op_threads: int = 0
+    omp_threads: int = 0
+    onednn: bool = True
+    data_threadpool_size: int = 0
+    data_max_intra_op_parallelism: int = 0
+    cpu_affinity: List[int] = field(default_factory=list)
+
+    def __post_init__(self):
+        if self.role not in ROLES:
+            raise ValueError(f"Unknown runtime role: {self.role}, expected one of {ROLES}")
+
+    def apply(self) -> dict:
+        """
+        Applies the thread-pool, OpenMP/oneDNN and CPU affinity settings of this role to the current
+        process, and records the effective settings in `<role>.json` in `root_dir`.
+
+        The environment variables are read when TensorFlow initialises, so this should run before the
+        first TensorFlow op. If TensorFlow is already running, its thread pools cannot be resized and a
+        warning is logged instead.
+
+        Returns:
+            dict: The effective settings.
+        """
+        try:
+            tensorflow_loaded = 'tensorflow' in sys.modules
+            omp_threads = self.omp_threads or self.intra_op_threads
+            if omp_threads:
+                os.environ['OMP_NUM_THREADS'] = str(omp_threads)
+            if self.intra_op_threads:
+                os.environ['TF_NUM_INTRAOP_THREADS'] = str(self.intra_op_threads)
+            if self.inter_op_threads:
+                os.environ['TF_NUM_INTEROP_THREADS'] = str(self.inter_op_threads)
+            os.environ['TF_ENABLE_ONEDNN_OPTS'] = '1' if self.onednn else '0'
+
+            if self.cpu_affinity:
+                if hasattr(os, 'sched_setaffinity'):
+                    available = os.sched_getaffinity(0)
+                    cores = {core for core in self.cpu_affinity if core in available}
+                    if cores:
+                        os.sched_setaffinity(0, cores)
+                    else:
+                        logger.warning(f"None of the cores {self.cpu_affinity} are available, affinity not changed")
+                else:
+                    logger.warning("CPU affinity is not supported on this platform")
+
+            if tensorflow_loaded:
+                import tensorflow as tf
+                try:
+                    if self.intra_op_threads:
+                        tf.config.threading.set_intra_op_parallelism_threads(self.intra_op_threads)
+                    if self.inter_op_threads:
+                        tf.config.threading.set_inter_op_parallelism_threads(self.inter_op_threads)
+                except RuntimeError:
+                    logger.warning(f"TensorFlow is already initialised, the {self.role} thread pools keep their size")
+
+            report = self.effective()
+            report['tensorflow_loaded_before_apply'] = tensorflow_loaded
+            os.makedirs(self.root_dir, exist_ok=True)
+            report_path = os.path.join(self.root_dir, f'{self.role}.json')
+            with open(report_path, 'w') as f:
+                json.dump(report, f, indent=2)
+            logger.info(f"Runtime settings for {self.role}: {report['effective']}")
+            return report
+        except Exception as e:
+            logger.error(f'Error applying runtime settings for {self.role}: {e}')
+            raise e
+
+    def effective(self) -> dict:
+        """
+        Reads back the settings actually in force in the current process.
+
+        Returns:
+            dict: The configured and effective settings.
+        """
+        effective = {
+            'pid': os.getpid(),
+            'cpu_count': os.cpu_count(),
+            'cpu_affinity': sorted(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else None,
+            'env': {name: os.environ.get(name) for name in
+                    ('OMP_NUM_THREADS', 'TF_NUM_INTRAOP_THREADS', 'TF_NUM_INTEROP_THREADS', 'TF_ENABLE_ONEDNN_OPTS')},
+            'data_threadpool_size': self.data_threadpool_size,
+            'data_max_intra_op_parallelism': self.data_max_intra_op_parallelism,
+        }
+        if 'tensorflow' in sys.modules:
+            import tensorflow as tf
+            effective['tf_intra_op_threads'] = tf.config.threading.get_intra_op_parallelism_threads()
+            effective['tf_inter_op_threads'] = tf.config.threading.get_inter_op_parallelism_threads()
+
+        configured = {name: value for name, value in self.__dict__.items() if name != 'root_dir'}
+        return {'role': self.role, 'time': time.time(), 'configured': configured, 'effective': effective}
+
+    def dataset_options(self):
+        """
+        Builds the `tf.data` options that give this role's input pipelines a private thread pool,
+        so that they do not compete with the op thread pools.
+
+        Returns:
+            tf.data.Options: The options to apply with `dataset.with_options`.
+        """
+        import tensorflow as tf
+
+        options = tf.data.Options()
+        if self.data_threadpool_size:
+            options.threading.private_threadpool_size = self.data_threadpool_size
+        if self.data_max_intra_op_parallelism:
+            options.threading.max_intra_op_parallelism = self.data_max_intra_op_parallelism
+        return options
@@ -0,0 +1,271 @@
+import os
+import sys
+import json
+import time
+import signal
+import threading
+import multiprocessing
+from multiprocessing.connection import wait
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Dict, List
+from brainMRI.logging import attach_to_parent, logger, process_log_queue
+
+
+@dataclass
+class Stage:
+    """
+    One pipeline stage of the DAG: the pipeline class to run, and the stages it needs to have completed.
+    """
+    name: str
+    title: str
+    pipeline: type
+    after: List[str] = field(default_factory=list)
+
+
+def _run_stage(pipeline: type, title: str, cpus: int, log_queue) -> None:
+    """
+    Runs one pipeline stage in a worker process, with its thread pools sized to the cores it was given.
+    """
+    attach_to_parent(log_queue)
+    # Explicit runtime settings of the stage's role still win, RuntimeConfig only sets non-zero counts
+    for variable in ('OMP_NUM_THREADS', 'TF_NUM_INTRAOP_THREADS'):
+        os.environ.setdefault(variable, str(cpus))
+    from brainMRI.config.configuration import ConfigHandler
+
+    try:
+        logger.info(f">>>>>> stage {title} started <<<<<<")
+        pipeline(ConfigHandler()).main()
+        logger.info(f">>>>>> stage {title} completed <<<<<<\n\nx==========x")
+    except Exception as e:
+        logger.exception(e)
+        sys.exit(1)
+
+
+def _physical_memory_mb() -> int:
+    return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') // 2 ** 20
+
+
+@dataclass
+class StageScheduler:
+    """
+    Runs pipeline stages as a dependency DAG, each stage in its own process, starting every stage whose
+    dependencies have completed as soon as its declared cores and memory fit in what the running stages
+    leave of `max_cpus` and `max_memory_mb`. A stage that needs more than the whole budget runs alone.
+
+    With `fail_fast`, the first failure stops the running stages and skips the rest; otherwise only the
+    stages that depend on the failed one are skipped. Ctrl-C or SIGTERM cancels the run the same way.
+    """
+    root_dir: Path
+    max_cpus: int = 0
+    max_memory_mb: int = 0
+    fail_fast: bool = True
+    stage_resources: Dict[str, dict] = field(default_factory=dict)
+    terminate_timeout: float = 10.0
+
+    def __post_init__(self):
+        self._cancelled = threading.Event()
+
+    def cancel(self) -> None:
+        """
+        Asks a running `run` to stop its stages and skip the rest. Safe to call from any thread.
+        """
+        self._cancelled.set()
+
+    def _order(self, stages: List[Stage]) -> List[str]:
+        """
+        Orders the stages topologically, keeping the listed order among independent stages.
+
+        Raises:
+            ValueError: If a stage is listed twice, depends on an unknown stage, or the dependencies form a cycle.
+        """
+        names = [stage.name for stage in stages]
+        if len(set(names)) != len(names):
+            raise ValueError(f"Stage names must be unique: {names}")
+        for stage in stages:
+            unknown = set(stage.after) - set(names)
+            if unknown:
+                raise ValueError(f"Stage {stage.name} depends on unknown stages {sorted(unknown)}")
+
+        order, done = [], set()
+        while len(order) < len(stages):
+            ready = [stage.name for stage in stages if stage.name not in done and set(stage.after) <= done]
+            if not ready:
+                raise ValueError(f"The stage dependencies form a cycle among {sorted(set(names) - done)}")
+            order.extend(ready)
+            done.update(ready)
+        return order
+
+    def _resources(self, name: str, cpus: int, memory_mb: int) -> tuple:
+        # A declared 0 claims the whole budget; a stage that declares nothing takes one core and no memory
+        resources = self.stage_resources.get(name, {})
+        stage_cpus, stage_memory = resources.get('cpus', 1), resources.get('memory_mb')
+        return (min(stage_cpus, cpus) or cpus,
+                memory_mb if stage_memory == 0 else min(stage_memory or 0, memory_mb))
+
+    def _stop(self, running: dict, status: dict, timeline: dict, now: float) -> None:
+        for process, _, _ in running.values():
+            process.terminate()
+        for name, (process, _, _) in running.items():
+            process.join(self.terminate_timeout)
+            if process.is_alive():
+                process.kill()
+                process.join()
+            status[name] = 'cancelled'
+            timeline[name]['end'] = now
+        running.clear()
+
+    def critical_path(self, stages: List[Stage], timeline: dict) -> List[str]:
+        """
+        Follows, back from the last stage to finish, the dependency that finished last before each stage
+        started: the chain of stages that set the wall time.
+
+        Returns:
+            List[str]: The stages on the critical path, first to last.
+        """
+        after = {stage.name: stage.after for stage in stages}
+        finished = {name: times for name, times in timeline.items() if times.get('end') is not None}
+        if not finished:
+            return []
+        path = [max(finished, key=lambda name: finished[name]['end'])]
+        while True:
+            dependencies = [name for name in after[path[-1]] if name in finished]
+            if not dependencies:
+                return path[::-1]
+            path.append(max(dependencies, key=lambda name: finished[name]['end']))
+
+    def _log_timeline(self, report: dict) -> None:
+        wall = report['wall_seconds'] or 1e-9
+        width = 40
+        lines = [f"Stage timeline: wall {report['wall_seconds']:.1f}s, critical path "
+                 f"{report['critical_path_seconds']:.1f}s ({' -> '.join(report['critical_path'])})"]
+        for name, stage in report['stages'].items():
+            if stage['start'] is None:
+                lines.append(f"  {name:<20} {stage['status']}")
+                continue
+            first = int(stage['start'] / wall * width)
+            last = max(first + 1, int(stage['end'] / wall * width))
+            marker = '#' if name in report['critical_path'] else '='
+            bar = ' ' * first + marker * (last - first) + ' ' * (width - last)
+            lines.append(f"  {name:<20} |{bar}| {stage['start']:7.1f}s +{stage['seconds']:7.1f}s {stage['status']}")
+        logger.info('\n'.join(lines))
+
+    def run(self, stages: List[Stage]) -> dict:
+        """
+        Runs the stages and saves their timeline, with the critical path, to `timeline.json` in `root_dir`.
+
+        Args:
+            stages (List[Stage]): The stages, in the order to prefer among independent ones.
+
+        Returns:
+            dict: The timeline report.
+
+        Raises:
+            ValueError: If the stages do not form a DAG.
+            RuntimeError: If a stage failed or the run was cancelled.
+        """
+        order = self._order(stages)
+        self._cancelled.clear()
+        by_name = {stage.name: stage for stage in stages}
+        cpus = self.max_cpus or os.cpu_count() or 1
+        memory_mb = self.max_memory_mb or _physical_memory_mb()
+        context = multiprocessing.get_context('spawn')
+        logger.info(f"Scheduling {len(stages)} stages within {cpus} cores and {memory_mb} MB")
+
+        if threading.current_thread() is threading.main_thread():
+            previous_handler = signal.signal(signal.SIGTERM, lambda *_: self.cancel())
+        else:
+            previous_handler = None
+
+        pending = list(order)
+        running = {}
+        status = {}
+        timeline = {name: {'start': None, 'end': None} for name in order}
+        free_cpus, free_memory = cpus, memory_mb
+        start = time.monotonic()
+        try:
+            while pending or running:
+                try:
+                    if running:
+                        wait([process.sentinel for process, _, _ in running.values()], timeout=1.0)
+                    now = time.monotonic() - start
+                    for name, (process, stage_cpus, stage_memory) in list(running.items()):
+                        if process.is_alive():
+                            continue
+                        process.join()
+                        del running[name]
+                        free_cpus, free_memory = free_cpus + stage_cpus, free_memory + stage_memory
+                        timeline[name]['end'] = now
+                        status[name] = 'completed' if process.exitcode == 0 else 'failed'
+                        logger.info(f"Stage {name} {status[name]} in {now - timeline[name]['start']:.1f}s")
+                        if status[name] == 'failed' and self.fail_fast:
+                            logger.error(f"Stage {name} failed with exit code {process.exitcode}, "
+                                         f"stopping {sorted(running)} and skipping {pending}")
+                            self.cancel()
+                except KeyboardInterrupt:
+                    self.cancel()
+
+                if self._cancelled.is_set():
+                    self._stop(running, status, timeline, time.monotonic() - start)
+                    free_cpus, free_memory = cpus, memory_mb
+                    status.update({name: 'skipped' for name in pending})
+                    pending = []
+                    break
+
+                for name in list(pending):
+                    if any(status.get(dependency) in ('failed', 'skipped', 'cancelled')
+                           for dependency in by_name[name].after):
+                        status[name] = 'skipped'
+                        pending.remove(name)
+                        logger.warning(f"Skipping stage {name}, a stage it depends on did not complete")
+
+                for name in list(pending):
+                    if not all(status.get(dependency) == 'completed' for dependency in by_name[name].after):
+                        continue
+                    stage_cpus, stage_memory = self._resources(name, cpus, memory_mb)
+                    if running and (stage_cpus > free_cpus or stage_memory > free_memory):
+                        continue
+                    stage = by_name[name]
+                    process = context.Process(target=_run_stage, args=(stage.pipeline, stage.title, stage_cpus,
+                                                                           process_log_queue()), name=name)
+                    process.start()
+                    running[name] = (process, stage_cpus, stage_memory)
+                    free_cpus, free_memory = free_cpus - stage_cpus, free_memory - stage_memory
+                    timeline[name]['start'] = time.monotonic() - start
+                    pending.remove(name)
+                    logger.info(f"Stage {name} started with {stage_cpus} cores and {stage_memory} MB")
+        finally:
+            if running:
+                self._stop(running, status, timeline, time.monotonic() - start)
+            if previous_handler is not None:
+                signal.signal(signal.SIGTERM, previous_handler)
+
+        critical_path = self.critical_path(stages, timeline)
+        report = {
+            'wall_seconds': time.monotonic() - start,
+            'critical_path': critical_path,
+            'critical_path_seconds': sum(timeline[name]['end'] - timeline[name]['start'] for name in critical_path),
+            'max_cpus': cpus,
+            'max_memory_mb': memory_mb,
+            'stages': {
+                name: {
+                    'status': status.get(name, 'skipped'),
+                    'after': by_name[name].after,
+                    'start': timeline[name]['start'],
+                    'end': timeline[name]['end'],
+                    'seconds': (timeline[name]['end'] - timeline[name]['start'])
+                    if timeline[name]['start'] is not None else None,
+                }
+                for name in order
+            },
+        }
+        os.makedirs(self.root_dir, exist_ok=True)
+        with open(os.path.join(self.root_dir, 'timeline.json'), 'w') as f:
+            json.dump(report, f, indent=2)
+        self._log_timeline(report)
+
+        unfinished = {name: stage['status'] for name, stage in report['stages'].items()
+                      if stage['status'] != 'completed'}
+        if unfinished:
+            raise RuntimeError(f"The pipeline did not complete: {unfinished}")
+        return report
@@ -0,0 +1,89 @@
+import io
+import json
+import struct
+import numpy as np
+
+NPY_MAGIC = b'\x93NUMPY'
+
+# The pixel types a tensor payload may hold; values are on the 0-255 scale of decoded images
+TENSOR_DTYPES = ('uint8', 'float16', 'float32')
+
+
+def _check_dtype(dtype: np.dtype) -> np.dtype:
+    if dtype.newbyteorder('=').name not in TENSOR_DTYPES:
+        raise ValueError(f"Unsupported tensor dtype {dtype}, expected one of {TENSOR_DTYPES}")
+    return dtype
+
+
+def _view(data, shape: tuple, dtype: np.dtype, offset: int, order: str = 'C') -> np.ndarray:
+    expected = int(np.prod(shape)) * dtype.itemsize
+    if len(data) - offset != expected:
+        raise ValueError(f"The tensor holds {len(data) - offset} bytes, its shape {shape} and dtype {dtype} "
+                         f"need {expected}")
+    return np.ndarray(shape, dtype=dtype, buffer=data, offset=offset, order=order)
+
+
+def decode_tensor(data: bytes) -> np.ndarray:
+    """
+    Reads an array from a tensor payload without copying it: the array is a read-only view of `data`.
+
+    Two payloads are accepted: a NumPy `.npy` file, or a length-prefixed tensor, which is a
+    little-endian uint32 header length, a JSON header with the `dtype` and `shape`, and the raw
+    little-endian array in C order.
+
+    Args:
+        data (bytes): The payload.
+
+    Returns:
+        np.ndarray: The array.
+
+    Raises:
+        ValueError: If the payload is malformed, or its dtype is not one of `TENSOR_DTYPES`.
+    """
+    buffer = memoryview(data)
+    if bytes(buffer[:len(NPY_MAGIC)]) == NPY_MAGIC:
+        if len(buffer) < 10 or buffer[6] not in (1, 2):
+            raise ValueError("Unsupported .npy version, expected 1.0 or 2.0")
+        # Only the header is copied out to be parsed
+        length_format, start = ('<H', 10) if buffer[6] == 1 else ('<I', 12)
+        offset = start + struct.unpack_from(length_format, buffer, 8)[0]
+        header = io.BytesIO(bytes(buffer[:offset]))
+        version = np.lib.format.read_magic(header)
+        read_header = np.lib.format.read_array_header_1_0 if version[0] == 1 else np.lib.format.read_array_header_2_0
+        shape, fortran_order, dtype = read_header(header)
+        return _view(data, shape, _check_dtype(dtype), offset, 'F' if fortran_order else 'C')
+
+    if len(buffer) < 4:
+        raise ValueError("The tensor payload is too short to hold a header")
+    offset = 4 + struct.unpack_from('<I', buffer, 0)[0]
+    if offset > len(buffer):
+        raise ValueError(f"The tensor header length {offset - 4} exceeds the {len(buffer)}-byte payload")
+    try:
+        header = json.loads(bytes(buffer[4:offset]))
+        dtype = np.dtype(header['dtype']).newbyteorder('<')
+        shape = tuple(int(size) for size in header['shape'])
+    except (ValueError, KeyError, TypeError) as e:
+        raise ValueError(f"Invalid tensor header: {e}") from e
+    return _view(data, shape, _check_dtype(dtype), offset)
+
+
+def encode_tensor(array: np.ndarray, length_prefixed: bool = False) -> bytes:
+    """
+    Writes an array as a tensor payload that `decode_tensor` reads, for clients that send pixel arrays.
+
+    Args:
+        array (np.ndarray): The array.
+        length_prefixed (bool): Writes a length-prefixed tensor instead of a `.npy` file.
+
+    Returns:
+        bytes: The payload.
+    """
+    array = np.asarray(array)
+    _check_dtype(array.dtype)
+    if not length_prefixed:
+        buffer = io.BytesIO()
+        np.save(buffer, array, allow_pickle=False)
+        return buffer.getvalue()
+    array = np.ascontiguousarray(array, dtype=array.dtype.newbyteorder('<'))
+    header = json.dumps({'dtype': array.dtype.newbyteorder('=').name, 'shape': list(array.shape)}).encode()
+    return struct.pack('<I', len(header)) + header + array.tobytes()
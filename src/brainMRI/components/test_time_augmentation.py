@@ -0,0 +1,134 @@
+from dataclasses import dataclass, field
+from typing import Dict, List, Tuple
+import numpy as np
+from brainMRI.logging import logger
+
+
+@dataclass
+class TestTimeAugmentation:
+    random_flip_horizontal: bool = True
+    random_flip_vertical: bool = False
+    random_rotation: bool = True
+    random_zoom_height: bool = True
+    random_zoom_width: bool = False
+    random_rotation_factor: float = .2
+    random_zoom_height_factor: float = .2
+    random_zoom_width_factor: float = 0
+    _grids: Dict[Tuple[int, int], list] = field(default_factory=dict, init=False, repr=False)
+
+    def transforms(self) -> List[dict]:
+        """
+        Builds the deterministic counterparts of the flip, rotation and zoom transforms configured
+        for `DataAugmentation`. Rotations use half of the training range in each direction and
+        zoom uses half of the training zoom-in range, so the views stay within the training distribution.
+
+        Returns:
+            List[dict]: One transform per view, the identity view first.
+        """
+        transforms = [{'name': 'identity'}]
+        if self.random_flip_horizontal:
+            transforms.append({'name': 'flip_horizontal', 'flip_x': True})
+        if self.random_flip_vertical:
+            transforms.append({'name': 'flip_vertical', 'flip_y': True})
+        if self.random_rotation and self.random_rotation_factor:
+            # RandomRotation factors are fractions of a full turn
+            angle = self.random_rotation_factor * np.pi
+            transforms.append({'name': 'rotate_positive', 'angle': angle})
+            transforms.append({'name': 'rotate_negative', 'angle': -angle})
+        zoom_height = self.random_zoom_height_factor / 2 if self.random_zoom_height else 0
+        zoom_width = self.random_zoom_width_factor / 2 if self.random_zoom_width else 0
+        if zoom_height or zoom_width:
+            transforms.append({'name': 'zoom_in', 'zoom_y': 1 - zoom_height, 'zoom_x': 1 - zoom_width})
+        return transforms
+
+    @property
+    def num_views(self) -> int:
+        return len(self.transforms())
+
+    @staticmethod
+    def _reflect(coords: np.ndarray, size: int) -> np.ndarray:
+        """
+        Maps sampling coordinates back inside the image by reflection, matching the Keras `reflect` fill mode.
+        """
+        if size == 1:
+            return np.zeros_like(coords)
+        period = 2 * (size - 1)
+        coords = np.abs(coords) % period
+        return np.where(coords > size - 1, period - coords, coords)
+
+    def _sampling_grids(self, height: int, width: int) -> list:
+        """
+        Precomputes the bilinear sampling indices and weights of every view for one image size.
+        The grids are shared by all images, so a batch of views is produced with a few vectorised gathers.
+        """
+        if (height, width) in self._grids:
+            return self._grids[(height, width)]
+
+        ys, xs = np.meshgrid(np.arange(height, dtype=np.float32), np.arange(width, dtype=np.float32), indexing='ij')
+        cy, cx = (height - 1) / 2, (width - 1) / 2
+        grids = []
+        for transform in self.transforms():
+            if transform['name'] == 'identity':
+                grids.append(None)
+                continue
+            dy = (ys - cy) * transform.get('zoom_y', 1.0)
+            dx = (xs - cx) * transform.get('zoom_x', 1.0)
+            if transform.get('flip_y'):
+                dy = -dy
+            if transform.get('flip_x'):
+                dx = -dx
+            angle = transform.get('angle', 0.0)
+            cos, sin = np.cos(angle), np.sin(angle)
+            src_y = self._reflect(sin * dx + cos * dy + cy, height)
+            src_x = self._reflect(cos * dx - sin * dy + cx, width)
+
+            y0 = np.floor(src_y).astype(np.intp)
+            x0 = np.floor(src_x).astype(np.intp)
+            y1 = np.minimum(y0 + 1, height - 1)
+            x1 = np.minimum(x0 + 1, width - 1)
+            wy = (src_y - y0)[..., None].astype(np.float32)
+            wx = (src_x - x0)[..., None].astype(np.float32)
+            grids.append((y0, y1, x0, x1, wy, wx))
+
+        self._grids[(height, width)] = grids
+        logger.info(f"Built {len(grids)} test-time augmentation views for {height}x{width} images")
+        return grids
+
+    def views(self, images: np.ndarray) -> np.ndarray:
+        """
+        Builds all augmented views of a batch of images, stacked view-major so that the whole
+        stack can go through the model in a single forward pass.
+
+        Args:
+            images (np.ndarray): The batch of images, shaped (batch, height, width, channels).
+
+        Returns:
+            np.ndarray: The views, shaped (num_views * batch, height, width, channels).
+        """
+        images = np.asarray(images, dtype=np.float32)
+        batch, height, width, channels = images.shape
+        grids = self._sampling_grids(height, width)
+
+        views = np.empty((len(grids), batch, height, width, channels), dtype=np.float32)
+        for index, grid in enumerate(grids):
+            if grid is None:
+                views[index] = images
+                continue
+            y0, y1, x0, x1, wy, wx = grid
+            top = images[:, y0, x0] * (1 - wx) + images[:, y0, x1] * wx
+            bottom = images[:, y1, x0] * (1 - wx) + images[:, y1, x1] * wx
+            views[index] = top * (1 - wy) + bottom * wy
+        return views.reshape(len(grids) * batch, height, width, channels)
+
+    def average(self, predictions: np.ndarray, batch_size: int) -> np.ndarray:
+        """
+        Averages the model outputs of all views back to one prediction per image.
+
+        Args:
+            predictions (np.ndarray): The outputs for the stacked views, view-major.
+            batch_size (int): The number of original images.
+
+        Returns:
+            np.ndarray: The mean prediction of each image.
+        """
+        return np.asarray(predictions).reshape(-1, batch_size, *np.shape(predictions)[1:]).mean(axis=0)
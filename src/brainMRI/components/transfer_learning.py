@@ -1,9 +1,68 @@
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 import matplotlib.pyplot as plt
 import os
+import shutil
 import tensorflow as tf
 from pathlib import Path
+from typing import List
 import pickle
+from brainMRI.components.callbacks import AsyncModelCheckpoint
+from brainMRI.components.class_balancing import ClassBalancing
+from brainMRI.components.data_service import DataService
+from brainMRI.components.evaluation import REGISTRY_METRICS, Evaluation
+from brainMRI.components.model_registry import ModelRegistry
+from brainMRI.components.onnx_export import OnnxExport
+from brainMRI.components.prepare_datasets import load_dataset
+from brainMRI.components.retrieval import pooled_embedding_model
+from brainMRI.components.runtime_config import RuntimeConfig
+from brainMRI.logging import logger
+
+
+def cache_dataset(dataset: tf.data.Dataset, path: str) -> tf.data.Dataset:
+    """
+    Caches a dataset to files at `path` and fills the cache with one full pass, so that later readers,
+    such as the per-class streams of class balancing, read the finished cache concurrently instead of
+    racing to write it.
+
+    Args:
+        dataset (tf.data.Dataset): The dataset to cache.
+        path (str): The cache file prefix.
+
+    Returns:
+        tf.data.Dataset: The cached dataset.
+    """
+    dataset = dataset.cache(path)
+    dataset.reduce(tf.constant(0, tf.int64), lambda count, _: count + 1)
+    return dataset
+
+
+@tf.keras.utils.register_keras_serializable(package='brainMRI')
+class LayerwiseAdam(tf.keras.optimizers.Adam):
+    """
+    Adam with a per-variable learning rate multiplier, keyed by variable path.
+    Variables without a multiplier use the base learning rate.
+    """
+
+    def __init__(self, lr_multipliers: dict = None, **kwargs):
+        super().__init__(**kwargs)
+        self.lr_multipliers = dict(lr_multipliers or {})
+
+    def build(self, var_list):
+        super().build(var_list)
+        # update_step may receive backend variables without a path, so multipliers are looked up by index
+        self._variable_multipliers = [self.lr_multipliers.get(variable.path, 1.0) for variable in var_list]
+
+    def update_step(self, gradient, variable, learning_rate):
+        multiplier = self._variable_multipliers[self._get_variable_index(variable)]
+        if multiplier != 1.0:
+            learning_rate = learning_rate * multiplier
+        super().update_step(gradient, variable, learning_rate)
+
+    def get_config(self):
+        config = super().get_config()
+        config['lr_multipliers'] = self.lr_multipliers
+        return config
+
 
 @dataclass
 class TransferLearning:
@@ -15,28 +74,305 @@ class TransferLearning:
     batch_size: int
     learning_rate: float
     callback_path: Path
+    class_balancing_config: ClassBalancing = None
+    train_dataset: tf.data.Dataset = None
+    val_dataset: tf.data.Dataset = None
+    backbone_name: str = 'vgg16'
+    fine_tune_at: int = 0
+    fine_tune_blocks: int = 0
+    fine_tune_epochs: int = 0
+    fine_tune_learning_rate: float = 1e-5
+    layerwise_lr_decay: float = 1.0
+    gradient_accumulation_steps: int = 1
+    cache_features: bool = True
+    progressive_resizing: List[dict] = field(default_factory=list)
+    model_registry: ModelRegistry = None
+    auto_promote: bool = True
+    class_names_file: Path = None
+    params_hash: str = None
+    export_saved_model: bool = True
+    onnx_export: OnnxExport = None
+    runtime_config: RuntimeConfig = None
+    evaluation: Evaluation = None
+    data_service: DataService = None
 
 
     def __post_init__(self):
-        self.train_dataset = tf.data.Dataset.load(self.train_dir)
-        self.val_dataset = tf.data.Dataset.load(self.val_dir)
+        # Set by a callback, such as a search trial's pruner, to skip the training stages and phases still to come
+        self.stop_training = False
+        # Datasets can be injected directly (e.g. cross-validation folds) instead of loaded from disk
+        self._datasets_on_disk = self.train_dataset is None and self.val_dataset is None
+        # Datasets read through the data service are loaded so that its workers can split them
+        splittable = self.data_service is not None
+        if self.train_dataset is None:
+            self.train_dataset = load_dataset(self.train_dir, splittable=splittable)
+        if self.val_dataset is None:
+            self.val_dataset = load_dataset(self.val_dir, splittable=splittable)
+        if self.runtime_config is not None:
+            self.train_dataset = self.train_dataset.with_options(self.runtime_config.dataset_options())
+            self.val_dataset = self.val_dataset.with_options(self.runtime_config.dataset_options())
         self.base_model = tf.keras.models.load_model(self.base_model_path, safe_mode=False)
         with open(self.callback_path, 'rb') as handle:
             self.callbacks = pickle.load(handle)
 
-    def train(self):
+    def train(self, initial_epoch: int = 0):
+        """
+        Trains the model with a two-phase schedule. Phase one trains the classification head on a
+        frozen backbone for `epochs` epochs; phase two unfreezes the top of the backbone and fine-tunes
+        it for `fine_tune_epochs` more epochs at a lower learning rate. A callback that sets `stop_training`
+        ends training after the current stage or phase.
+
+        Args:
+            initial_epoch (int): The epoch to resume training from. Resuming past `epochs` skips phase one.
+        """
+        self.history = None
+        self.stop_training = False
+        if self.fine_tune_epochs > 0:
+            # Fails before phase one on a fine-tuning layer outside the backbone
+            self._fine_tune_start(self.base_model.get_layer(self.backbone_name))
+        if self.data_service is not None and self._datasets_on_disk:
+            self.data_service.start()
+        try:
+            if initial_epoch < self.epochs:
+                self.train_head(initial_epoch)
+            if self.fine_tune_epochs > 0 and not self.stop_training:
+                self.fine_tune(max(initial_epoch, self.epochs))
+        finally:
+            if self.data_service is not None:
+                self.data_service.stop()
+        self.save_model(self.base_model)
+
+    def _balance(self, dataset: tf.data.Dataset, batch_size: int = None):
+        """
+        Applies the class balancing configuration to a training dataset.
+
+        Returns:
+            Tuple[tf.data.Dataset, Optional[int], Optional[dict]]: The dataset, steps per epoch and class weights.
+        """
+        if self.class_balancing_config is None:
+            return dataset, None, None
+        dataset, steps_per_epoch = self.class_balancing_config.balance(dataset, batch_size or self.batch_size)
+        return dataset, steps_per_epoch, self.class_balancing_config.get_class_weights()
+
+    def _distribute(self, dataset: tf.data.Dataset) -> tf.data.Dataset:
+        """
+        Runs the input pipeline of a dataset on the data service workers when there is a data service.
+        Injected datasets, such as cross-validation folds held in memory, are always read locally.
+        """
+        if self.data_service is None or not self._datasets_on_disk:
+            return dataset
+        return self.data_service.distribute(dataset)
+
+    def _merge_history(self, history: tf.keras.callbacks.History) -> None:
+        """
+        Appends the history of a training phase to the history of the previous phases.
+        """
+        if self.history is None:
+            self.history = history
+            return
+        for key, values in history.history.items():
+            self.history.history.setdefault(key, []).extend(values)
+
+    def _resolution_schedule(self, initial_epoch: int = 0) -> list:
+        """
+        Splits the phase one epochs into the progressive-resizing stages followed by a full-size stage.
+        Stages are clipped to `epochs`, and stages that end before `initial_epoch` are skipped.
+
+        Returns:
+            List[Tuple[int, int, Optional[list], int]]: The first epoch, end epoch, [height, width]
+            (None for the full size) and batch size of each stage.
+        """
+        stages, start = [], 0
+        for stage in self.progressive_resizing:
+            image_size = stage['image_size']
+            if isinstance(image_size, int):
+                image_size = [image_size, image_size]
+            end = min(start + stage['epochs'], self.epochs)
+            stages.append((start, end, list(image_size), stage.get('batch_size', self.batch_size)))
+            start = end
+        stages.append((start, self.epochs, None, self.batch_size))
+        return [(max(start, initial_epoch), end, image_size, batch_size)
+                for start, end, image_size, batch_size in stages if end > max(start, initial_epoch)]
+
+    def _dataset_at(self, split: str, image_size: list, batch_size: int) -> tf.data.Dataset:
+        """
+        Returns the train or validation dataset at a progressive-resizing resolution and batch size,
+        from the prepared resolution variant when there is one.
+        """
+        dataset = self.train_dataset if split == 'train' else self.val_dataset
+        if image_size is None and batch_size == self.batch_size:
+            return dataset
+
+        if self._datasets_on_disk:
+            dataset = load_dataset(self.train_dir if split == 'train' else self.val_dir, batch_size=batch_size,
+                                   image_size=image_size, splittable=self.data_service is not None)
+            if self.runtime_config is not None:
+                dataset = dataset.with_options(self.runtime_config.dataset_options())
+            return dataset
+
+        dataset = dataset.unbatch()
+        if image_size is not None:
+            dataset = dataset.map(lambda image, label: (tf.image.resize(image, image_size), label),
+                                  num_parallel_calls=tf.data.AUTOTUNE)
+        return dataset.batch(batch_size).prefetch(tf.data.AUTOTUNE)
+
+    def train_head(self, initial_epoch: int = 0):
+        """
+        Phase one: trains the classification head with the whole backbone frozen. With `cache_features`,
+        the backbone runs once per image and the head is trained on the cached feature maps, which skips
+        the backbone forward pass on every later epoch (at the cost of no augmentation in this phase).
+
+        With `progressive_resizing`, the first epochs run at lower resolutions with larger batches and
+        the remaining epochs at full size, which needs a base model built with a flexible input size.
+
+        Args:
+            initial_epoch (int): The epoch to resume training from.
+
+        Raises:
+            ValueError: If progressive resizing is configured for a fixed-size base model.
+        """
+        backbone = self.base_model.get_layer(self.backbone_name)
+        backbone.trainable = False
+        metrics = [tf.keras.metrics.BinaryAccuracy(threshold=0.5, name='accuracy')]
+        schedule = self._resolution_schedule(initial_epoch)
+        if self.progressive_resizing and self.base_model.input_shape[1] is not None:
+            raise ValueError("progressive_resizing needs a base model with a flexible input size, "
+                             "set base_model.flexible_input to True")
+
+        if not self.cache_features:
+            self.base_model.compile(
+                loss=tf.keras.losses.BinaryCrossentropy(),
+                optimizer=tf.keras.optimizers.Adam(learning_rate=self.learning_rate),
+                metrics=metrics)
+            for start, end, image_size, batch_size in schedule:
+                if self.stop_training:
+                    break
+                logger.info(f"Phase one: epochs {start}-{end} at {image_size or 'full size'}, batch size {batch_size}")
+                train_dataset, steps_per_epoch, class_weight = self._balance(
+                    self._dataset_at('train', image_size, batch_size), batch_size)
+                train_dataset = self._distribute(train_dataset)
+                history = self.base_model.fit(
+                    train_dataset,
+                    epochs=end,
+                    initial_epoch=start,
+                    steps_per_epoch=steps_per_epoch,
+                    validation_data=self._distribute(self._dataset_at('val', image_size, batch_size)),
+                    class_weight=class_weight,
+                    callbacks=self.callbacks
+                )
+                self._merge_history(history)
+            return
+
+        # The head layers are shared with the full model, so training them here trains the full model's head
+        pooling = next(layer for layer in self.base_model.layers
+                       if isinstance(layer, tf.keras.layers.GlobalAveragePooling2D))
+        classifier = self.base_model.layers[-1]
+        feature_extractor = tf.keras.Model(self.base_model.inputs, pooling.input)
+        features = tf.keras.Input(shape=feature_extractor.output.shape[1:])
+        head = tf.keras.Model(features, classifier(pooling(features)))
+
+        features_dir = os.path.join(self.root_dir, 'features')
+        shutil.rmtree(features_dir, ignore_errors=True)
+        os.makedirs(features_dir, exist_ok=True)
+
+        def extract(dataset, name):
+            return cache_dataset(dataset.map(
+                lambda image, label: (feature_extractor(image, training=False), label)
+            ), os.path.join(features_dir, name)).prefetch(tf.data.AUTOTUNE)
+
+        head.compile(
+            loss=tf.keras.losses.BinaryCrossentropy(),
+            optimizer=tf.keras.optimizers.Adam(learning_rate=self.learning_rate),
+            metrics=metrics)
+        # Checkpoints would serialise the head alone; the full model is checkpointed in phase two
+        callbacks = [callback for callback in self.callbacks
+                     if not isinstance(callback, (tf.keras.callbacks.ModelCheckpoint, AsyncModelCheckpoint))]
+        for stage, (start, end, image_size, batch_size) in enumerate(schedule):
+            if self.stop_training:
+                break
+            logger.info(f"Phase one: training the head on cached features for epochs {start}-{end} "
+                        f"at {image_size or 'full size'}, batch size {batch_size}")
+            train_features, steps_per_epoch, class_weight = self._balance(
+                extract(self._distribute(self._dataset_at('train', image_size, batch_size)), f'train_{stage}'),
+                batch_size)
+            history = head.fit(
+                train_features,
+                epochs=end,
+                initial_epoch=start,
+                steps_per_epoch=steps_per_epoch,
+                validation_data=extract(self._distribute(self._dataset_at('val', image_size, batch_size)),
+                                        f'val_{stage}'),
+                class_weight=class_weight,
+                callbacks=callbacks
+            )
+            self._merge_history(history)
+
+    def _fine_tune_start(self, backbone: tf.keras.Model) -> int:
+        """
+        Resolves the index of the first backbone layer to unfreeze, either from `fine_tune_blocks`
+        (the first layer of the top N `blockK_` groups) or from the `fine_tune_at` layer index.
+
+        Raises:
+            ValueError: If the resolved layer index is outside the backbone.
+        """
+        if self.fine_tune_blocks > 0:
+            blocks = [layer.name.split('_')[0] for layer in backbone.layers]
+            block_names = list(dict.fromkeys(name for name in blocks if name.startswith('block')))
+            first_block = block_names[-min(self.fine_tune_blocks, len(block_names))]
+            return blocks.index(first_block)
+
+        if not 0 <= self.fine_tune_at < len(backbone.layers):
+            raise ValueError(f"fine_tune_at={self.fine_tune_at} is outside the {len(backbone.layers)} layers "
+                             f"of the backbone")
+        return self.fine_tune_at
+
+    def fine_tune(self, initial_epoch: int):
+        """
+        Phase two: unfreezes the backbone from the resolved fine-tuning layer onwards and trains the
+        full model end to end. Lower blocks get geometrically smaller learning rates
+        (`layerwise_lr_decay` per block below the top one), and gradients can be accumulated over
+        several batches to bound memory.
+
+        Args:
+            initial_epoch (int): The epoch to resume training from, at or after the end of phase one.
+        """
+        backbone = self.base_model.get_layer(self.backbone_name)
+        start = self._fine_tune_start(backbone)
+        backbone.trainable = True
+        for layer in backbone.layers[:start]:
+            layer.trainable = False
+
+        block_names = list(dict.fromkeys(layer.name.split('_')[0] for layer in backbone.layers[start:]
+                                         if layer.name.startswith('block')))
+        lr_multipliers = {}
+        for layer in backbone.layers[start:]:
+            block = layer.name.split('_')[0]
+            depth = len(block_names) - 1 - block_names.index(block) if block in block_names else 0
+            for variable in layer.trainable_weights:
+                lr_multipliers[variable.path] = self.layerwise_lr_decay ** depth
+        logger.info(f"Phase two: fine-tuning {', '.join(block_names)} from layer {start} "
+                    f"({backbone.layers[start].name}) for {self.fine_tune_epochs} epochs")
+
+        optimizer_kwargs = {}
+        if self.gradient_accumulation_steps > 1:
+            optimizer_kwargs['gradient_accumulation_steps'] = self.gradient_accumulation_steps
         self.base_model.compile(
             loss=tf.keras.losses.BinaryCrossentropy(),
-            optimizer = tf.keras.optimizers.Adam(learning_rate=self.learning_rate),
+            optimizer=LayerwiseAdam(learning_rate=self.fine_tune_learning_rate, lr_multipliers=lr_multipliers,
+                                    **optimizer_kwargs),
             metrics=[tf.keras.metrics.BinaryAccuracy(threshold=0.5, name='accuracy')])
-        
-        self.history = self.base_model.fit(
-            self.train_dataset,
-            epochs=self.epochs,
-            validation_data=self.val_dataset,
+
+        train_dataset, steps_per_epoch, class_weight = self._balance(self.train_dataset)
+        history = self.base_model.fit(
+            self._distribute(train_dataset),
+            epochs=self.epochs + self.fine_tune_epochs,
+            initial_epoch=initial_epoch,
+            steps_per_epoch=steps_per_epoch,
+            validation_data=self._distribute(self.val_dataset),
+            class_weight=class_weight,
             callbacks=self.callbacks
         )
-        self.save_model(self.base_model)
+        self._merge_history(history)
 
     def save_plots(self):
         """
@@ -68,10 +404,80 @@ class TransferLearning:
 
     def save_model(self, model):
         """
-        Saves the trained model to the specified output directory.
-        
+        Saves the trained model to the specified output directory. The model is written to a temporary
+        file and renamed over `model.keras`, so readers never load a half-written file, after it is optionally
+        exported as a SavedModel and as ONNX for serving, so a reader that sees the new `model.keras` also
+        sees its exports. It is evaluated on the validation set first, so
+        the operating threshold in `evaluation.json` is in place before the model is. With a model registry
+        configured, the model is also registered as a new version and optionally promoted.
+
         Args:
             model (tf.keras.Model): The trained model to be saved.
         """
-        # Save the model
-        model.save(os.path.join(self.root_dir, 'model.keras'))
+        # The evaluation report next to the model carries the operating threshold the predictor uses
+        self.evaluation_report = None
+        evaluation_path = os.path.join(self.root_dir, 'evaluation.json')
+        if self.evaluation is not None:
+            self.evaluation_report = self.evaluation.evaluate(model, self.val_dataset, evaluation_path)
+
+        model_path = os.path.join(self.root_dir, 'model.keras')
+        tmp_path = os.path.join(self.root_dir, 'model.tmp.keras')
+        model.save(tmp_path)
+
+        # A pre-traced SavedModel lets serving skip Keras deserialisation and graph tracing. Next to `serve`,
+        # `serve_embeddings` also returns the pooled embedding, for indexing scored images in the same pass
+        export_dir = None
+        if self.export_saved_model:
+            export_dir = os.path.join(self.root_dir, 'serving')
+            tmp_export_dir = export_dir + '.tmp'
+            shutil.rmtree(tmp_export_dir, ignore_errors=True)
+            joint = pooled_embedding_model(model)
+            input_signature = [tf.TensorSpec((None,) + tuple(model.input_shape[1:]), tf.float32)]
+            archive = tf.keras.export.ExportArchive()
+            archive.track(joint)
+            archive.add_endpoint('serve', lambda images: model(images, training=False), input_signature)
+            archive.add_endpoint('serve_embeddings', lambda images: joint(images, training=False), input_signature)
+            archive.write_out(tmp_export_dir, verbose=False)
+            shutil.rmtree(export_dir, ignore_errors=True)
+            os.rename(tmp_export_dir, export_dir)
+            logger.info(f"SavedModel exported to: {export_dir}")
+
+        onnx_path = None
+        if self.onnx_export is not None:
+            onnx_path = self.onnx_export.export(model, os.path.join(self.root_dir, 'model.onnx'))
+            self.onnx_export.check_parity(model, onnx_path)
+
+        # The predictor polls model.keras to detect a new model, so it is replaced after the serving exports
+        os.replace(tmp_path, model_path)
+        logger.info(f"Model saved to: {model_path}")
+
+        if self.model_registry is None:
+            return
+
+        history = self.history.history if self.history is not None else {}
+        class_names = []
+        if self.class_names_file and os.path.exists(self.class_names_file):
+            with open(self.class_names_file, 'r') as f:
+                class_names = [line.strip() for line in f if line.strip()]
+        metadata = {
+            'val_metrics': {
+                'best_val_accuracy': float(max(history['val_accuracy'])) if history.get('val_accuracy') else None,
+                'final_val_loss': float(history['val_loss'][-1]) if history.get('val_loss') else None,
+                'epochs': len(history.get('val_loss', [])),
+            },
+            'params_hash': self.params_hash,
+            'class_names': class_names,
+        }
+        if self.evaluation_report is not None:
+            metadata['threshold'] = self.evaluation_report['threshold']
+            metadata['val_metrics'].update({name: self.evaluation_report[name] for name in REGISTRY_METRICS})
+        artifacts = {}
+        if export_dir:
+            artifacts['serving'] = export_dir
+        if onnx_path:
+            artifacts['model.onnx'] = onnx_path
+        if self.evaluation_report is not None:
+            artifacts['evaluation.json'] = evaluation_path
+        version = self.model_registry.register(model_path, metadata, artifacts=artifacts)
+        if self.auto_promote:
+            self.model_registry.promote(version)
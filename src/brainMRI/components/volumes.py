@@ -0,0 +1,333 @@
+import io
+import os
+import gzip
+import threading
+from collections import OrderedDict
+from collections.abc import Sequence
+from dataclasses import dataclass
+from typing import Iterator, List, Optional, Tuple
+import numpy as np
+from PIL import Image
+from brainMRI.logging import logger
+
+VOLUME_EXTENSIONS = ('.dcm', '.nii', '.nii.gz')
+
+# Separates a volume path from the index of one of its slices, e.g. `yes/case01.nii.gz#slice=0042`
+SLICE_SEPARATOR = '#slice='
+
+# NIfTI-1 datatype codes
+_NIFTI_DTYPES = {
+    2: np.uint8, 4: np.int16, 8: np.int32, 16: np.float32, 64: np.float64,
+    256: np.int8, 512: np.uint16, 768: np.uint32, 1024: np.int64, 1280: np.uint64,
+}
+
+
+def is_volume(path: str) -> bool:
+    return split_slice_path(path)[0].lower().endswith(VOLUME_EXTENSIONS)
+
+
+def split_slice_path(path: str) -> Tuple[str, Optional[int]]:
+    """
+    Splits a slice path into the volume file and the slice index, None for a file that is one image.
+    """
+    if SLICE_SEPARATOR in path:
+        volume_path, index = path.rsplit(SLICE_SEPARATOR, 1)
+        return volume_path, int(index)
+    return path, None
+
+
+def read_nifti_header(path: str) -> dict:
+    """
+    Parses the 348-byte NIfTI-1 header without reading any voxels.
+
+    Returns:
+        dict: The volume shape, voxel dtype, voxel spacing, data offset, intensity scaling and byte order.
+
+    Raises:
+        ValueError: If the file is not a single-file NIfTI-1 volume.
+    """
+    opener = gzip.open if path.lower().endswith('.gz') else open
+    with opener(path, 'rb') as f:
+        raw = f.read(348)
+    if len(raw) < 348:
+        raise ValueError(f"{path} is too short to be a NIfTI file")
+    byte_order = '<' if np.frombuffer(raw, '<i4', 1, 0)[0] == 348 else '>'
+    if np.frombuffer(raw, f'{byte_order}i4', 1, 0)[0] != 348 or raw[344:347] != b'n+1':
+        raise ValueError(f"{path} is not a single-file NIfTI-1 volume")
+
+    dim = np.frombuffer(raw, f'{byte_order}i2', 8, 40)
+    datatype = int(np.frombuffer(raw, f'{byte_order}i2', 1, 70)[0])
+    if datatype not in _NIFTI_DTYPES:
+        raise ValueError(f"{path} has the unsupported NIfTI datatype {datatype}")
+    pixdim = np.frombuffer(raw, f'{byte_order}f4', 8, 76)
+    vox_offset, slope, intercept = np.frombuffer(raw, f'{byte_order}f4', 3, 108)
+    ndim = int(dim[0])
+    return {
+        'format': 'nifti',
+        'shape': [int(size) for size in dim[1:1 + ndim]],
+        'dtype': np.dtype(_NIFTI_DTYPES[datatype]).newbyteorder(byte_order).str,
+        'spacing': [float(size) for size in pixdim[1:1 + min(ndim, 3)]],
+        'vox_offset': int(vox_offset),
+        'scl_slope': float(slope) if np.isfinite(slope) and slope != 0 else 1.0,
+        'scl_inter': float(intercept) if np.isfinite(intercept) else 0.0,
+    }
+
+
+def _dicom():
+    try:
+        import pydicom
+    except ImportError as e:
+        raise ImportError("Reading DICOM files needs pydicom: pip install pydicom") from e
+    return pydicom
+
+
+def read_dicom_header(path: str) -> dict:
+    """
+    Reads the DICOM header, stopping before the pixel data.
+
+    Returns:
+        dict: The frame shape, frame count, spacing, modality, intensity scaling and stored window.
+    """
+    dataset = _dicom().dcmread(path, stop_before_pixels=True)
+
+    def first(value):
+        # Multi-valued window tags hold one window per preset; the first one is used
+        return float(value[0] if isinstance(value, Sequence) and not isinstance(value, str) else value)
+
+    frames = int(getattr(dataset, 'NumberOfFrames', 1) or 1)
+    header = {
+        'format': 'dicom',
+        'shape': [int(dataset.Rows), int(dataset.Columns)] + ([frames] if frames > 1 else []),
+        'frames': frames,
+        'spacing': [float(value) for value in getattr(dataset, 'PixelSpacing', [])],
+        'modality': str(getattr(dataset, 'Modality', '')),
+        'series_uid': str(getattr(dataset, 'SeriesInstanceUID', '')),
+        'instance_number': int(getattr(dataset, 'InstanceNumber', 0) or 0),
+        'bits_stored': int(getattr(dataset, 'BitsStored', 0) or 0),
+        'scl_slope': float(getattr(dataset, 'RescaleSlope', 1) or 1),
+        'scl_inter': float(getattr(dataset, 'RescaleIntercept', 0) or 0),
+    }
+    if 'WindowCenter' in dataset and 'WindowWidth' in dataset:
+        header['window'] = [first(dataset.WindowCenter), first(dataset.WindowWidth)]
+    return header
+
+
+@dataclass
+class VolumeReader:
+    """
+    Reads 2D slices from NIfTI volumes and DICOM files without converting them to JPEG first. Uncompressed
+    NIfTI voxels are memory-mapped, so only the slices read are paged in; `.nii.gz` volumes are
+    decompressed when opened. DICOM pixel data is read per file, and multi-frame files per frame. The
+    last `max_open_volumes` volumes stay open.
+
+    Slices are windowed to 8 bits: with `window_center` and `window_width`, or the window stored in a
+    DICOM header, or otherwise between the `lower_percentile` and `upper_percentile` of the volume.
+    """
+    window_center: Optional[float] = None
+    window_width: Optional[float] = None
+    lower_percentile: float = 1.0
+    upper_percentile: float = 99.0
+    slice_axis: int = 2
+    slice_step: int = 1
+    skip_empty_slices: bool = True
+    percentile_samples: int = 1_000_000
+
+    max_open_volumes: int = 8
+
+    def __post_init__(self):
+        self._lock = threading.Lock()
+        # The most recently opened volumes with their intensity windows, least recently used first
+        self._volumes = OrderedDict()
+
+    def __getstate__(self):
+        # The lock and the open volumes stay with the process that opened them
+        state = self.__dict__.copy()
+        del state['_lock'], state['_volumes']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.__post_init__()
+
+    def header(self, path: str) -> dict:
+        """
+        Reads a volume header without touching the voxel data.
+
+        Returns:
+            dict: The header fields, with the number of 2D slices the volume yields in `slices`.
+        """
+        if path.lower().endswith('.dcm'):
+            header = read_dicom_header(path)
+            header['slices'] = len(range(0, header['frames'], self.slice_step)) if header['frames'] > 1 else 1
+        else:
+            header = read_nifti_header(path)
+            shape = header['shape'] + [1] * (3 - len(header['shape']))
+            header['slices'] = len(range(0, shape[self.slice_axis], self.slice_step))
+        return header
+
+    def slice_size(self, header: dict) -> Tuple[int, int]:
+        """
+        Returns:
+            Tuple[int, int]: The width and height of the slices of a volume, from its header.
+        """
+        if header['format'] == 'dicom':
+            return header['shape'][1], header['shape'][0]
+        shape = (header['shape'] + [1] * 3)[:3]
+        width, height = [size for axis, size in enumerate(shape) if axis != self.slice_axis]
+        return width, height
+
+    def slice_paths(self, path: str, relative_path: str) -> Iterator[str]:
+        """
+        Lists the slices of a volume from its header.
+
+        Args:
+            path (str): The volume file.
+            relative_path (str): The name to give the slices, normally the path relative to the data directory.
+
+        Yields:
+            str: `relative_path` for a single-image file, otherwise `relative_path#slice=<index>` per slice.
+        """
+        header = self.header(path)
+        if header['format'] == 'dicom' and header['frames'] == 1:
+            yield relative_path
+            return
+        if header['format'] == 'dicom':
+            count = header['frames']
+        else:
+            count = (header['shape'] + [1] * 3)[self.slice_axis]
+        for index in range(0, count, self.slice_step):
+            yield f'{relative_path}{SLICE_SEPARATOR}{index:04d}'
+
+    def count_slices(self, path: str) -> int:
+        """
+        Counts the slices the prepare stage keeps from a volume. Without `skip_empty_slices` that is every
+        slice listed in the header; with it, every slice is read so that the empty ones are left out.
+
+        Returns:
+            int: The number of slices.
+        """
+        if not self.skip_empty_slices:
+            return self.header(path)['slices']
+        return sum(self.read_slice(slice_path) is not None for slice_path in self.slice_paths(path, path))
+
+    def _open(self, path: str):
+        """
+        Opens a volume, reusing the last one, and works out its intensity window.
+
+        Returns:
+            Tuple[np.ndarray, dict, Tuple[float, float]]: The voxel array (memory-mapped where possible),
+                the header and the (lower, upper) window.
+        """
+        stat = os.stat(path)
+        key = (path, stat.st_mtime_ns, stat.st_size)
+        with self._lock:
+            if key in self._volumes:
+                self._volumes.move_to_end(key)
+                return self._volumes[key]
+
+            if path.lower().endswith('.dcm'):
+                header = read_dicom_header(path)
+                dataset = _dicom().dcmread(path)
+                data = dataset.pixel_array
+                if header['frames'] == 1:
+                    data = data[None]
+            else:
+                header = read_nifti_header(path)
+                shape = tuple(header['shape'])
+                if path.lower().endswith('.gz'):
+                    with gzip.open(path, 'rb') as f:
+                        f.seek(header['vox_offset'])
+                        buffer = f.read(int(np.prod(shape)) * np.dtype(header['dtype']).itemsize)
+                    data = np.frombuffer(buffer, header['dtype']).reshape(shape, order='F')
+                else:
+                    data = np.memmap(path, dtype=header['dtype'], mode='r', offset=header['vox_offset'],
+                                     shape=shape, order='F')
+                # Only the first volume of a time series is used
+                while data.ndim > 3:
+                    data = data[..., 0]
+                while data.ndim < 3:
+                    data = data[..., None]
+
+            window = self._window(data, header)
+            self._volumes[key] = (data, header, window)
+            while len(self._volumes) > self.max_open_volumes:
+                self._volumes.popitem(last=False)
+            return data, header, window
+
+    def _window(self, data: np.ndarray, header: dict) -> Tuple[float, float]:
+        if self.window_center is not None and self.window_width is not None:
+            center, width = self.window_center, self.window_width
+        elif 'window' in header:
+            center, width = header['window']
+        else:
+            # Percentiles of a strided sample, so that the whole volume is never loaded for them
+            flat = data.reshape(-1, order='A')
+            step = max(1, flat.size // self.percentile_samples)
+            sample = np.asarray(flat[::step], dtype=np.float64) * header['scl_slope'] + header['scl_inter']
+            lower, upper = np.percentile(sample, [self.lower_percentile, self.upper_percentile])
+            return float(lower), float(max(upper, lower + 1e-6))
+        return center - width / 2, center + width / 2
+
+    def read_slice(self, path: str) -> Optional[np.ndarray]:
+        """
+        Reads and windows one slice.
+
+        Args:
+            path (str): A DICOM file, or a volume file with a `#slice=<index>` suffix.
+
+        Returns:
+            Optional[np.ndarray]: The slice as uint8 (height, width), or None for an empty slice when
+                `skip_empty_slices` is set.
+        """
+        volume_path, index = split_slice_path(path)
+        data, header, (lower, upper) = self._open(volume_path)
+        if header['format'] == 'dicom':
+            image = data[index or 0]
+        else:
+            # NIfTI stores x fastest; transposing puts y in rows, as the volume is usually viewed
+            image = np.take(data, index or 0, axis=self.slice_axis).T
+        image = np.asarray(image, dtype=np.float64) * header['scl_slope'] + header['scl_inter']
+        image = np.clip((image - lower) / (upper - lower), 0.0, 1.0)
+        image = np.round(image * 255).astype(np.uint8)
+        if self.skip_empty_slices and image.max() == image.min():
+            return None
+        return image
+
+    def read_png(self, path: str) -> Optional[bytes]:
+        """
+        Reads one slice and encodes it as a lossless grayscale PNG.
+
+        Returns:
+            Optional[bytes]: The PNG, or None for a skipped empty slice.
+        """
+        image = self.read_slice(path)
+        if image is None:
+            return None
+        buffer = io.BytesIO()
+        Image.fromarray(image, mode='L').save(buffer, format='PNG')
+        return buffer.getvalue()
+
+    def read_item(self, path: str) -> Optional[bytes]:
+        """
+        Reads the bytes the prepare stage hashes and decodes: the file itself for an ordinary image,
+        a PNG of the windowed slice for a volume slice or DICOM file.
+        """
+        if is_volume(path):
+            return self.read_png(path)
+        with open(path, 'rb') as f:
+            return f.read()
+
+    def scan(self, paths: List[str]) -> List[dict]:
+        """
+        Reads the headers of volume files, logging and skipping the unreadable ones.
+
+        Returns:
+            List[dict]: The header of each readable volume, with its `path`.
+        """
+        headers = []
+        for path in paths:
+            try:
+                headers.append(dict(self.header(path), path=path))
+            except (OSError, ValueError, ImportError) as e:
+                logger.warning(f"Skipping unreadable volume {path}: {e}")
+        return headers
@@ -1,22 +1,141 @@
+from __future__ import annotations
+
+import json
+import hashlib
+import functools
+from typing import TYPE_CHECKING
 from brainMRI.constants import *
+from brainMRI.config.schema import CONFIG_SCHEMA, PARAMS_SCHEMA, ConfigError, validate
+from brainMRI.logging import LoggingConfig
 from brainMRI.utils.helpers import load_config, create_directories
-from brainMRI.components.analyze_data import AnalyzeImageData
-from brainMRI.components.augmentation import DataAugmentation
-from brainMRI.components.base_model import BaseModel
-from brainMRI.components.callbacks import Callbacks
-from brainMRI.components.fetch_data import FetchData
-from brainMRI.components.prepare_datasets import PrepareDatasets
-from brainMRI.components.transfer_learning import TransferLearning
+
+
+# Components are imported by their getters: building the config of one stage imports only that stage's
+# dependencies, and serving an ONNX model never loads TensorFlow
+if TYPE_CHECKING:
+    from brainMRI.components.analyze_data import AnalyzeImageData
+    from brainMRI.components.augmentation import DataAugmentation
+    from brainMRI.components.base_model import BaseModel
+    from brainMRI.components.benchmark import PredictionBenchmark
+    from brainMRI.components.callbacks import Callbacks
+    from brainMRI.components.class_balancing import ClassBalancing
+    from brainMRI.components.cross_validation import CrossValidation
+    from brainMRI.components.data_service import DataService
+    from brainMRI.components.distillation import Distillation
+    from brainMRI.components.evaluation import Evaluation
+    from brainMRI.components.fetch_data import FetchData
+    from brainMRI.components.hyperparameter_search import HyperparameterSearch
+    from brainMRI.components.model_registry import ModelRegistry
+    from brainMRI.components.onnx_export import OnnxExport
+    from brainMRI.components.prediction import Prediction
+    from brainMRI.components.prediction_cache import PredictionCache
+    from brainMRI.components.prepare_datasets import PrepareDatasets
+    from brainMRI.components.quarantine import FileVerifier
+    from brainMRI.components.retrieval import SimilarCaseIndex
+    from brainMRI.components.runtime_config import RuntimeConfig
+    from brainMRI.components.scheduler import StageScheduler
+    from brainMRI.components.test_time_augmentation import TestTimeAugmentation
+    from brainMRI.components.transfer_learning import TransferLearning
+    from brainMRI.components.volumes import VolumeReader
+
+
+def memoised(getter):
+    """
+    Builds the config object once per handler and argument values, and returns the same object after
+    that. Only for getters whose objects callers do not modify.
+    """
+    @functools.wraps(getter)
+    def wrapper(self, *args):
+        key = (getter.__name__,) + args
+        if key not in self._memo:
+            self._memo[key] = getter(self, *args)
+        return self._memo[key]
+    return wrapper
 
 
 class ConfigHandler:
     def __init__(self, file_path=CONFIG_FILE_PATH, params_path = PARAMS_FILE_PATH):
+        self.file_path = file_path
+        self.params_path = params_path
         self.config = load_config(file_path)
         self.params = load_config(params_path)
+        self._memo = {}
+        self.validate()
         create_directories([self.config.root_dir])
 
+    def validate(self) -> None:
+        """
+        Checks both files against their schemas, so that a missing or mistyped key fails at load time
+        instead of in the middle of a run.
+
+        Raises:
+            ConfigError: Listing every mismatch found.
+        """
+        errors = [f"{self.file_path}: {error}" for error in validate(self.config.to_dict(), CONFIG_SCHEMA)]
+        errors += [f"{self.params_path}: {error}" for error in validate(self.params.to_dict(), PARAMS_SCHEMA)]
+        if errors:
+            raise ConfigError('Invalid configuration:\n' + '\n'.join(errors))
+
     
+    @memoised
+    def get_logging_config(self, stage: str) -> LoggingConfig:
+        config = self.config.logging
+        params = self.params.logging
+        # Per-stage settings override the defaults, except the rotation of the log file all stages share
+        settings = {key: value for key, value in params.items() if key != 'stages'}
+        settings.update(params.get('stages', {}).get(stage, {}))
+
+        logging_config = LoggingConfig(
+            stage=stage,
+            level=settings['level'],
+            json_format=settings['json_format'],
+            log_file=config.log_file,
+            max_bytes=params.max_mb * 1024 * 1024,
+            backup_count=params.backup_count,
+            console=settings['console'],
+            max_per_second=settings['max_per_second'],
+            sample_every=settings['sample_every']
+        )
+        return logging_config
+
+    @memoised
+    def get_runtime_config(self, role: str) -> RuntimeConfig:
+        from brainMRI.components.runtime_config import RuntimeConfig
+
+        config = self.config.runtime
+        params = self.params.runtime[role]
+
+        runtime_config = RuntimeConfig(
+            role=role,
+            root_dir=config.root_dir,
+            intra_op_threads=params.intra_op_threads,
+            inter_op_threads=params.inter_op_threads,
+            omp_threads=params.omp_threads,
+            onednn=params.onednn,
+            data_threadpool_size=params.data_threadpool_size,
+            data_max_intra_op_parallelism=params.data_max_intra_op_parallelism,
+            cpu_affinity=list(params.cpu_affinity)
+        )
+        return runtime_config
+
+    def get_stage_scheduler_config(self) -> StageScheduler:
+        from brainMRI.components.scheduler import StageScheduler
+
+        config = self.config.scheduler
+        params = self.params.scheduler
+
+        stage_scheduler_config = StageScheduler(
+            root_dir=config.root_dir,
+            max_cpus=params.max_cpus,
+            max_memory_mb=params.max_memory_mb,
+            fail_fast=params.fail_fast,
+            stage_resources=params.stages.to_dict()
+        )
+        return stage_scheduler_config
+
     def get_fetch_data_config(self) -> FetchData:
+        from brainMRI.components.fetch_data import FetchData
+
         config = self.config.data
         fetch_data_config = FetchData(
             root_dir = config.root_dir,
@@ -29,6 +148,8 @@ class ConfigHandler:
     
 
     def get_analyze_image_data_config(self) -> AnalyzeImageData:
+        from brainMRI.components.analyze_data import AnalyzeImageData
+
         config = self.config.info
         create_directories([config.root_dir])
         analyze_image_data_config = AnalyzeImageData(
@@ -40,12 +161,60 @@ class ConfigHandler:
             image_samples_path=config.image_samples_path,
             image_stats_results_path=config.image_stats_results_path,
             plots_path=config.plots_path,
+            volume_reader=self.get_volume_reader_config(),
+            volume_metadata_path=config.volume_metadata_path,
+            verifier=self.get_file_verifier_config(),
         )
         return analyze_image_data_config
 
+    @memoised
+    def get_file_verifier_config(self) -> FileVerifier:
+        from brainMRI.components.quarantine import FileVerifier
+
+        config = self.config.quarantine
+        params = self.params.quarantine
+        if not params.enabled:
+            return None
+
+        create_directories([config.root_dir])
+        file_verifier_config = FileVerifier(
+            data_dir=config.data_dir,
+            manifest_path=config.manifest_path,
+            quarantine_dir=config.quarantine_dir,
+            workers=params.workers,
+            timeout=params.timeout,
+            move=params.move,
+            volume_reader=self.get_volume_reader_config()
+        )
+        return file_verifier_config
+
+    def _quarantine_manifest_path(self):
+        return self.config.quarantine.manifest_path if self.params.quarantine.enabled else None
+
+    @memoised
+    def get_volume_reader_config(self) -> VolumeReader:
+        from brainMRI.components.volumes import VolumeReader
+
+        params = self.params.volumes
+        if not params.enabled:
+            return None
+
+        volume_reader_config = VolumeReader(
+            window_center=params.window_center,
+            window_width=params.window_width,
+            lower_percentile=params.lower_percentile,
+            upper_percentile=params.upper_percentile,
+            slice_axis=params.slice_axis,
+            slice_step=params.slice_step,
+            skip_empty_slices=params.skip_empty_slices
+        )
+        return volume_reader_config
+
 
     
     def get_prepare_datasets_config(self) -> PrepareDatasets:
+        from brainMRI.components.prepare_datasets import PrepareDatasets
+
         config = self.config.prepare_datasets
         params = self.params.prepare_datasets
         create_directories([config.save_dir])
@@ -58,12 +227,23 @@ class ConfigHandler:
             batch_size= params.batch_size,
             labels= params.labels,
             subset= params.subset,
-            seed= params.seed
+            seed= params.seed,
+            runtime_config= self.get_runtime_config('prepare'),
+            mode= params.mode,
+            shard_size= params.shard_size,
+            max_rss_mb= params.max_rss_mb,
+            incremental= params.incremental,
+            variant_sizes= params.variant_sizes,
+            volume_reader= self.get_volume_reader_config(),
+            quarantine_manifest_path= self._quarantine_manifest_path()
         )
 
         return prepare_datasets_config
     
+    @memoised
     def get_data_augmentation_config(self) -> DataAugmentation:
+        from brainMRI.components.augmentation import DataAugmentation
+
         params = self.params.data_augmentation
         config = self.config.data_augmentation
         data_augmentation_config = DataAugmentation(
@@ -89,6 +269,8 @@ class ConfigHandler:
         return data_augmentation_config
     
     def get_base_model_config(self) -> BaseModel:
+        from brainMRI.components.base_model import BaseModel
+
         config = self.config.base_model
         params= self.params.base_model
         data_augmentation_config = self.get_data_augmentation_config()
@@ -98,13 +280,15 @@ class ConfigHandler:
             weights=params.weights,
             include_top=params.include_top,
             input_shape=params.input_shape,
-            fine_tune_at=params.fine_tune_at,
-            data_augmentation_config = data_augmentation_config
+            data_augmentation_config = data_augmentation_config,
+            flexible_input=params.flexible_input
       )
         return base_model_config
     
 
     def get_callbacks_config(self) -> Callbacks:
+        from brainMRI.components.callbacks import Callbacks
+
         config = self.config.callbacks
         params = self.params.callbacks
         create_directories([config.root_dir])
@@ -113,17 +297,43 @@ class ConfigHandler:
             root_dir=config.root_dir,
             patience=params.patience,
             factor=params.factor,
-            min_lr=params.min_lr
+            min_lr=params.min_lr,
+            checkpoint_keep_best=params.checkpoint_keep_best,
+            checkpoint_keep_last=params.checkpoint_keep_last,
+            checkpoint_weights_only=params.checkpoint_weights_only
         )
         return callbacks_config
 
 
-    def get_transfer_learning_config(self) -> TransferLearning:
+    @memoised
+    def get_class_balancing_config(self) -> ClassBalancing:
+        from brainMRI.components.class_balancing import ClassBalancing
+
+        config = self.config.class_balancing
+        params = self.params.class_balancing
+
+        class_balancing_config = ClassBalancing(
+            image_counts_path=config.image_counts_path,
+            class_names_file=config.class_names_file,
+            split_counts_path=config.split_counts_path,
+            enabled=params.enabled,
+            method=params.method,
+            target_distribution=params.target_distribution,
+            use_class_weights=params.use_class_weights,
+            shuffle_buffer_size=params.shuffle_buffer_size,
+            seed=params.seed
+        )
+        return class_balancing_config
+
+
+    def get_transfer_learning_config(self, **overrides) -> TransferLearning:
+        from brainMRI.components.transfer_learning import TransferLearning
+
         config = self.config.transfer_learning
         params = self.params.transfer_learning
 
         create_directories([config.root_dir])
-        transfer_learning_config = TransferLearning(
+        transfer_learning_kwargs = dict(
             root_dir=config.root_dir,
             train_dir=config.train_dir,
             val_dir=config.val_dir,
@@ -131,6 +341,291 @@ class ConfigHandler:
             callback_path=config.callback_path,
             epochs=params.epochs,
             batch_size=params.batch_size,
-            learning_rate=params.learning_rate
+            learning_rate=params.learning_rate,
+            class_balancing_config=self.get_class_balancing_config(),
+            fine_tune_at=self.params.base_model.fine_tune_at,
+            fine_tune_blocks=params.fine_tune_blocks,
+            fine_tune_epochs=params.fine_tune_epochs,
+            fine_tune_learning_rate=params.fine_tune_learning_rate,
+            layerwise_lr_decay=params.layerwise_lr_decay,
+            gradient_accumulation_steps=params.gradient_accumulation_steps,
+            cache_features=params.cache_features,
+            progressive_resizing=[stage.to_dict() for stage in params.progressive_resizing],
+            model_registry=self.get_model_registry_config(),
+            auto_promote=self.params.model_registry.auto_promote,
+            class_names_file=self.config.prediction.class_names_file,
+            params_hash=hashlib.sha256(json.dumps(self.params.to_dict(), sort_keys=True).encode()).hexdigest(),
+            export_saved_model=params.export_saved_model,
+            onnx_export=self.get_onnx_export_config() if params.export_onnx else None,
+            runtime_config=self.get_runtime_config('train'),
+            evaluation=self.get_evaluation_config() if params.evaluate else None,
+            data_service=self.get_data_service_config() if self.params.data_service.enabled else None
+        )
+        # Callers such as cross-validation folds and search trials override paths, datasets and budgets
+        transfer_learning_kwargs.update(overrides)
+        transfer_learning_config = TransferLearning(**transfer_learning_kwargs)
+        return transfer_learning_config
+
+    def get_data_service_config(self) -> DataService:
+        from brainMRI.components.data_service import DataService
+
+        config = self.config.data_service
+        params = self.params.data_service
+
+        create_directories([config.root_dir])
+        data_service_config = DataService(
+            root_dir=config.root_dir,
+            dispatcher_address=params.dispatcher_address,
+            dispatcher_port=params.dispatcher_port,
+            num_workers=params.num_workers,
+            worker_host=params.worker_host,
+            worker_port=params.worker_port,
+            worker_addresses=params.worker_addresses,
+            sharding_policy=params.sharding_policy,
+            max_outstanding_requests=params.max_outstanding_requests,
+            compression=params.compression
+        )
+        return data_service_config
+
+    def get_distillation_config(self) -> Distillation:
+        from brainMRI.components.distillation import Distillation
+
+        config = self.config.distillation
+        params = self.params.distillation
+
+        create_directories([config.root_dir])
+        distillation_config = Distillation(
+            root_dir=config.root_dir,
+            teacher_path=config.teacher_path,
+            train_dir=config.train_dir,
+            val_dir=config.val_dir,
+            image_size=tuple(self.params.prepare_datasets.image_size),
+            student=params.student,
+            width=params.width,
+            alpha=params.alpha,
+            pretrained=params.pretrained,
+            temperature=params.temperature,
+            soft_weight=params.soft_weight,
+            epochs=params.epochs,
+            batch_size=params.batch_size,
+            shuffle_buffer_size=params.shuffle_buffer_size,
+            learning_rate=params.learning_rate,
+            patience=params.patience,
+            latency_batch_sizes=params.latency_batch_sizes,
+            latency_repeats=params.latency_repeats,
+            evaluation=self.get_evaluation_config(),
+            onnx_export=self.get_onnx_export_config() if params.export_onnx else None,
+            runtime_config=self.get_runtime_config('train')
+        )
+        return distillation_config
+
+    @memoised
+    def get_onnx_export_config(self) -> OnnxExport:
+        from brainMRI.components.onnx_export import OnnxExport
+
+        config = self.config.onnx_export
+        params = self.params.onnx_export
+
+        create_directories([config.root_dir])
+        onnx_export_config = OnnxExport(
+            root_dir=config.root_dir,
+            image_size=self.config.prediction.image_size,
+            opset=params.opset,
+            parity_samples=params.parity_samples,
+            parity_tolerance=params.parity_tolerance,
+            model_registry=self.get_model_registry_config()
+        )
+        return onnx_export_config
+
+    @memoised
+    def get_evaluation_config(self) -> Evaluation:
+        from brainMRI.components.evaluation import Evaluation
+
+        config = self.config.evaluation
+        params = self.params.evaluation
+
+        create_directories([config.root_dir])
+        evaluation_config = Evaluation(
+            root_dir=config.root_dir,
+            dataset_dir=config.dataset_dir,
+            batch_size=params.batch_size,
+            num_thresholds=params.num_thresholds,
+            calibration_bins=params.calibration_bins,
+            threshold_strategy=params.threshold_strategy,
+            min_sensitivity=params.min_sensitivity,
+            default_threshold=self.params.prediction.threshold,
+            model_registry=self.get_model_registry_config()
+        )
+        return evaluation_config
+
+    @memoised
+    def get_model_registry_config(self) -> ModelRegistry:
+        from brainMRI.components.model_registry import ModelRegistry
+
+        config = self.config.model_registry
+        params = self.params.model_registry
+        if not params.enabled:
+            return None
+
+        create_directories([config.root_dir])
+        model_registry_config = ModelRegistry(
+            root_dir=config.root_dir,
+            keep_versions=params.keep_versions
+        )
+        return model_registry_config
+
+    def get_cross_validation_config(self) -> CrossValidation:
+        from brainMRI.components.cross_validation import CrossValidation
+
+        config = self.config.cross_validation
+        params = self.params.cross_validation
+
+        create_directories([config.root_dir])
+        cross_validation_config = CrossValidation(
+            root_dir=config.root_dir,
+            data_dir=config.data_dir,
+            config_path=self.file_path,
+            params_path=self.params_path,
+            image_size=self.params.prepare_datasets.image_size,
+            n_splits=params.n_splits,
+            max_workers=params.max_workers,
+            threads_per_worker=params.threads_per_worker,
+            epochs=params.epochs,
+            seed=params.seed,
+            quarantine_manifest_path=self._quarantine_manifest_path()
+        )
+        return cross_validation_config
+
+
+    def get_hyperparameter_search_config(self) -> HyperparameterSearch:
+        from brainMRI.components.hyperparameter_search import HyperparameterSearch
+
+        config = self.config.hyperparameter_search
+        params = self.params.hyperparameter_search
+
+        create_directories([config.root_dir])
+        hyperparameter_search_config = HyperparameterSearch(
+            root_dir=config.root_dir,
+            config_path=self.file_path,
+            params_path=self.params_path,
+            search_space=params.search_space.to_dict(),
+            strategy=params.strategy,
+            num_trials=params.num_trials,
+            min_epochs=params.min_epochs,
+            max_epochs=params.max_epochs,
+            eta=params.eta,
+            max_workers=params.max_workers,
+            threads_per_worker=params.threads_per_worker,
+            median_pruning=params.median_pruning,
+            prune_warmup_epochs=params.prune_warmup_epochs,
+            seed=params.seed
+        )
+        return hyperparameter_search_config
+
+
+    @memoised
+    def get_test_time_augmentation_config(self) -> TestTimeAugmentation:
+        from brainMRI.components.test_time_augmentation import TestTimeAugmentation
+
+        params = self.params.data_augmentation
+
+        test_time_augmentation_config = TestTimeAugmentation(
+            random_flip_horizontal=params.random_flip_horizontal,
+            random_flip_vertical=params.random_flip_vertical,
+            random_rotation=params.random_rotation,
+            random_zoom_height=params.random_zoom_height,
+            random_zoom_width=params.random_zoom_width,
+            random_rotation_factor=params.random_rotation_factor,
+            random_zoom_height_factor=params.random_zoom_height_factor,
+            random_zoom_width_factor=params.random_zoom_width_factor
+        )
+        return test_time_augmentation_config
+
+    def get_prediction_config(self) -> Prediction:
+        from brainMRI.components.prediction import Prediction
+
+        config = self.config.prediction
+        params = self.params.prediction
+
+        prediction_config = Prediction(
+            model_path=config.model_path,
+            class_names_file=config.class_names_file,
+            image_size=config.image_size,
+            batch_size=params.batch_size,
+            threshold=params.threshold,
+            use_evaluated_threshold=params.use_evaluated_threshold,
+            explain=params.explain,
+            gradcam_alpha=params.gradcam_alpha,
+            tta=params.tta,
+            tta_config=self.get_test_time_augmentation_config(),
+            cache=self.get_prediction_cache_config(),
+            retrieval=self.get_retrieval_config(),
+            index_scored=self.params.retrieval.index_scored,
+            registry=self.get_model_registry_config(),
+            watch_interval=self.params.model_registry.watch_interval,
+            use_saved_model=params.use_saved_model,
+            backend=params.backend,
+            # The onnx backend falls back to the thread counts of the serve role
+            intra_op_threads=params.intra_op_threads or self.params.runtime.serve.intra_op_threads,
+            inter_op_threads=params.inter_op_threads or self.params.runtime.serve.inter_op_threads,
+            warmup_batch_sizes=params.warmup_batch_sizes,
+            max_tensor_images=params.max_tensor_images
+        )
+        return prediction_config
+
+    @memoised
+    def get_prediction_cache_config(self) -> PredictionCache:
+        from brainMRI.components.prediction_cache import PredictionCache
+
+        config = self.config.prediction_cache
+        params = self.params.prediction_cache
+        if not params.enabled:
+            return None
+
+        prediction_cache_config = PredictionCache(
+            max_entries=params.max_entries,
+            ttl_seconds=params.ttl_seconds,
+            disk_path=config.disk_path if params.disk else None,
+            max_disk_bytes=params.max_disk_mb * 1024 * 1024,
+            sync_every=params.sync_every
+        )
+        return prediction_cache_config
+
+    @memoised
+    def get_retrieval_config(self) -> SimilarCaseIndex:
+        from brainMRI.components.retrieval import SimilarCaseIndex
+
+        config = self.config.retrieval
+        params = self.params.retrieval
+        if not params.enabled:
+            return None
+
+        retrieval_config = SimilarCaseIndex(
+            root_dir=config.root_dir,
+            data_dir=config.data_dir,
+            batch_size=params.batch_size,
+            exact_max_items=params.exact_max_items,
+            num_lists=params.num_lists,
+            num_probes=params.num_probes,
+            block_rows=params.block_rows,
+            retrain_growth=params.retrain_growth,
+            top_k=params.top_k,
+            max_k=params.max_k,
+            queue_size=params.queue_size
+        )
+        return retrieval_config
+
+    def get_benchmark_config(self) -> PredictionBenchmark:
+        from brainMRI.components.benchmark import PredictionBenchmark
+
+        config = self.config.benchmark
+        params = self.params.benchmark
+
+        create_directories([config.root_dir])
+        benchmark_config = PredictionBenchmark(
+            root_dir=config.root_dir,
+            batch_sizes=params.batch_sizes,
+            repeats=params.repeats,
+            warmup=params.warmup
         )
-        return transfer_learning_config
\ No newline at end of file
+        return benchmark_config
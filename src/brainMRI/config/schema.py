@@ -0,0 +1,330 @@
+from typing import List
+
+NUMBER = (int, float)
+
+
+class ConfigError(ValueError):
+    """
+    Raised when `config.yaml` or `params.yaml` does not match its schema.
+    """
+
+
+class Choice:
+    def __init__(self, *values):
+        self.values = values
+
+
+class ListOf:
+    def __init__(self, item):
+        self.item = item
+
+
+class MapOf:
+    def __init__(self, value):
+        self.value = value
+
+
+class Nullable:
+    def __init__(self, schema):
+        self.schema = schema
+
+
+class AnyValue:
+    pass
+
+
+def _type_name(schema) -> str:
+    if isinstance(schema, tuple):
+        return ' or '.join(item.__name__ for item in schema)
+    return schema.__name__
+
+
+def validate(data, schema, path: str = '') -> List[str]:
+    """
+    Checks a parsed YAML document against a schema and collects every mismatch. Keys that are not in the
+    schema are allowed.
+
+    Args:
+        data: The parsed value.
+        schema: A dict of keys to schemas, a type or tuple of types, or a `Choice`, `ListOf`, `MapOf`,
+            `Nullable` or `AnyValue` marker.
+        path (str): The dotted path of `data`, used in the error messages.
+
+    Returns:
+        List[str]: The errors, empty if the value matches.
+    """
+    if isinstance(schema, AnyValue):
+        return []
+    if isinstance(schema, Nullable):
+        return [] if data is None else validate(data, schema.schema, path)
+    if isinstance(schema, Choice):
+        return [] if data in schema.values else [f"{path} must be one of {list(schema.values)}, got {data!r}"]
+    if isinstance(schema, ListOf):
+        if not isinstance(data, list):
+            return [f"{path} must be a list, got {data!r}"]
+        return [error for index, item in enumerate(data) for error in validate(item, schema.item, f"{path}[{index}]")]
+    if isinstance(schema, (dict, MapOf)):
+        if not isinstance(data, dict):
+            return [f"{path or 'the document'} must be a mapping, got {data!r}"]
+        if isinstance(schema, MapOf):
+            return [error for key, value in data.items() for error in validate(value, schema.value, f"{path}.{key}")]
+        errors = []
+        for key, value_schema in schema.items():
+            key_path = f"{path}.{key}" if path else key
+            if key not in data:
+                errors.append(f"{key_path} is missing")
+            else:
+                errors.extend(validate(data[key], value_schema, key_path))
+        return errors
+
+    # bool is a subclass of int, so it must be excluded explicitly from numbers
+    types = schema if isinstance(schema, tuple) else (schema,)
+    if isinstance(data, bool) and bool not in types:
+        return [f"{path} must be {_type_name(schema)}, got {data!r}"]
+    if not isinstance(data, types):
+        return [f"{path} must be {_type_name(schema)}, got {data!r}"]
+    return []
+
+
+CONFIG_SCHEMA = {
+    'root_dir': str,
+    'data': {'root_dir': str, 'data_url': str, 'filepath': str, 'extract_path': str},
+    'info': {
+        'root_dir': str,
+        'data_folder': str,
+        'image_quality_and_format': str,
+        'image_counts_path': str,
+        'image_metadata_path': str,
+        'allowed_formats': ListOf(str),
+        'image_samples_path': str,
+        'image_stats_results_path': str,
+        'plots_path': str,
+        'volume_metadata_path': str,
+    },
+    'quarantine': {'root_dir': str, 'data_dir': str, 'manifest_path': str, 'quarantine_dir': str},
+    'prepare_datasets': {'data_dir': str, 'save_dir': str},
+    'data_augmentation': {'training_dir': str},
+    'base_model': {'root_dir': str},
+    'class_balancing': {'image_counts_path': str, 'class_names_file': str, 'split_counts_path': str},
+    'callbacks': {'root_dir': str},
+    'transfer_learning': {
+        'root_dir': str,
+        'train_dir': str,
+        'val_dir': str,
+        'base_model_path': str,
+        'callback_path': str,
+    },
+    'data_service': {'root_dir': str},
+    'cross_validation': {'root_dir': str, 'data_dir': str},
+    'hyperparameter_search': {'root_dir': str},
+    'model_registry': {'root_dir': str},
+    'onnx_export': {'root_dir': str},
+    'evaluation': {'root_dir': str, 'dataset_dir': str},
+    'distillation': {'root_dir': str, 'teacher_path': str, 'train_dir': str, 'val_dir': str},
+    'prediction': {'model_path': str, 'class_names_file': str, 'image_size': int},
+    'prediction_cache': {'disk_path': str},
+    'batch_prediction': {'input_dir': str, 'output_path': str},
+    'retrieval': {'root_dir': str, 'data_dir': str},
+    'benchmark': {'root_dir': str},
+    'scheduler': {'root_dir': str},
+    'runtime': {'root_dir': str},
+    'logging': {'log_file': str},
+}
+
+_RUNTIME_ROLE_SCHEMA = {
+    'intra_op_threads': int,
+    'inter_op_threads': int,
+    'omp_threads': int,
+    'onednn': bool,
+    'data_threadpool_size': int,
+    'data_max_intra_op_parallelism': int,
+    'cpu_affinity': ListOf(int),
+}
+
+PARAMS_SCHEMA = {
+    'prepare_datasets': {
+        'validation_split': NUMBER,
+        'image_size': ListOf(int),
+        'batch_size': int,
+        'labels': str,
+        'subset': str,
+        'seed': int,
+        'mode': Choice('directory', 'streaming'),
+        'incremental': bool,
+        'variant_sizes': ListOf(ListOf(int)),
+        'shard_size': int,
+        'max_rss_mb': int,
+    },
+    'volumes': {
+        'enabled': bool,
+        'window_center': Nullable(NUMBER),
+        'window_width': Nullable(NUMBER),
+        'lower_percentile': NUMBER,
+        'upper_percentile': NUMBER,
+        'slice_axis': Choice(0, 1, 2),
+        'slice_step': int,
+        'skip_empty_slices': bool,
+    },
+    'quarantine': {
+        'enabled': bool,
+        'workers': int,
+        'timeout': NUMBER,
+        'move': bool,
+    },
+    'data_augmentation': {
+        'random_flip_horizontal': bool,
+        'random_flip_vertical': bool,
+        'random_rotation': bool,
+        'random_zoom_height': bool,
+        'random_zoom_width': bool,
+        'random_brightness': bool,
+        'random_contrast': bool,
+        'random_translation_height': bool,
+        'random_translation_width': bool,
+        'random_rotation_factor': NUMBER,
+        'random_zoom_height_factor': NUMBER,
+        'random_zoom_width_factor': NUMBER,
+        'random_brightness_factor': NUMBER,
+        'random_contrast_lower_factor': NUMBER,
+        'random_contrast_upper_factor': NUMBER,
+        'random_translation_height_factor': NUMBER,
+        'random_translation_width_factor': NUMBER,
+    },
+    'base_model': {
+        'fine_tune_at': int,
+        'input_shape': ListOf(int),
+        'weights': Nullable(str),
+        'include_top': bool,
+        'flexible_input': bool,
+    },
+    'callbacks': {
+        'patience': int,
+        'factor': NUMBER,
+        'min_lr': NUMBER,
+        'checkpoint_keep_best': int,
+        'checkpoint_keep_last': int,
+        'checkpoint_weights_only': bool,
+    },
+    'class_balancing': {
+        'enabled': bool,
+        'method': Choice('sample', 'rejection', 'none'),
+        'target_distribution': Nullable(MapOf(NUMBER)),
+        'use_class_weights': bool,
+        'shuffle_buffer_size': int,
+        'seed': int,
+    },
+    'transfer_learning': {
+        'epochs': int,
+        'batch_size': int,
+        'learning_rate': NUMBER,
+        'cache_features': bool,
+        'progressive_resizing': ListOf({'image_size': (int, list), 'epochs': int}),
+        'fine_tune_epochs': int,
+        'fine_tune_blocks': int,
+        'fine_tune_learning_rate': NUMBER,
+        'layerwise_lr_decay': NUMBER,
+        'gradient_accumulation_steps': int,
+        'export_saved_model': bool,
+        'export_onnx': bool,
+        'evaluate': bool,
+    },
+    'data_service': {
+        'enabled': bool,
+        'dispatcher_address': Nullable(str),
+        'dispatcher_port': int,
+        'num_workers': int,
+        'worker_host': str,
+        'worker_port': int,
+        'worker_addresses': ListOf(str),
+        'sharding_policy': Choice('off', 'dynamic', 'file', 'data', 'file_or_data', 'hint'),
+        'max_outstanding_requests': int,
+        'compression': Choice('none', 'auto'),
+    },
+    'evaluation': {
+        'batch_size': int,
+        'num_thresholds': int,
+        'calibration_bins': int,
+        'threshold_strategy': Choice('youden', 'f1', 'min_sensitivity', 'fixed'),
+        'min_sensitivity': NUMBER,
+    },
+    'distillation': {
+        'student': Choice('small_cnn', 'mobilenet_v3_small'),
+        'width': int,
+        'alpha': NUMBER,
+        'pretrained': bool,
+        'temperature': NUMBER,
+        'soft_weight': NUMBER,
+        'epochs': int,
+        'batch_size': int,
+        'shuffle_buffer_size': int,
+        'learning_rate': NUMBER,
+        'patience': int,
+        'latency_batch_sizes': ListOf(int),
+        'latency_repeats': int,
+        'export_onnx': bool,
+    },
+    'onnx_export': {'opset': int, 'parity_samples': int, 'parity_tolerance': NUMBER},
+    'cross_validation': {'n_splits': int, 'max_workers': int, 'threads_per_worker': int, 'epochs': int, 'seed': int},
+    'hyperparameter_search': {
+        'strategy': Choice('random', 'successive_halving', 'hyperband'),
+        'num_trials': int,
+        'min_epochs': int,
+        'max_epochs': int,
+        'eta': int,
+        'max_workers': int,
+        'threads_per_worker': int,
+        'median_pruning': bool,
+        'prune_warmup_epochs': int,
+        'seed': int,
+        'search_space': MapOf({'type': Choice('uniform', 'loguniform', 'int', 'choice')}),
+    },
+    'model_registry': {'enabled': bool, 'auto_promote': bool, 'keep_versions': int, 'watch_interval': NUMBER},
+    'prediction': {
+        'batch_size': int,
+        'threshold': NUMBER,
+        'use_evaluated_threshold': bool,
+        'explain': bool,
+        'gradcam_alpha': NUMBER,
+        'tta': bool,
+        'backend': Choice('tensorflow', 'onnx'),
+        'use_saved_model': bool,
+        'intra_op_threads': int,
+        'inter_op_threads': int,
+        'warmup_batch_sizes': ListOf(int),
+        'max_tensor_images': int,
+    },
+    'prediction_cache': {'enabled': bool, 'max_entries': int, 'ttl_seconds': NUMBER, 'disk': bool, 'max_disk_mb': int,
+                         'sync_every': int},
+    'batch_prediction': {'tta': bool, 'explain': bool},
+    'retrieval': {
+        'enabled': bool,
+        'index_scored': bool,
+        'batch_size': int,
+        'exact_max_items': int,
+        'num_lists': int,
+        'num_probes': int,
+        'block_rows': int,
+        'retrain_growth': NUMBER,
+        'top_k': int,
+        'max_k': int,
+        'queue_size': int,
+    },
+    'benchmark': {'batch_sizes': ListOf(int), 'repeats': int, 'warmup': int},
+    'scheduler': {
+        'max_cpus': int,
+        'max_memory_mb': int,
+        'fail_fast': bool,
+        'stages': MapOf({'cpus': int, 'memory_mb': int}),
+    },
+    'runtime': {role: _RUNTIME_ROLE_SCHEMA for role in ('prepare', 'train', 'serve', 'analyze')},
+    'logging': {
+        'level': Choice('DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL'),
+        'json_format': bool,
+        'max_mb': int,
+        'backup_count': int,
+        'console': bool,
+        'max_per_second': int,
+        'sample_every': int,
+        'stages': Nullable(MapOf(AnyValue())),
+    },
+}
@@ -1,23 +1,308 @@
 import os
 import sys
+import copy
+import json
+import time
+import queue
+import atexit
 import logging
+import threading
+import multiprocessing
+import multiprocessing.util
+from dataclasses import dataclass
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
 
 FORMET = "[%(asctime)s: %(levelname)s: %(module)s: %(message)s]"
 
 
 log_dir = 'logs'
 log_filepath = os.path.join(log_dir, 'running_logs.log')
-os.makedirs(log_dir, exist_ok=True)
 
+# Attributes every LogRecord has, and the format tag of records from child processes; anything else was
+# passed through `extra` and is a structured field
+_RECORD_ATTRIBUTES = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime', 'json_format'}
 
-logging.basicConfig(
-    level=logging.INFO,
-    format=FORMET,
 
-    handlers= [
-        logging.FileHandler(log_filepath),
-        logging.StreamHandler(sys.stdout)
-    ]
-)
+class TextFormatter(logging.Formatter):
+    """
+    The plain text format, noting how many similar messages the rate limiter dropped before this one.
+    """
 
-logger = logging.getLogger(__name__)
\ No newline at end of file
+    def format(self, record: logging.LogRecord) -> str:
+        text = super().format(record)
+        suppressed = getattr(record, 'suppressed', 0)
+        return f"{text} ({suppressed} similar messages suppressed)" if suppressed else text
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    Formats each record as one JSON object per line, including any fields passed with `extra`.
+    """
+
+    def format(self, record: logging.LogRecord) -> str:
+        payload = {
+            'time': self.formatTime(record),
+            'level': record.levelname,
+            'module': record.module,
+            'message': record.getMessage(),
+            'pid': record.process,
+            'thread': record.threadName,
+        }
+        for key, value in record.__dict__.items():
+            if key not in _RECORD_ATTRIBUTES:
+                payload[key] = value
+        if record.exc_info:
+            payload['exception'] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            # Records from child processes carry the traceback already formatted
+            payload['exception'] = record.exc_text
+        return json.dumps(payload, default=str)
+
+
+class RecordQueueHandler(QueueHandler):
+    """
+    Queues records with their arguments merged into the message, but without folding the traceback into
+    it as `QueueHandler` does, so that the formatter writing the record can put it in its own field.
+    Tracebacks cannot be pickled, so records sent to another process carry the formatted traceback in
+    `exc_text` instead.
+    """
+
+    def __init__(self, queue, pickled: bool = False):
+        super().__init__(queue)
+        self.pickled = pickled
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record = copy.copy(record)
+        record.message = record.getMessage()
+        record.msg, record.args = record.message, None
+        if self.pickled and record.exc_info:
+            record.exc_text = record.exc_text or _TRACEBACK_FORMATTER.formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+class RecordFormatter(logging.Formatter):
+    """
+    Formats the records of the log file: as JSON or plain text as the stage that produced the record
+    is configured, for records sent by child processes, and as `json_format` says otherwise.
+    """
+
+    def __init__(self, json_format: bool = False):
+        super().__init__()
+        self.json_format = json_format
+        self.json_formatter = JsonFormatter()
+        self.text_formatter = TextFormatter(FORMET)
+
+    def format(self, record: logging.LogRecord) -> str:
+        json_format = getattr(record, 'json_format', self.json_format)
+        return (self.json_formatter if json_format else self.text_formatter).format(record)
+
+
+class FormatTagFilter(logging.Filter):
+    """
+    Tags every record a child process sends to its parent with the child's log format.
+    """
+
+    def __init__(self, json_format: bool):
+        super().__init__()
+        self.json_format = json_format
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        record.json_format = self.json_format
+        return True
+
+
+class RateLimitFilter(logging.Filter):
+    """
+    Limits each call site (file and line) to `max_per_interval` records per `interval` seconds and,
+    with `sample_every` > 1, keeps only every n-th record of a call site. Warnings and errors always
+    pass. The number of dropped records is attached to the next record of the call site that passes.
+    """
+
+    def __init__(self, max_per_interval: int = 0, interval: float = 1.0, sample_every: int = 1):
+        super().__init__()
+        self.max_per_interval = max_per_interval
+        self.interval = interval
+        self.sample_every = sample_every
+        self._sites = {}
+        self._lock = threading.Lock()
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno >= logging.WARNING:
+            return True
+
+        now = time.monotonic()
+        with self._lock:
+            # [window start, records in window, records seen, records suppressed]
+            state = self._sites.setdefault((record.pathname, record.lineno), [now, 0, 0, 0])
+            state[2] += 1
+            if self.sample_every > 1 and (state[2] - 1) % self.sample_every:
+                state[3] += 1
+                return False
+            if self.max_per_interval:
+                if now - state[0] >= self.interval:
+                    state[0], state[1] = now, 0
+                if state[1] >= self.max_per_interval:
+                    state[3] += 1
+                    return False
+                state[1] += 1
+            if state[3]:
+                record.suppressed = state[3]
+                state[3] = 0
+        return True
+
+
+class StageFilter(logging.Filter):
+    """
+    Tags every record with the pipeline stage that produced it.
+    """
+
+    def __init__(self, stage: str = None):
+        super().__init__()
+        self.stage = stage
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        record.stage = self.stage
+        return True
+
+
+@dataclass
+class LoggingConfig:
+    stage: str = None
+    level: str = 'INFO'
+    json_format: bool = False
+    log_file: str = log_filepath
+    max_bytes: int = 10 * 1024 * 1024
+    backup_count: int = 5
+    console: bool = True
+    max_per_second: int = 0
+    sample_every: int = 1
+
+    def apply(self) -> None:
+        """
+        Routes all logging through a queue: callers only enqueue the record, and a background listener
+        thread formats it and writes it to the size-rotated log file and to stdout. Replaces any
+        previous configuration, so each stage can apply its own settings.
+
+        In a process attached to its parent with `attach_to_parent`, the records meant for the log file
+        are sent to the parent instead, so that only one process writes and rotates the file. They are
+        still formatted as this process is configured, but the file and its rotation are the parent's.
+        """
+        global _listener, _config
+
+        root = logging.getLogger()
+        if _listener is not None:
+            _listener.stop()
+            _listener = None
+        for handler in list(root.handlers):
+            root.removeHandler(handler)
+            handler.close()
+
+        _config = self
+        formatter = JsonFormatter() if self.json_format else TextFormatter(FORMET)
+        handlers = []
+        if _parent_queue is not None:
+            # The parent formats the record, in the format tagged on it
+            parent_handler = RecordQueueHandler(_parent_queue, pickled=True)
+            parent_handler.addFilter(FormatTagFilter(self.json_format))
+            handlers.append(parent_handler)
+        else:
+            os.makedirs(os.path.dirname(self.log_file) or '.', exist_ok=True)
+            file_handler = RotatingFileHandler(self.log_file, maxBytes=self.max_bytes,
+                                               backupCount=self.backup_count, encoding='utf-8', delay=True)
+            file_handler.setFormatter(RecordFormatter(self.json_format))
+            handlers.append(file_handler)
+            _serve_children(file_handler)
+        if self.console:
+            console_handler = logging.StreamHandler(sys.stdout)
+            console_handler.setFormatter(formatter)
+            handlers.append(console_handler)
+
+        log_queue = queue.Queue(-1)
+        queue_handler = RecordQueueHandler(log_queue)
+        queue_handler.addFilter(StageFilter(self.stage))
+        queue_handler.addFilter(RateLimitFilter(self.max_per_second, 1.0, self.sample_every))
+        root.addHandler(queue_handler)
+        root.setLevel(self.level)
+
+        _listener = QueueListener(log_queue, *handlers, respect_handler_level=True)
+        _listener.start()
+
+
+_listener = None
+_config = None
+
+_TRACEBACK_FORMATTER = logging.Formatter()
+
+# The queue child processes send their file records on, and the listener writing them to this process's file
+_children_queue = None
+_children_listener = None
+_children_handler = None
+
+# The queue of the parent process, in a process attached with `attach_to_parent`
+_parent_queue = None
+
+
+def _serve_children(file_handler: logging.Handler) -> None:
+    """
+    Points the listener for child process records at the current log file handler.
+    """
+    global _children_listener, _children_handler
+    _children_handler = file_handler
+    if _children_listener is not None:
+        _children_listener.stop()
+        _children_listener = None
+    if _children_queue is not None:
+        _children_listener = QueueListener(_children_queue, file_handler)
+        _children_listener.start()
+
+
+def process_log_queue():
+    """
+    Returns the queue a spawned child process sends its log records on, to pass to the child
+    so that it calls `attach_to_parent` with it. A child passes its parent's queue on to its own children.
+
+    Returns:
+        multiprocessing.Queue: The queue.
+    """
+    global _children_queue
+    if _parent_queue is not None:
+        return _parent_queue
+    if _children_queue is None:
+        _children_queue = multiprocessing.get_context('spawn').Queue(-1)
+        _serve_children(_children_handler)
+    return _children_queue
+
+
+def attach_to_parent(log_queue) -> None:
+    """
+    Sends the log file records of this process to the parent process that owns the log file, so that
+    concurrent processes do not each rotate the same file. Call it first in a spawned child process.
+
+    Args:
+        log_queue (multiprocessing.Queue): The queue from the parent's `process_log_queue`.
+    """
+    global _parent_queue
+    _parent_queue = log_queue
+    _config.apply()
+    # Flushes the queued records at process exit before the multiprocessing queues are closed, which
+    # happens at exit priority 10, ahead of the atexit handlers
+    multiprocessing.util.Finalize(None, _stop_listener, exitpriority=20)
+
+
+def _stop_listener() -> None:
+    # Flushes the records still in the queues before the process exits
+    global _listener, _children_listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+    if _children_listener is not None:
+        _children_listener.stop()
+        _children_listener = None
+
+
+atexit.register(_stop_listener)
+
+LoggingConfig().apply()
+
+logger = logging.getLogger(__name__)
@@ -8,6 +8,8 @@ class AnalyzeDataPipeline:
 
 
     def main(self) -> None:
+        self.config.get_logging_config('analyze_data').apply()
+        self.config.get_runtime_config('analyze').apply()
         analyzer_config = self.config.get_analyze_image_data_config()
         analyzer_config.analyzer()
 
@@ -8,6 +8,7 @@ class BaseModelPipeline:
             self.config = config
 
     def main(self):
+        self.config.get_logging_config('base_model').apply()
         base_model_config = self.config.get_base_model_config()
         base_model_config.build_model()
 
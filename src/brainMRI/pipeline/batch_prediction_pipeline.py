@@ -0,0 +1,32 @@
+from brainMRI.config.configuration import ConfigHandler
+from brainMRI.logging import logger
+
+
+
+class BatchPredictionPipeline:
+    def __init__(self, config) -> None:
+            self.config = config
+
+    def main(self):
+        self.config.get_logging_config('batch_prediction').apply()
+        self.config.get_runtime_config('serve').apply()
+        prediction_config = self.config.get_prediction_config()
+        prediction_config.score_directory(
+            self.config.config.batch_prediction.input_dir,
+            self.config.config.batch_prediction.output_path,
+            tta=self.config.params.batch_prediction.tta,
+            explain=self.config.params.batch_prediction.explain
+        )
+
+if __name__ == '__main__':
+    try:
+        config = ConfigHandler()
+        stage_name = 'Batch Prediction stage'
+        logger.info(f">>>>>> stage {stage_name} started <<<<<<")  # Log the start of the pipeline stage
+        pipeline = BatchPredictionPipeline(config)
+        pipeline.main()
+        logger.info(f">>>>>> stage {stage_name} completed <<<<<<\n\nx==========x")  # Log the completion of the pipeline stage
+
+    except Exception as e:
+        logger.exception(e)  # Log the exception if an error occurs
+        raise e
\ No newline at end of file
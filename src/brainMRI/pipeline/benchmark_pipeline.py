@@ -0,0 +1,28 @@
+from brainMRI.config.configuration import ConfigHandler
+from brainMRI.logging import logger
+
+
+
+class BenchmarkPipeline:
+    def __init__(self, config) -> None:
+            self.config = config
+
+    def main(self):
+        self.config.get_logging_config('benchmark').apply()
+        self.config.get_runtime_config('serve').apply()
+        prediction_config = self.config.get_prediction_config()
+        benchmark_config = self.config.get_benchmark_config()
+        benchmark_config.run(prediction_config)
+
+if __name__ == '__main__':
+    try:
+        config = ConfigHandler()
+        stage_name = 'Benchmark stage'
+        logger.info(f">>>>>> stage {stage_name} started <<<<<<")  # Log the start of the pipeline stage
+        pipeline = BenchmarkPipeline(config)
+        pipeline.main()
+        logger.info(f">>>>>> stage {stage_name} completed <<<<<<\n\nx==========x")  # Log the completion of the pipeline stage
+
+    except Exception as e:
+        logger.exception(e)  # Log the exception if an error occurs
+        raise e
\ No newline at end of file
@@ -8,6 +8,7 @@ class CallbacksPipeline:
             self.config = config
 
     def main(self):
+        self.config.get_logging_config('callbacks').apply()
         callbacks_config = self.config.get_callbacks_config()
         f = callbacks_config.get_callbacks()
    
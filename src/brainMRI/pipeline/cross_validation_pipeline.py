@@ -0,0 +1,26 @@
+from brainMRI.config.configuration import ConfigHandler
+from brainMRI.logging import logger
+
+
+
+class CrossValidationPipeline:
+    def __init__(self, config) -> None:
+            self.config = config
+
+    def main(self):
+        self.config.get_logging_config('cross_validation').apply()
+        cross_validation_config = self.config.get_cross_validation_config()
+        cross_validation_config.run()
+
+if __name__ == '__main__':
+    try:
+        config = ConfigHandler()
+        stage_name = 'Cross Validation stage'
+        logger.info(f">>>>>> stage {stage_name} started <<<<<<")  # Log the start of the pipeline stage
+        pipeline = CrossValidationPipeline(config)
+        pipeline.main()
+        logger.info(f">>>>>> stage {stage_name} completed <<<<<<\n\nx==========x")  # Log the completion of the pipeline stage
+
+    except Exception as e:
+        logger.exception(e)  # Log the exception if an error occurs
+        raise e
\ No newline at end of file
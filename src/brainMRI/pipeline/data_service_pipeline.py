@@ -0,0 +1,27 @@
+from brainMRI.config.configuration import ConfigHandler
+from brainMRI.logging import logger
+
+
+
+class DataServicePipeline:
+    def __init__(self, config) -> None:
+            self.config = config
+
+    def main(self):
+        self.config.get_logging_config('data_service').apply()
+        self.config.get_runtime_config('prepare').apply()
+        data_service_config = self.config.get_data_service_config()
+        data_service_config.serve()
+
+if __name__ == '__main__':
+    try:
+        config = ConfigHandler()
+        stage_name = 'Data Service stage'
+        logger.info(f">>>>>> stage {stage_name} started <<<<<<")  # Log the start of the pipeline stage
+        pipeline = DataServicePipeline(config)
+        pipeline.main()
+        logger.info(f">>>>>> stage {stage_name} completed <<<<<<\n\nx==========x")  # Log the completion of the pipeline stage
+
+    except Exception as e:
+        logger.exception(e)  # Log the exception if an error occurs
+        raise e
\ No newline at end of file
@@ -0,0 +1,27 @@
+from brainMRI.config.configuration import ConfigHandler
+from brainMRI.logging import logger
+
+
+
+class DistillationPipeline:
+    def __init__(self, config) -> None:
+            self.config = config
+
+    def main(self):
+        self.config.get_logging_config('distillation').apply()
+        self.config.get_runtime_config('train').apply()
+        distillation_config = self.config.get_distillation_config()
+        distillation_config.run()
+
+if __name__ == '__main__':
+    try:
+        config = ConfigHandler()
+        stage_name = 'Distillation stage'
+        logger.info(f">>>>>> stage {stage_name} started <<<<<<")  # Log the start of the pipeline stage
+        pipeline = DistillationPipeline(config)
+        pipeline.main()
+        logger.info(f">>>>>> stage {stage_name} completed <<<<<<\n\nx==========x")  # Log the completion of the pipeline stage
+
+    except Exception as e:
+        logger.exception(e)  # Log the exception if an error occurs
+        raise e
\ No newline at end of file
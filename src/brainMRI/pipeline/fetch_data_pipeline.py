@@ -8,6 +8,7 @@ class FetchDataPipeline:
             self.config = config
 
     def main(self):
+        self.config.get_logging_config('fetch_data').apply()
         fetch_data_config = self.config.get_fetch_data_config()
         fetch_data_config.download_file()
         fetch_data_config.unzip_file()
@@ -0,0 +1,26 @@
+from brainMRI.config.configuration import ConfigHandler
+from brainMRI.logging import logger
+
+
+
+class HyperparameterSearchPipeline:
+    def __init__(self, config) -> None:
+            self.config = config
+
+    def main(self):
+        self.config.get_logging_config('hyperparameter_search').apply()
+        hyperparameter_search_config = self.config.get_hyperparameter_search_config()
+        hyperparameter_search_config.run()
+
+if __name__ == '__main__':
+    try:
+        config = ConfigHandler()
+        stage_name = 'Hyperparameter Search stage'
+        logger.info(f">>>>>> stage {stage_name} started <<<<<<")  # Log the start of the pipeline stage
+        pipeline = HyperparameterSearchPipeline(config)
+        pipeline.main()
+        logger.info(f">>>>>> stage {stage_name} completed <<<<<<\n\nx==========x")  # Log the completion of the pipeline stage
+
+    except Exception as e:
+        logger.exception(e)  # Log the exception if an error occurs
+        raise e
\ No newline at end of file
@@ -0,0 +1,26 @@
+from brainMRI.config.configuration import ConfigHandler
+from brainMRI.logging import logger
+
+
+
+class OnnxExportPipeline:
+    def __init__(self, config) -> None:
+            self.config = config
+
+    def main(self):
+        self.config.get_logging_config('onnx_export').apply()
+        onnx_export_config = self.config.get_onnx_export_config()
+        onnx_export_config.run(self.config.config.prediction.model_path)
+
+if __name__ == '__main__':
+    try:
+        config = ConfigHandler()
+        stage_name = 'ONNX Export stage'
+        logger.info(f">>>>>> stage {stage_name} started <<<<<<")  # Log the start of the pipeline stage
+        pipeline = OnnxExportPipeline(config)
+        pipeline.main()
+        logger.info(f">>>>>> stage {stage_name} completed <<<<<<\n\nx==========x")  # Log the completion of the pipeline stage
+
+    except Exception as e:
+        logger.exception(e)  # Log the exception if an error occurs
+        raise e
\ No newline at end of file
@@ -8,6 +8,8 @@ class PrepareDatasetsPipeline:
             self.config = config
 
     def main(self):
+        self.config.get_logging_config('prepare_datasets').apply()
+        self.config.get_runtime_config('prepare').apply()
         prepare_datasets_config = self.config.get_prepare_datasets_config()
         prepare_datasets_config.prepare_datasets()
 
@@ -0,0 +1,30 @@
+from brainMRI.config.configuration import ConfigHandler
+from brainMRI.logging import logger
+
+
+
+class RetrievalPipeline:
+    def __init__(self, config) -> None:
+            self.config = config
+
+    def main(self):
+        self.config.get_logging_config('retrieval').apply()
+        self.config.get_runtime_config('serve').apply()
+        prediction_config = self.config.get_prediction_config()
+        if prediction_config.retrieval is None:
+            logger.info("Similar-case retrieval is disabled, set retrieval.enabled in params.yaml")
+            return
+        prediction_config.retrieval.build(prediction_config)
+
+if __name__ == '__main__':
+    try:
+        config = ConfigHandler()
+        stage_name = 'Retrieval stage'
+        logger.info(f">>>>>> stage {stage_name} started <<<<<<")  # Log the start of the pipeline stage
+        pipeline = RetrievalPipeline(config)
+        pipeline.main()
+        logger.info(f">>>>>> stage {stage_name} completed <<<<<<\n\nx==========x")  # Log the completion of the pipeline stage
+
+    except Exception as e:
+        logger.exception(e)  # Log the exception if an error occurs
+        raise e
\ No newline at end of file
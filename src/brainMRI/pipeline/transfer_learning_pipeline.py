@@ -8,7 +8,9 @@ class TransferLearningPipeline:
             self.config = config
 
     def main(self):
-        transfer_learning_config = config.get_transfer_learning_config()
+        self.config.get_logging_config('transfer_learning').apply()
+        self.config.get_runtime_config('train').apply()
+        transfer_learning_config = self.config.get_transfer_learning_config()
         transfer_learning_config.train()
         transfer_learning_config.save_plots()
 
@@ -1,16 +1,26 @@
-from brainMRI.logging import logger
+from brainMRI.logging import attach_to_parent, logger
 import yaml
 import os
+import copy
+import threading
 from box import ConfigBox
 from ensure import ensure_annotations
 from box.exceptions import BoxValueError
 from pathlib import Path
 
+# Parsed YAML documents by path, with the modification time they were parsed at
+_config_cache = {}
+_config_cache_lock = threading.Lock()
+
+
 @ensure_annotations
 def load_config(config_file: Path) -> ConfigBox:
     """
     Load a YAML configuration file and return a ConfigBox object.
 
+    Each file is parsed once per process and parsed again only when its modification time changes.
+    Every call returns its own copy, so callers may modify the result.
+
     Args:
         config_file (Path): The path to the YAML configuration file.
 
@@ -23,13 +33,19 @@ def load_config(config_file: Path) -> ConfigBox:
         yaml.YAMLError: If there's an error parsing the YAML file.
     """
     try:
-        # Open the YAML file and load its contents
-        with open(config_file, 'r') as file:
-            config = yaml.safe_load(file)
-            logger.info(f"YAML file: {config_file} loaded successfully")
+        key = os.path.abspath(config_file)
+        mtime_ns = os.stat(config_file).st_mtime_ns
+        with _config_cache_lock:
+            cached = _config_cache.get(key)
+            if cached is None or cached[0] != mtime_ns:
+                # Open the YAML file and load its contents
+                with open(config_file, 'r') as file:
+                    config = yaml.safe_load(file)
+                    logger.info(f"YAML file: {config_file} loaded successfully")
+                cached = _config_cache[key] = (mtime_ns, config)
 
         # Wrap the loaded configuration in a ConfigBox object
-        return ConfigBox(config)
+        return ConfigBox(copy.deepcopy(cached[1]))
 
     # Handle specific exceptions
     except BoxValueError:
@@ -68,3 +84,49 @@ def create_directories(path_to_directories: list, verbose: bool = True):
         # Log an error message and re-raise the exception
         logger.error(f"Error creating directory '{path_to_directories}': {e}")
         raise
+
+
+
+# Not wrapped with ensure_annotations: process pools pickle the initializer by reference
+def limit_worker_threads(threads: int, log_queue=None):
+    """
+    Caps the number of threads used by a worker process so that parallel workers
+    do not oversubscribe the cores. Must run before any TensorFlow op is executed in the process.
+
+    Args:
+        threads (int): The number of intra-op threads allowed for the worker.
+        log_queue (multiprocessing.Queue): The parent's log queue, to send the worker's log file records to.
+    """
+    if log_queue is not None:
+        attach_to_parent(log_queue)
+    os.environ['OMP_NUM_THREADS'] = str(threads)
+    os.environ['TF_NUM_INTRAOP_THREADS'] = str(threads)
+    os.environ['TF_NUM_INTEROP_THREADS'] = str(min(2, threads))
+
+    import tensorflow as tf
+    tf.config.threading.set_intra_op_parallelism_threads(threads)
+    tf.config.threading.set_inter_op_parallelism_threads(min(2, threads))
+    logger.info(f"Worker {os.getpid()} limited to {threads} threads")
+
+
+
+def get_rss_mb() -> float:
+    """
+    Returns the current resident set size of the process in MB.
+    """
+    try:
+        with open('/proc/self/statm', 'r') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / (1024 * 1024)
+    except (OSError, ValueError):
+        return get_peak_rss_mb()
+
+
+def get_peak_rss_mb() -> float:
+    """
+    Returns the peak resident set size of the process in MB.
+    """
+    import resource
+    import sys
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
@@ -0,0 +1,34 @@
+import json
+import pytest
+import tensorflow as tf
+from brainMRI.components.class_balancing import ClassBalancing
+
+
+def class_balancing(tmp_path, train_counts):
+    (tmp_path / 'class_names.txt').write_text('no\nyes\n')
+    # The analyze stage counts every image, the validation split included
+    (tmp_path / 'image_counts.txt').write_text("Number of class 'no' images: 125\nNumber of class 'yes' images: 125\n")
+    (tmp_path / 'split_counts.json').write_text(json.dumps({'train': train_counts, 'val': {'no': 25, 'yes': 25}}))
+    return ClassBalancing(image_counts_path=tmp_path / 'image_counts.txt', class_names_file=tmp_path / 'class_names.txt',
+                          split_counts_path=tmp_path / 'split_counts.json')
+
+
+def unknown_length(labels):
+    dataset = tf.data.Dataset.from_tensor_slices((tf.zeros([len(labels), 2]), tf.constant(labels)))
+    return dataset.filter(lambda image, label: True).batch(10)
+
+
+def test_unknown_length_epoch_is_sized_from_the_training_split(tmp_path):
+    balancing = class_balancing(tmp_path, {'no': 100, 'yes': 100})
+
+    _, steps_per_epoch = balancing.balance(unknown_length([0, 1] * 100), 10)
+
+    assert steps_per_epoch == 20
+
+
+def test_class_without_training_images_is_rejected(tmp_path):
+    # Regression: its filtered stream repeated forever without producing an element
+    balancing = class_balancing(tmp_path, {'no': 200, 'yes': 0})
+
+    with pytest.raises(ValueError, match='yes'):
+        balancing.balance(unknown_length([0] * 200), 10)
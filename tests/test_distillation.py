@@ -0,0 +1,47 @@
+import json
+import numpy as np
+import tensorflow as tf
+from brainMRI.components.distillation import Distillation
+from brainMRI.components.model_registry import ModelRegistry
+from brainMRI.components.onnx_export import OnnxExport
+
+
+def save_dataset(path, count=8, image_size=16):
+    images = np.random.default_rng(0).uniform(0, 255, size=(count, image_size, image_size, 3)).astype(np.float32)
+    labels = (np.arange(count) % 2).astype(np.int32)
+    tf.data.Dataset.from_tensor_slices((images, labels)).batch(4).save(str(path))
+    return path
+
+
+def test_onnx_export_writes_the_student_and_not_the_promoted_teacher(tmp_path, monkeypatch):
+    # Regression: with a promoted registry version, OnnxExport.run exported the teacher instead of the student
+    inputs = tf.keras.Input(shape=(16, 16, 3))
+    x = tf.keras.layers.Conv2D(64, 3)(inputs)
+    x = tf.keras.layers.GlobalAveragePooling2D()(x)
+    teacher = tf.keras.Model(inputs, tf.keras.layers.Dense(1, activation='sigmoid')(x))
+    teacher_path = str(tmp_path / 'teacher.keras')
+    teacher.save(teacher_path)
+    registry = ModelRegistry(tmp_path / 'registry')
+    registry.promote(registry.register(teacher_path, {}))
+
+    def export(self, model, onnx_path):
+        # tf2onnx is optional, the file records the parameter count of the model it was given
+        with open(onnx_path, 'w') as f:
+            json.dump({'parameters': int(model.count_params())}, f)
+        return str(onnx_path)
+
+    monkeypatch.setattr(OnnxExport, 'export', export)
+    monkeypatch.setattr(OnnxExport, 'check_parity', lambda self, model, onnx_path: {})
+    distillation = Distillation(
+        root_dir=tmp_path / 'distillation', teacher_path=teacher_path,
+        train_dir=save_dataset(tmp_path / 'train'), val_dir=save_dataset(tmp_path / 'val'), image_size=(16, 16),
+        width=4, epochs=1, latency_batch_sizes=[1], latency_repeats=1,
+        onnx_export=OnnxExport(root_dir=tmp_path / 'onnx', image_size=16, model_registry=registry))
+
+    comparison = distillation.run()
+
+    with open(comparison['onnx_path']) as f:
+        assert json.load(f)['parameters'] == comparison['student']['parameters']
+    assert comparison['student']['parameters'] != comparison['teacher']['parameters']
+    assert comparison['onnx_path'] == str(tmp_path / 'distillation' / 'model.onnx')
+    assert not (tmp_path / 'registry' / 'versions' / registry.current() / 'model.onnx').exists()
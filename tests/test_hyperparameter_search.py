@@ -0,0 +1,54 @@
+import pickle
+import numpy as np
+import tensorflow as tf
+from brainMRI.components.hyperparameter_search import _MedianPruner, _connect
+from brainMRI.components.transfer_learning import TransferLearning
+
+
+def record(db_path, trial_id, epoch, val_loss):
+    with _connect(db_path) as connection:
+        connection.execute('INSERT OR REPLACE INTO epochs VALUES (?, ?, ?, ?)', (trial_id, epoch, val_loss, 0.0))
+
+
+def transfer_learning(tmp_path, **kwargs):
+    inputs = tf.keras.Input(shape=(8, 8, 3))
+    backbone_inputs = tf.keras.Input(shape=(8, 8, 3))
+    backbone = tf.keras.Model(backbone_inputs, tf.keras.layers.Conv2D(4, 3, name='block1_conv1')(backbone_inputs),
+                              name='vgg16')
+    x = tf.keras.layers.GlobalAveragePooling2D()(backbone(inputs))
+    tf.keras.Model(inputs, tf.keras.layers.Dense(1, activation='sigmoid')(x)).save(tmp_path / 'base_model.keras')
+    with open(tmp_path / 'callbacks.pickle', 'wb') as f:
+        pickle.dump([], f)
+
+    images = np.random.default_rng(0).uniform(0, 255, size=(8, 8, 8, 3)).astype(np.float32)
+    dataset = tf.data.Dataset.from_tensor_slices((images, np.arange(8) % 2)).batch(4)
+    return TransferLearning(root_dir=tmp_path, train_dir=None, val_dir=None,
+                            base_model_path=tmp_path / 'base_model.keras', epochs=2, batch_size=4,
+                            learning_rate=1e-3, callback_path=tmp_path / 'callbacks.pickle', train_dataset=dataset,
+                            val_dataset=dataset, fine_tune_epochs=2, export_saved_model=False, **kwargs)
+
+
+def test_pruned_trial_skips_the_remaining_phases(tmp_path):
+    # Regression: fit resets stop_training, so a pruned trial went on to fine-tune
+    db_path = str(tmp_path / 'trials.db')
+    record(db_path, 1, 0, 0.0)
+    trainer = transfer_learning(tmp_path, cache_features=False)
+    pruner = _MedianPruner(db_path, 0, [0, 1], warmup_epochs=0, enabled=True, transfer_learning=trainer)
+    trainer.callbacks.append(pruner)
+
+    trainer.train()
+
+    assert pruner.pruned
+    assert len(trainer.history.history['val_loss']) == 1
+
+
+def test_pruner_compares_only_the_trials_of_its_rung(tmp_path):
+    db_path = str(tmp_path / 'trials.db')
+    # A trial of an earlier search or another bracket, with a far lower loss
+    record(db_path, 7, 0, 0.0)
+    pruner = _MedianPruner(db_path, 0, [0, 1], warmup_epochs=0, enabled=True)
+    pruner.set_model(tf.keras.Sequential())
+
+    pruner.on_epoch_end(0, {'val_loss': 1.0})
+
+    assert not pruner.pruned
@@ -0,0 +1,58 @@
+import json
+import logging
+import multiprocessing
+import brainMRI.logging as brain_logging
+from brainMRI.logging import LoggingConfig, attach_to_parent, process_log_queue
+
+
+def log_from_child(log_queue, json_format):
+    brain_logging._config = LoggingConfig(stage='child', json_format=json_format, console=False)
+    attach_to_parent(log_queue)
+    logging.getLogger('child').info('from the child')
+    try:
+        raise ValueError('failed in the child')
+    except ValueError:
+        logging.getLogger('child').exception('child error %d', 2)
+
+
+def test_child_records_keep_the_format_of_their_stage(tmp_path):
+    log_file = tmp_path / 'running_logs.log'
+    LoggingConfig(stage='parent', log_file=str(log_file), console=False).apply()
+    try:
+        logging.getLogger('parent').info('from the parent')
+        child = multiprocessing.get_context('spawn').Process(target=log_from_child, args=(process_log_queue(), True))
+        child.start()
+        child.join()
+        assert child.exitcode == 0
+    finally:
+        brain_logging._stop_listener()
+        LoggingConfig(console=False).apply()
+
+    parent_line, child_line, error_line = log_file.read_text().splitlines()
+    assert parent_line.endswith('from the parent]')
+    record = json.loads(child_line)
+    assert record['message'] == 'from the child'
+    assert record['stage'] == 'child'
+    assert 'json_format' not in record
+    error = json.loads(error_line)
+    assert error['message'] == 'child error 2'
+    assert 'ValueError: failed in the child' in error['exception']
+
+
+def test_json_records_keep_the_exception_apart_from_the_message(tmp_path):
+    # Regression: QueueHandler.prepare folded the traceback into the message and dropped exc_info
+    log_file = tmp_path / 'running_logs.log'
+    LoggingConfig(json_format=True, log_file=str(log_file), console=False).apply()
+    try:
+        try:
+            raise ValueError('failed')
+        except ValueError:
+            logging.getLogger('parent').exception('error %s', 'here')
+    finally:
+        brain_logging._stop_listener()
+        LoggingConfig(console=False).apply()
+
+    record = json.loads(log_file.read_text())
+    assert record['message'] == 'error here'
+    assert record['exception'].startswith('Traceback')
+    assert 'ValueError: failed' in record['exception']
@@ -0,0 +1,25 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+import pytest
+from brainMRI.components.model_registry import ModelRegistry
+
+
+def test_concurrent_registrations_get_distinct_versions(tmp_path):
+    model_path = tmp_path / 'model.keras'
+    model_path.write_bytes(b'model')
+    registry = ModelRegistry(tmp_path / 'registry', keep_versions=100)
+
+    with ThreadPoolExecutor(8) as executor:
+        versions = list(executor.map(lambda index: registry.register(model_path, {'index': index}), range(32)))
+
+    assert sorted(versions) == [f'v{index:04d}' for index in range(1, 33)]
+    assert all(registry.metadata(version)['version'] == version for version in versions)
+
+
+def test_failed_registration_leaves_no_staging_directory(tmp_path):
+    registry = ModelRegistry(tmp_path / 'registry')
+
+    with pytest.raises(FileNotFoundError):
+        registry.register(tmp_path / 'missing.keras', {})
+
+    assert [name for name in os.listdir(registry.root_dir) if name.startswith('.staging-')] == []
@@ -0,0 +1,31 @@
+import os
+import numpy as np
+from PIL import Image
+from brainMRI.components.prepare_datasets import PrepareDatasets
+from brainMRI.components.volumes import VolumeReader
+from test_volumes import volume, write_nifti
+
+
+def test_directory_mode_reads_the_non_empty_volume_slices(tmp_path):
+    data = volume()
+    os.makedirs(tmp_path / 'data' / 'yes')
+    os.makedirs(tmp_path / 'data' / 'no')
+    write_nifti(str(tmp_path / 'data' / 'yes' / 'case.nii.gz'), data)
+    Image.fromarray(np.full((4, 6, 3), 7, np.uint8)).save(tmp_path / 'data' / 'no' / 'image.png')
+    prepare = PrepareDatasets(data_dir=str(tmp_path / 'data'), save_dir=str(tmp_path / 'prepared'),
+                              validation_split=0.5, image_size=(4, 6), batch_size=8, labels='inferred',
+                              subset='both', seed=1,
+                              volume_reader=VolumeReader(window_center=127.5, window_width=255.0))
+    os.makedirs(prepare.save_dir)
+
+    datasets = prepare.prepare_datasets()
+
+    images = np.concatenate([images.numpy() for dataset in datasets for images, _ in dataset])
+    labels = np.concatenate([labels.numpy() for dataset in datasets for _, labels in dataset])
+    slices = sorted((image[..., 0] for image, label in zip(images, labels) if label == 1),
+                    key=lambda image: image.sum())
+    expected = sorted(((data[:, :, index] * 2 + 1).T for index in (0, 2, 4)), key=lambda image: image.sum())
+    assert len(labels) == 4
+    assert np.all(images[labels == 0] == 7)
+    for image, slice_image in zip(slices, expected):
+        np.testing.assert_allclose(image, slice_image)
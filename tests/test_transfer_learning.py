@@ -0,0 +1,21 @@
+import tensorflow as tf
+from brainMRI.components.class_balancing import ClassBalancing
+from brainMRI.components.transfer_learning import cache_dataset
+
+
+def test_balancing_reads_a_cache_larger_than_the_shuffle_buffer(tmp_path):
+    # Regression: the per-class streams of sample balancing each opened a writer on an unfilled cache
+    class_names_file = tmp_path / 'class_names.txt'
+    class_names_file.write_text('no\nyes\n')
+    (tmp_path / 'image_counts.txt').write_text("Number of class 'no' images: 2000\nNumber of class 'yes' images: 1000\n")
+    class_balancing = ClassBalancing(image_counts_path=tmp_path / 'image_counts.txt',
+                                     class_names_file=class_names_file, shuffle_buffer_size=1000)
+    labels = tf.cast(tf.range(3000) % 3 == 0, tf.float32)[:, None]
+    dataset = tf.data.Dataset.from_tensor_slices((tf.random.uniform([3000, 4]), labels)).batch(32)
+
+    balanced, steps_per_epoch = class_balancing.balance(cache_dataset(dataset, str(tmp_path / 'features')), 32)
+
+    labels = tf.concat([label for _, label in balanced.take(steps_per_epoch)], axis=0)
+    assert steps_per_epoch == 94
+    assert labels.shape[0] == 94 * 32
+    assert 0.4 < float(tf.reduce_mean(labels)) < 0.6
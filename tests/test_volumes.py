@@ -0,0 +1,86 @@
+import gzip
+import numpy as np
+import pytest
+from brainMRI.components.volumes import VolumeReader, read_nifti_header
+
+
+def write_nifti(path, data, byte_order='<', spacing=(0.5, 0.75, 2.0), slope=2.0, intercept=1.0):
+    """
+    Writes a single-file NIfTI-1 volume with a hand-built 348-byte header and the voxels in Fortran order.
+    """
+    header = bytearray(348)
+    header[0:4] = np.array(348, f'{byte_order}i4').tobytes()
+    dim = [data.ndim, *data.shape] + [1] * (7 - data.ndim)
+    header[40:56] = np.array(dim, f'{byte_order}i2').tobytes()
+    header[70:72] = np.array(4, f'{byte_order}i2').tobytes()  # int16
+    header[72:74] = np.array(16, f'{byte_order}i2').tobytes()
+    header[76:108] = np.array([1.0, *spacing, 0, 0, 0, 0], f'{byte_order}f4').tobytes()
+    header[108:120] = np.array([352, slope, intercept], f'{byte_order}f4').tobytes()
+    header[344:348] = b'n+1\0'
+    # The 4-byte extension flag, then the voxels
+    payload = bytes(header) + bytes(4) + data.astype(f'{byte_order}i2').tobytes(order='F')
+    opener = gzip.open if str(path).endswith('.gz') else open
+    with opener(path, 'wb') as f:
+        f.write(payload)
+    return path
+
+
+def volume():
+    # Stored values 0-127, 0-255 once scaled by 2 and offset by 1; slices 1 and 3 are empty
+    data = np.random.default_rng(0).integers(0, 128, size=(6, 4, 5)).astype(np.int16)
+    data[:, :, 1] = 0
+    data[:, :, 3] = 50
+    return data
+
+
+@pytest.mark.parametrize('byte_order', ['<', '>'])
+@pytest.mark.parametrize('extension', ['.nii', '.nii.gz'])
+def test_nifti_header_round_trip(tmp_path, extension, byte_order):
+    path = write_nifti(str(tmp_path / f'case{extension}'), volume(), byte_order)
+
+    header = read_nifti_header(path)
+
+    assert header['format'] == 'nifti'
+    assert header['shape'] == [6, 4, 5]
+    assert header['dtype'] == np.dtype(np.int16).newbyteorder(byte_order).str
+    assert header['spacing'] == [0.5, 0.75, 2.0]
+    assert header['vox_offset'] == 352
+    assert header['scl_slope'] == 2.0
+    assert header['scl_inter'] == 1.0
+
+
+@pytest.mark.parametrize('extension', ['.nii', '.nii.gz'])
+def test_nifti_slices_round_trip(tmp_path, extension):
+    data = volume()
+    path = write_nifti(str(tmp_path / f'case{extension}'), data)
+    # A window of 0-255 leaves the scaled intensities unchanged
+    reader = VolumeReader(window_center=127.5, window_width=255.0, skip_empty_slices=False)
+
+    slice_paths = list(reader.slice_paths(path, 'yes/case'))
+
+    assert slice_paths == [f'yes/case#slice={index:04d}' for index in range(5)]
+    assert reader.header(path)['slices'] == 5
+    assert reader.slice_size(reader.header(path)) == (6, 4)
+    for index in range(5):
+        image = reader.read_slice(f'{path}#slice={index:04d}')
+        assert image.dtype == np.uint8
+        np.testing.assert_array_equal(image, (data[:, :, index] * 2 + 1).T)
+
+
+def test_empty_slices_are_skipped_and_not_counted(tmp_path):
+    path = write_nifti(str(tmp_path / 'case.nii.gz'), volume())
+    reader = VolumeReader(window_center=127.5, window_width=255.0)
+
+    kept = [index for index in range(5) if reader.read_slice(f'{path}#slice={index:04d}') is not None]
+
+    assert kept == [0, 2, 4]
+    assert reader.count_slices(path) == 3
+    assert VolumeReader(skip_empty_slices=False).count_slices(path) == 5
+
+
+def test_header_rejects_non_nifti_files(tmp_path):
+    path = tmp_path / 'case.nii'
+    path.write_bytes(bytes(400))
+
+    with pytest.raises(ValueError):
+        read_nifti_header(str(path))